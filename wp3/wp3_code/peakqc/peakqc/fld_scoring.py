@@ -10,7 +10,9 @@ from tqdm import tqdm
 import multiprocessing as mp
 from scipy.signal import find_peaks
 from scipy.signal import fftconvolve
-from typing import List, Union
+from scipy.ndimage import convolve1d
+from scipy import sparse
+from typing import Iterator, List, Union
 from beartype.typing import Optional, Literal, SupportsFloat, Tuple
 from beartype import beartype
 import numpy.typing as npt
@@ -21,6 +23,12 @@ import gc as gc
 from multiprocessing import Pool
 import peakqc.insertsizes as insertsizes
 import math
+from collections.abc import Sequence
+
+# batch_convolve: kernel length up to which the 'direct' backend beats the fft
+CONV_DIRECT_KERNEL = 32
+# call_peaks: number of row blocks per thread (a few per thread to balance the load)
+PEAK_BLOCKS_PER_THREAD = 4
 
 
 @beartype
@@ -30,12 +38,17 @@ def moving_average(series: npt.ArrayLike,
     Move average filter to smooth out data.
 
     This implementation ensures that the smoothed data has no shift and
-    local maxima remain at the same position.
+    local maxima remain at the same position. Steps 0 to n and the last n - 1
+    steps are kept unsmoothed.
+
+    A 2D array is smoothed row-wise in one pass. The window is summed step by
+    step over the whole array, so each value is accumulated in the same order
+    as in a per-element loop and the result is bit-identical to it.
 
     Parameters
     ----------
     series : npt.ArrayLike
-        Array of data to be smoothed.
+        Array of data to be smoothed. 1D or 2D (smoothed along the last axis).
     n : int, default 10
         Number of steps to the left and right of the current step to be averaged.
 
@@ -45,20 +58,20 @@ def moving_average(series: npt.ArrayLike,
         Smoothed array
     """
 
-    list(series)
-    smoothed = []
-    for i in range(len(series)):  # loop over all steps
-        sumPerStep = 0
-        if i > n and i <= (len(series) - n):  # main phase
-            for j in range(-n, n):
-                sumPerStep += series[i + j]
-            smoothed.append(sumPerStep / (n * 2))
-        elif i > (len(series) - n):  # end phase
-            smoothed.append(series[i])
-        elif i <= n:  # init phase
-            smoothed.append(series[i])
-
-    smoothed = np.array(smoothed)
+    series = np.asarray(series)
+    length = series.shape[-1]
+    # main phase: steps n + 1 to length - n, averaged over [i - n, i + n)
+    n_main = max(length - 2 * n, 0)
+    if n_main == 0:
+        return series.copy()
+
+    window_sum = np.zeros(series.shape[:-1] + (n_main,), dtype=series.dtype)
+    for j in range(2 * n):
+        window_sum += series[..., j + 1:j + 1 + n_main]
+    main = window_sum / (n * 2)
+
+    smoothed = series.astype(np.result_type(series, main))
+    smoothed[..., n + 1:n + 1 + n_main] = main
 
     return smoothed
 
@@ -69,7 +82,7 @@ def multi_ma(series: npt.ArrayLike,
              window_size: int = 10,
              n_threads: int = 8) -> npt.ArrayLike:
     """
-    Multiprocessing wrapper for moving average filter.
+    Apply the moving average filter repeatedly to every row of an array.
 
     Parameters
     ----------
@@ -80,7 +93,8 @@ def multi_ma(series: npt.ArrayLike,
     window_size : int, default 10
         Number of steps to the left and right of the current step to be averaged.
     n_threads : int, default 8
-        Number of threads to be used for multiprocessing.
+        Unused. The filter is vectorized over all rows and runs without a process pool;
+        kept for backwards compatibility.
 
     Returns
     -------
@@ -88,25 +102,9 @@ def multi_ma(series: npt.ArrayLike,
         array of smoothed array
     """
 
-    # smooth
+    series = np.asarray(series)
     for i in range(n):
-
-        smooth_series = []
-        # init pool
-        pool = mp.Pool(n_threads)
-        jobs = []
-        # loop over chunks
-
-        for dist in series:
-            job = pool.apply_async(moving_average, args=(dist, window_size))
-            jobs.append(job)
-        pool.close()
-
-        # collect results
-        for job in jobs:
-            smooth_series.append(job.get())
-
-        series = np.array(smooth_series)
+        series = moving_average(series, n=window_size)
 
     return series
 
@@ -148,11 +146,163 @@ def scale(series_arr: npt.ArrayLike) -> npt.ArrayLike:
 # ////////////////////////////////// Peak calling \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
 
 
+class PeakList(Sequence):
+    """
+    Ragged peaks of many cells in CSR layout (flat peak indices plus row offsets).
+
+    The peaks of cell i are indices[offsets[i]:offsets[i + 1]]. Indexing and iterating
+    yield these per-cell arrays, so a PeakList can be used wherever a list of peak arrays
+    was used before, while the scoring functions work on the flat arrays directly.
+
+    Parameters
+    ----------
+    indices : npt.ArrayLike
+        Peak positions of all cells, concatenated in cell order.
+    offsets : npt.ArrayLike
+        Start of every cell in indices, followed by len(indices) (n_cells + 1 values).
+
+    Attributes
+    ----------
+    indices : np.ndarray
+        Flat peak positions.
+    offsets : np.ndarray
+        Row offsets into indices.
+
+    Raises
+    ------
+    ValueError
+        If offsets do not start at 0, decrease or do not end at len(indices).
+    """
+
+    indices: np.ndarray
+    offsets: np.ndarray
+
+    def __init__(self, indices: npt.ArrayLike, offsets: npt.ArrayLike):
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        if self.offsets.ndim != 1 or len(self.offsets) == 0 or self.offsets[0] != 0 \
+                or self.offsets[-1] != len(self.indices) or np.any(np.diff(self.offsets) < 0):
+            raise ValueError("offsets must start at 0, be non-decreasing and end at len(indices).")
+
+    @classmethod
+    def from_list(cls, peaks: "PeakList | list | npt.ArrayLike") -> "PeakList":
+        """
+        Build a PeakList from a list of per-cell peak arrays.
+
+        Parameters
+        ----------
+        peaks : PeakList | list | npt.ArrayLike
+            Per-cell peak arrays. A PeakList is returned unchanged.
+
+        Returns
+        -------
+        PeakList
+            The peaks in CSR layout.
+        """
+
+        if isinstance(peaks, cls):
+            return peaks
+
+        rows = [np.asarray(row, dtype=np.intp).ravel() for row in peaks]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        indices = np.concatenate(rows) if rows else np.array([], dtype=np.intp)
+
+        return cls(indices, offsets)
+
+    @property
+    def counts(self) -> np.ndarray:
+        """Number of peaks per cell."""
+        return np.diff(self.offsets)
+
+    @property
+    def rows(self) -> np.ndarray:
+        """Cell index of every peak."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    @property
+    def rank(self) -> np.ndarray:
+        """Position of every peak within its cell (0 for the first peak)."""
+        return np.arange(len(self.indices)) - np.repeat(self.offsets[:-1], self.counts)
+
+    def to_list(self) -> list[np.ndarray]:
+        """Return the peaks as a list of per-cell arrays."""
+        return np.split(self.indices, self.offsets[1:-1]) if len(self) else []
+
+    def reduce(self, values: npt.ArrayLike) -> np.ndarray:
+        """
+        Sum per-peak values per cell with np.add.reduceat.
+
+        Parameters
+        ----------
+        values : npt.ArrayLike
+            One value per peak (aligned with indices).
+
+        Returns
+        -------
+        np.ndarray
+            Sum per cell, 0 for cells without peaks.
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        sums = np.zeros(len(self), dtype=np.float64)
+        # reduceat returns the element at the offset for empty segments, so only reduce non-empty cells
+        non_empty = self.counts > 0
+        if non_empty.any():
+            sums[non_empty] = np.add.reduceat(values, self.offsets[:-1][non_empty])
+
+        return sums
+
+    def __len__(self) -> int:
+        """Return the number of cells."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int | np.integer | slice) -> "np.ndarray | PeakList":
+        """
+        Return the peaks of cell i, or a PeakList of the cells selected by a slice.
+
+        Parameters
+        ----------
+        i : int | np.integer | slice
+            Cell index or slice of cells.
+
+        Returns
+        -------
+        np.ndarray | PeakList
+            Peaks of the cell or PeakList of the selected cells.
+
+        Raises
+        ------
+        TypeError
+            If i is neither an integer nor a slice, e.g. an array of cell indices.
+        IndexError
+            If i is out of range.
+        """
+
+        if isinstance(i, slice):
+            return PeakList.from_list(self.to_list()[i])
+        if isinstance(i, (bool, np.bool_)) or not isinstance(i, (int, np.integer)):
+            raise TypeError(f"PeakList indices must be integers or slices, not {type(i).__name__}")
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("PeakList index out of range")
+
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+    def __repr__(self) -> str:
+        """Return the number of cells and peaks."""
+        return f"PeakList(n_cells={len(self)}, n_peaks={len(self.indices)})"
+
+
 @beartype
 def call_peaks(data: npt.ArrayLike,
                n_threads: int = 4,
                distance: int = 50,
-               width: int = 10) -> npt.ArrayLike:
+               width: int = 10,
+               block_size: Optional[int] = None) -> PeakList:
     """
     Find peaks for multiple arrays at once.
 
@@ -161,38 +311,80 @@ def call_peaks(data: npt.ArrayLike,
     data : np.ndarray
         Array of arrays to find peaks in (2D).
     n_threads : int, default 4
-        Number of threads to be used for multiprocessing.
+        Number of threads to be used for multiprocessing. With 1 no pool is started.
     distance : int, default 50
         Minimum distance between peaks.
     width : int, default 10
         Minimum width of peaks.
+    block_size : Optional[int], default None
+        Number of rows sent to a worker at once. Defaults to splitting the rows
+        into PEAK_BLOCKS_PER_THREAD blocks per thread.
 
     Notes
     -----
-    Multiprocessing wrapper for scipy.signal.find_peaks.
+    Multiprocessing wrapper for scipy.signal.find_peaks. Each worker processes a
+    contiguous block of rows and returns the peaks of the block as one flat array
+    with row offsets, so only one array pair per block is pickled.
 
     Returns
     -------
-    npt.ArrayLike
-        Array of peaks (index of data)
+    PeakList
+        Peaks (index of data) of every row.
     """
 
-    peaks = []
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[None, :]
+    n_rows = len(data)
 
-    pool = mp.Pool(n_threads)
-    jobs = []
+    if block_size is None:
+        block_size = max(1, math.ceil(n_rows / (n_threads * PEAK_BLOCKS_PER_THREAD)))
+    blocks = [data[start:start + block_size] for start in range(0, n_rows, block_size)]
 
-    for array in data:
-        job = pool.apply_async(call_peaks_worker, args=(array, distance, width))
-        jobs.append(job)
-    pool.close()
+    if n_threads == 1 or len(blocks) <= 1:
+        results = [_call_peaks_block(block, distance, width) for block in blocks]
+    else:
+        with Pool(n_threads) as pool:
+            results = pool.starmap(_call_peaks_block, [(block, distance, width) for block in blocks])
 
-    # collect results
-    for job in jobs:
-        peak_list = job.get()
-        peaks.append(peak_list)
+    # stitch the flat peaks of the blocks together, shifting the offsets of every block
+    indices = [np.array([], dtype=np.intp)]
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for flat, block_offsets in results:
+        offsets.append(block_offsets[1:] + offsets[-1][-1])
+        indices.append(flat)
 
-    return peaks
+    return PeakList(np.concatenate(indices), np.concatenate(offsets))
+
+
+def _call_peaks_block(block: np.ndarray,
+                      distance: int,
+                      width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find peaks in a block of rows.
+
+    Parameters
+    ----------
+    block : np.ndarray
+        2D array of rows to find peaks in.
+    distance : int
+        Minimum distance between peaks.
+    width : int
+        Minimum width of peaks.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Flat array of the peaks of all rows and the row offsets into it (len(block) + 1).
+    """
+
+    row_peaks = [find_peaks(row, distance=distance, width=width)[0] for row in block]
+
+    offsets = np.zeros(len(row_peaks) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in row_peaks], out=offsets[1:])
+    flat = np.concatenate(row_peaks) if row_peaks else np.array([], dtype=np.intp)
+
+    return flat.astype(np.intp, copy=False), offsets
 
 
 @beartype
@@ -223,17 +415,17 @@ def call_peaks_worker(array: npt.ArrayLike,
 
 
 @beartype
-def filter_peaks(peaks: npt.ArrayLike,
+def filter_peaks(peaks: npt.ArrayLike | PeakList,
                  reference: npt.ArrayLike,
                  peaks_thr: SupportsFloat,
-                 operator: Literal['bigger', 'smaller'] = 'bigger') -> npt.ArrayLike:
+                 operator: Literal['bigger', 'smaller'] = 'bigger') -> npt.ArrayLike | PeakList:
     """
     Filter peaks based on a reference array and a threshold.
 
     Parameters
     ----------
-    peaks : npt.ArrayLike
-        Array of peaks to be filtered.
+    peaks : npt.ArrayLike | PeakList
+        Array of peaks to be filtered (1D reference) or peaks per row (2D reference).
     reference : npt.ArrayLike
         Array of reference values (e.g. data were peaks were found).
     peaks_thr : float
@@ -243,33 +435,34 @@ def filter_peaks(peaks: npt.ArrayLike,
 
     Returns
     -------
-    npt.ArrayLike
-        Filtered array of peaks
+    npt.ArrayLike | PeakList
+        Filtered array of peaks, a PeakList for a 2D reference.
     """
 
-    filtered_peaks = []
+    reference = np.asarray(reference)
 
-    if operator == "bigger":
-        if len(reference.shape) == 1:
-            filtered_peaks = peaks[np.where(reference[peaks] >= peaks_thr)]
-        if len(reference.shape) == 2:
-            for i, index in enumerate(peaks):
-                filtered_peaks.append(index[np.where(reference[i, index] >= peaks_thr)])
+    if len(reference.shape) == 1:
+        peaks = np.asarray(peaks)
+        values = reference[peaks]
+        keep = values >= peaks_thr if operator == "bigger" else values <= peaks_thr
 
-    if operator == "smaller":
-        if len(reference.shape) == 1:
-            filtered_peaks = peaks[np.where(reference[peaks] <= peaks_thr)]
-        if len(reference.shape) == 2:
-            for i, index in enumerate(peaks):
-                filtered_peaks.append(index[np.where(reference[i, index] <= peaks_thr)])
+        return peaks[keep]
 
-    return filtered_peaks
+    # gather the reference value of every peak of all rows at once
+    peaks = PeakList.from_list(peaks)
+    values = reference[peaks.rows, peaks.indices]
+    keep = values >= peaks_thr if operator == "bigger" else values <= peaks_thr
+
+    offsets = np.zeros(len(peaks) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(peaks.rows[keep], minlength=len(peaks)), out=offsets[1:])
+
+    return PeakList(peaks.indices[keep], offsets)
 
 # //////////////////////////////////////// Scoring \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
 
 
 @beartype
-def distances_score(peaks: npt.ArrayLike,
+def distances_score(peaks: npt.ArrayLike | PeakList,
                     momentum: npt.ArrayLike,
                     period: int,
                     penalty_scale: int) -> npt.ArrayLike:
@@ -278,8 +471,8 @@ def distances_score(peaks: npt.ArrayLike,
 
     Parameters
     ----------
-    peaks : npt.ArrayLike
-        Array of peaks.
+    peaks : npt.ArrayLike | PeakList
+        Peaks per cell.
     momentum : npt.ArrayLike
         Array of momentum values.
     period : int
@@ -293,39 +486,28 @@ def distances_score(peaks: npt.ArrayLike,
         Array of scores
     """
 
-    scores = []
-    # loop over all cells
-    for i in range(len(peaks)):
-        # get peaks and momentum for single cell
-        peak_list = peaks[i]
-        single_momentum = momentum[i]
-
-        # calculate score
-        if len(peak_list) == 0:
-            score = 0
-        elif len(peak_list) == 1:  # if only one peak, score is the momentum at that peak divided by 100
-            score = single_momentum[peak_list[0]] / 100
-        elif len(peak_list) > 1:  # if more than one peak
-            corrected_scores = []
-            for j in range(1, len(peak_list)):  # loop over all peaks
-                amplitude = single_momentum[peak_list[j - 1]] * 2  # amplitude is the momentum at the previous peak
-
-                diff = peak_list[j] - peak_list[j - 1]  # difference between the current and previous peak
-                corrected_score = amplitude - (abs(diff - period) / penalty_scale)  # corrected score
-                if corrected_score < 0:
-                    corrected_score = 0
+    peaks = PeakList.from_list(peaks)
+    momentum = np.asarray(momentum)
+    rows, indices, rank = peaks.rows, peaks.indices, peaks.rank
 
-                corrected_scores.append(corrected_score)  # append corrected score to list
+    # every peak after the first is scored against its predecessor:
+    # amplitude (twice the momentum at the previous peak) minus the deviation from the period
+    previous = np.roll(indices, 1)
+    amplitude = momentum[rows, previous] * 2
+    corrected = np.maximum(amplitude - np.abs(indices - previous - period) / penalty_scale, 0)
+    corrected[rank == 0] = 0
 
-            score = float(np.sum(np.array(corrected_scores))) + 0  # sum all corrected scores
+    scores = peaks.reduce(corrected)
 
-        scores.append(score)  # append score to list
+    # if only one peak, score is the momentum at that peak divided by 100
+    single = peaks.counts == 1
+    scores[single] = momentum[single, indices[peaks.offsets[:-1][single]]] / 100
 
     return scores
 
 
 @beartype
-def score_mask(peaks: npt.ArrayLike,
+def score_mask(peaks: npt.ArrayLike | PeakList,
                convolved_data: npt.ArrayLike,
                insert_counts: npt.ArrayLike,
                plot_mask: bool = True,
@@ -335,8 +517,8 @@ def score_mask(peaks: npt.ArrayLike,
 
     Parameters
     ----------
-    peaks : npt.ArrayLike
-        Array of arrays of the peaks.
+    peaks : npt.ArrayLike | PeakList
+        Peaks per sample.
     convolved_data : npt.ArrayLike
         Array of arrays of the convolved data.
     plot_mask : bool, default False
@@ -356,32 +538,17 @@ def score_mask(peaks: npt.ArrayLike,
     else:
         score_mask = build_score_mask(plot_mask=plot_mask, save_mask=save_mask)
 
-    scores = []
-    # loop over all cells
-    for i, peak_list in enumerate(peaks):
-        conv = convolved_data[i]
-
-        # calculate score
-        # if no peaks, score is 0
-        if len(peak_list) == 0:
-            score = 0
-        # if only one peak, score is the convolved data at that peak multiplied by the score mask
-        elif len(peak_list) == 1:
-            score = conv[peak_list[0]] * score_mask[0][peak_list[0]]
+    peaks = PeakList.from_list(peaks)
+    convolved_data = np.asarray(convolved_data)
+    rows, indices, rank = peaks.rows, peaks.indices, peaks.rank
 
+    # the convolved data at every peak is weighted by the mask of its rank (the 4th mask for all later peaks);
+    # the first peak only counts if it is the only peak of the cell
+    weights = score_mask[np.minimum(rank, 3), indices]
+    values = convolved_data[rows, indices] * weights
+    values[(rank == 0) & (peaks.counts[rows] > 1)] = 0
 
-        elif len(peak_list) > 1:
-            score = 0
-            for j in range(1, len(peak_list)):
-                if j <= 3:
-                    score += conv[peak_list[j]] * score_mask[j][peak_list[j]] 
-                #############################################################
-                else:
-                    score += conv[peak_list[j]] * score_mask[3][peak_list[j]]
-                #############################################################
-        scores.append(score)
-
-    return np.array(scores)
+    return peaks.reduce(values)
 
 
 @beartype
@@ -644,10 +811,80 @@ def wavelet_transform_fld(dists_arr: npt.ArrayLike,
 
 
 @beartype
-def custom_conv(data: npt.ArrayLike,
+def batch_convolve(data: npt.ArrayLike | sparse.spmatrix,
+                   kernel: npt.ArrayLike,
+                   backend: Literal['auto', 'direct', 'fft', 'toeplitz'] = 'auto') -> np.ndarray:
+    """
+    Convolve every row of a 2D array with a kernel in one call.
+
+    The result equals np.convolve(row, kernel, mode='same') for every row
+    (up to floating point rounding).
+
+    Parameters
+    ----------
+    data : npt.ArrayLike | sparse.spmatrix
+        2D array (rows x positions), e.g. cells x fragment lengths.
+        A 1D array is treated as a single row.
+    kernel : npt.ArrayLike
+        1D kernel, e.g. a wavelet.
+    backend : Literal['auto', 'direct', 'fft', 'toeplitz'], default 'auto'
+        'direct' sums the shifted rows (scipy.ndimage) and is fastest for short kernels.
+        'fft' convolves all rows with scipy.signal.fftconvolve along axis 1.
+        'toeplitz' multiplies the data with the convolution matrix of the kernel,
+        sparse input is not densified.
+        'auto' uses 'toeplitz' for sparse input, 'direct' for short kernels and 'fft' otherwise.
+
+    Returns
+    -------
+    np.ndarray
+        Convolved data (rows x max(positions, kernel length)).
+    """
+
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if not sparse.issparse(data):
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    length = data.shape[1]
+    n_kernel = len(kernel)
+    # np.convolve 'same': centered slice of the full convolution of length max(length, n_kernel)
+    n_out = max(length, n_kernel)
+    offset = (min(length, n_kernel) - 1) // 2
+
+    if backend == 'auto':
+        if sparse.issparse(data):
+            backend = 'toeplitz'
+        elif n_kernel <= CONV_DIRECT_KERNEL:
+            backend = 'direct'
+        else:
+            backend = 'fft'
+
+    if backend == 'toeplitz':
+        # matrix[i, j] = kernel[j + offset - i], the contribution of position i to output j
+        taps = np.arange(n_out)[None, :] + offset - np.arange(length)[:, None]
+        valid = (taps >= 0) & (taps < n_kernel)
+        matrix = np.where(valid, kernel[np.clip(taps, 0, n_kernel - 1)], 0.0)
+        return np.asarray(data @ matrix)
+
+    if sparse.issparse(data):
+        data = data.toarray().astype(np.float64)
+
+    if backend == 'fft':
+        full = fftconvolve(data, kernel[None, :], mode='full', axes=1)
+        return full[:, offset:offset + n_out]
+
+    if n_kernel > length:
+        # the output is longer than the rows, np.convolve swaps the roles of both inputs
+        return np.array([np.convolve(row, kernel, mode='same') for row in data])
+
+    # scipy.ndimage centers even kernels one position right of np.convolve
+    return convolve1d(data, kernel, axis=1, mode='constant', cval=0.0,
+                      origin=(n_kernel - 1) // 2 - n_kernel // 2)
+
+
+@beartype
+def custom_conv(data: npt.ArrayLike | sparse.spmatrix,
                 wavelength: int = 150,
                 sigma: float = 0.4,
-                mode: str = 'convolve',
+                mode: Literal['convolve', 'fftconvolve', 'auto', 'direct', 'fft', 'toeplitz'] = 'convolve',
                 save_wavl: Optional[str] = None,
                 plot_wavl: bool = True) -> npt.ArrayLike:
     """
@@ -655,16 +892,15 @@ def custom_conv(data: npt.ArrayLike,
 
     Parameters
     ----------
-    data : npt.ArrayLike
+    data : npt.ArrayLike | sparse.spmatrix
         Array of arrays of the fragment length distributions.
     wavelength : int, default 150
         Wavelength of the wavelet.
     sigma : float, default 0.4
         Standard deviation of the Gaussian curve.
-    mode : str, default 'concolve'
-        Mode of the convoluti
-        
-        on. Either 'convolve' or 'fftconvolve'.
+    mode : str, default 'convolve'
+        Backend of batch_convolve. 'convolve' selects the backend automatically,
+        'fftconvolve' is an alias of 'fft'.
     plot_wavl : bool, default True
         If true, the wavelet is plotted.
 
@@ -691,21 +927,18 @@ def custom_conv(data: npt.ArrayLike,
                               sigma=sigma,
                               plot=plot_wavl,
                               save_wavl=save_wavl)
-    
-    # convolve with the data
-    
-    convolved_data = []
-    for cell in data:
-        if mode == 'convolve':
-            convolved_data.append(np.convolve(cell, wavelet, mode='same'))
-        elif mode == 'fftconvolve':
-            convolved_data.append(fftconvolve(data, wavelet, mode='same'))
 
-    return np.array(convolved_data)
-    
-    
+    # convolve all cells at once
+    backend = {'convolve': 'auto', 'fftconvolve': 'fft'}.get(mode, mode)
+    if not sparse.issparse(data) and np.ndim(data) == 1:
+        # each element is a cell of its own, as when iterating over the data
+        data = np.asarray(data)[:, None]
+
+    return batch_convolve(data, wavelet, backend=backend)
+
+
 @beartype
-def score_by_conv(data: npt.ArrayLike,
+def score_by_conv(data: npt.ArrayLike | sparse.spmatrix,
                   insert_counts: npt.ArrayLike,
                   wavelength: int = 150,
                   sigma: float = 0.4,
@@ -718,14 +951,17 @@ def score_by_conv(data: npt.ArrayLike,
                   operator: str = 'bigger',
                   plot_mask: bool = True,
                   plot_ov: bool = True,
-                  sample: int = 0) -> npt.ArrayLike:
+                  sample: int = 0,
+                  chunk_size: Optional[int] = None,
+                  rows: Optional[np.ndarray] = None) -> npt.ArrayLike:
     """
     Get a score by a continues wavelet transformation based convolution of the distribution with a single wavelet and score mask.
 
     Parameters
     ----------
-    data : npt.ArrayLike
+    data : npt.ArrayLike | sparse.spmatrix
         Array of arrays of the fragment length distributions.
+        Sparse input is scored in dense chunks of chunk_size rows.
     wavelength : int, default 150
         Wavelength of the wavelet.
     sigma : float, default 0.4
@@ -746,13 +982,47 @@ def score_by_conv(data: npt.ArrayLike,
         If true, the figure is saved.
     sample : int, default 0
         Index of the sample to plot.
+    chunk_size : Optional[int], default None
+        Number of rows to score at once. Defaults to all rows for dense input
+        and to insertsizes.DENSE_CHUNK_SIZE for sparse input.
+    rows : Optional[np.ndarray], default None
+        Indices of the rows of data to score, insert_counts holds their counts. The rows are
+        read in chunks, e.g. from a memory-mapped count table.
 
     Returns
     -------
     npt.ArrayLike
         Array of scores for each sample
     """
-    
+
+    if sparse.issparse(data) or chunk_size is not None or rows is not None:
+        insert_counts = np.asarray(insert_counts)
+        chunk_size = chunk_size or insertsizes.DENSE_CHUNK_SIZE
+
+        scores = []
+        for start, chunk in _iter_row_chunks(data, chunk_size, rows=rows):
+            # plot and save wavelet and mask only once
+            first = start == 0
+            scores.append(score_by_conv(chunk,
+                                        insert_counts[start:start + chunk_size],
+                                        wavelength=wavelength,
+                                        sigma=sigma,
+                                        plot_wavl=plot_wavl and first,
+                                        save_wavl=save_wavl if first else None,
+                                        save_mask=save_mask if first else None,
+                                        n_threads=n_threads,
+                                        plot_mask=plot_mask and first,
+                                        plot_ov=False))
+        scores = np.concatenate(scores)
+
+        if plot_ov:
+            sample_data = _dense_rows(data, [sample if rows is None else rows[sample]])
+            convolved_data = custom_conv(sample_data, wavelength=wavelength, sigma=sigma, plot_wavl=False)
+            peaks = call_peaks(convolved_data, n_threads=1)
+            plot_custom_conv(convolved_data, sample_data, peaks=peaks, scores=scores, sample_n=0, save_overview=save_overview)
+
+        return scores
+
     convolved_data = custom_conv(data, wavelength=wavelength, sigma=sigma, plot_wavl=plot_wavl, save_wavl=save_wavl)
 
     peaks = call_peaks(convolved_data, n_threads=n_threads)
@@ -774,13 +1044,14 @@ def score_by_conv(data: npt.ArrayLike,
 # //////////////////////////////// plotting \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
 
 @beartype
-def density_plot(dists_array: npt.ArrayLike,
+def density_plot(dists_array: npt.ArrayLike | sparse.spmatrix,
                  max_abundance: int | np.int64 = 600,
                  target_height: int = 1000,
                  save_density: Optional[str] = None,
                  colormap: str = 'jet',
                  ax: Optional[matplotlib.axes.Axes] = None,
-                 fig: Optional[matplotlib.figure.Figure] = None) -> npt.ArrayLike:
+                 fig: Optional[matplotlib.figure.Figure] = None,
+                 rows: Optional[np.ndarray] = None) -> npt.ArrayLike:
     """
     Plot the density of the fragment length distribution over all cells.
 
@@ -788,8 +1059,8 @@ def density_plot(dists_array: npt.ArrayLike,
 
     Parameters
     ----------
-    dists_array : npt.ArrayLike
-        Array of arrays of the fragment length distributions
+    dists_array : npt.ArrayLike | sparse.spmatrix
+        Array of arrays of the fragment length distributions. Sparse input is densified in chunks.
     max_abundance : int, default 100
         Maximal abundance of a fragment length of a cell (for better visability).
     target_height : int, default 1000
@@ -802,28 +1073,47 @@ def density_plot(dists_array: npt.ArrayLike,
         Axes to plot on.
     fig : matplotlib.figure.Figure, default None
         Figure to plot on.
+    rows : Optional[np.ndarray], default None
+        Indices of the rows of dists_array to plot. The rows are read block by block.
 
     Returns
     -------
     npt.ArrayLike
         Axes and figure of the plot.
+
+    Raises
+    ------
+    ValueError
+        If all counts are zero.
     """
- 
+
+    if not sparse.issparse(dists_array):
+        dists_array = np.asarray(dists_array)
+
     # handle 0,1 min/max scaled count_table
+    to_int = None
     if dists_array.dtype != 'float64':
-        if np.max(dists_array) > 1:
-            rounded = (np.round(dists_array)).astype('float64')
-            dists_array = rounded
+        if rows is None:
+            max_value = dists_array.max()
         else:
-            dists_array = (dists_array * 1000).astype('float64')
-   
-    
-    densities = np.zeros((max_abundance, dists_array.shape[1]), dtype='float64')
+            max_value = max((chunk.max() for _, chunk in _iter_row_chunks(dists_array, rows=rows) if chunk.size), default=0)
+        to_int = 'round' if max_value > 1 else 'scale'
+
+    n_cols = dists_array.shape[1]
+    densities = np.zeros((max_abundance, n_cols), dtype='float64')
+
+    # count the abundances of all columns at once, block by block
+    for _, chunk in _iter_row_chunks(dists_array, rows=rows):
+        if to_int == 'round':
+            chunk = np.round(chunk).astype('float64')
+        elif to_int == 'scale':
+            chunk = (chunk * 1000).astype('float64')
+        chunk = chunk.astype('int64')
+
+        keep = chunk < max_abundance
+        flat = chunk[keep] * n_cols + np.nonzero(keep)[1]
+        densities += np.bincount(flat, minlength=max_abundance * n_cols).reshape(max_abundance, n_cols)
 
-    for i in range(dists_array.shape[1]):
-        densities[:,i] = np.bincount(dists_array[:,i].astype('int64'), 
-                                   minlength=max_abundance)[:max_abundance]
-                             
     denominator = np.sum(densities, axis=0)
     if np.sum(denominator) == 0:
       raise ValueError("Empty density matrix - all counts are zero. Choose higher percentile.")  
@@ -956,7 +1246,7 @@ def plot_wavelet_transformation(convolution: npt.ArrayLike,
 @beartype
 def plot_custom_conv(convolved_data: npt.ArrayLike,
                      data: npt.ArrayLike,
-                     peaks: npt.ArrayLike,
+                     peaks: npt.ArrayLike | PeakList,
                      scores: npt.ArrayLike,
                      sample_n: int = 0,
                      save_overview: Optional[str] = None) -> npt.ArrayLike:
@@ -1027,34 +1317,40 @@ def plot_custom_conv(convolved_data: npt.ArrayLike,
 # ///////////////////////////////////////// sampling for bulk data \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
 
 
-def multinomial_sampler(args: Tuple[np.ndarray, np.ndarray, int, int]) -> np.ndarray:
-    dists_arr, subsample_mask, target_size, seed = args
-    
-    np.random.seed(seed + mp.current_process().pid)
+def multinomial_sampler(args: Tuple[np.ndarray, np.ndarray, int, np.random.Generator]) -> Tuple[np.ndarray, np.random.Generator]:
+    dists_arr, subsample_mask, target_size, rng = args
     
     subsampled_counts = np.zeros_like(dists_arr)
     
     for i in np.where(subsample_mask)[0]:
         probs = dists_arr[i] / dists_arr[i].sum()
-        subsampled_counts[i] = np.random.multinomial(target_size, probs)
+        subsampled_counts[i] = rng.multinomial(target_size, probs)
     
     subsampled_counts[~subsample_mask] = dists_arr[~subsample_mask]
     
-    return subsampled_counts
+    # the generator is returned to continue its stream on the next chunk of rows
+    return subsampled_counts, rng
     
 
 def parallel_multinomial_subsampling(
-    dists_arr: np.ndarray, 
+    dists_arr: np.ndarray | sparse.spmatrix, 
     insert_counts: Union[np.ndarray, pd.Series], 
     sample_size: int = 10000, 
     n_simulations: int = 100, 
     seed: int = 42, 
-    n_threads: int = 8
-) -> Tuple[np.ndarray, np.ndarray]:
+    n_threads: int = 8,
+    chunk_size: Optional[int] = None,
+    rngs: Optional[List[np.random.Generator]] = None,
+    rows: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray | sparse.csr_matrix, np.ndarray | sparse.csr_matrix]:
 
     """
     Performs parallel multinomial subsampling over multiple simulations.
 
+    Every simulation draws from its own generator spawned from np.random.SeedSequence(seed). The
+    rows are sampled in order and the generators continue from one chunk to the next, so the
+    result for a seed does not depend on chunk_size or on whether the input is sparse.
+
     Args:
         dists_arr (np.ndarray): 
             A 2D array where each row represents a probability distribution.
@@ -1068,20 +1364,52 @@ def parallel_multinomial_subsampling(
             Random seed for reproducibility. Defaults to 42.
         n_threads (int, optional): 
             The number of parallel processes to use. Defaults to 8.
+        chunk_size (int, optional):
+            Number of rows subsampled at once. Sparse input is always processed in chunks
+            (default insertsizes.DENSE_CHUNK_SIZE) and returned as sparse matrices.
+        rngs (List[np.random.Generator], optional):
+            One generator per simulation, used instead of seed. They are advanced in place.
+        rows (np.ndarray, optional):
+            Indices of the rows of dists_arr to subsample, insert_counts holds their counts. The
+            rows are read in chunks, e.g. from a memory-mapped count table.
 
     Returns:
         Tuple[np.ndarray, np.ndarray]: 
             - mean_counts (np.ndarray): The mean of the sampled distributions across simulations.
             - std_counts (np.ndarray): The standard deviation of the sampled distributions across simulations.
     """
+
+    if rngs is None:
+        rngs = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(n_simulations)]
+
+    if sparse.issparse(dists_arr) or chunk_size is not None or rows is not None:
+        insert_counts = np.asarray(insert_counts)
+        chunk_size = chunk_size or insertsizes.DENSE_CHUNK_SIZE
+
+        means, stds = [], []
+        for start, chunk in _iter_row_chunks(dists_arr, chunk_size, rows=rows):
+            mean_chunk, std_chunk = parallel_multinomial_subsampling(
+                chunk, insert_counts[start:start + chunk_size], sample_size=sample_size,
+                n_simulations=n_simulations, n_threads=n_threads, rngs=rngs
+            )
+            means.append(mean_chunk)
+            stds.append(std_chunk)
+
+        if sparse.issparse(dists_arr):
+            return (sparse.vstack([sparse.csr_matrix(m) for m in means], format='csr'),
+                    sparse.vstack([sparse.csr_matrix(s) for s in stds], format='csr'))
+
+        return np.vstack(means), np.vstack(stds)
     
     subsample_mask = insert_counts > sample_size
-    args = [(dists_arr, subsample_mask, sample_size, seed + i) for i in range(n_simulations)]
+    args = [(dists_arr, subsample_mask, sample_size, rng) for rng in rngs]
     
     with Pool(processes=n_threads) as pool:
         results = pool.map(multinomial_sampler, args)
 
-    subsampled_dists_arr = np.stack(results)
+    # workers advance copies of the generators, take over their states for the next chunk
+    rngs[:] = [rng for _, rng in results]
+    subsampled_dists_arr = np.stack([counts for counts, _ in results])
     
     # Round mean to int
     mean_counts = np.round(np.mean(subsampled_dists_arr, axis=0)).astype('int64')
@@ -1089,6 +1417,111 @@ def parallel_multinomial_subsampling(
     
     return mean_counts, std_counts
 
+
+def _iter_row_chunks(data: npt.ArrayLike | sparse.spmatrix,
+                     chunk_size: int = insertsizes.DENSE_CHUNK_SIZE,
+                     rows: Optional[np.ndarray] = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Yield (first row index, dense block) pairs over the rows of a 2D array.
+
+    Parameters
+    ----------
+    data : npt.ArrayLike | sparse.spmatrix
+        2D array. Sparse input is densified one block at a time.
+    chunk_size : int, default insertsizes.DENSE_CHUNK_SIZE
+        Number of rows per block.
+    rows : Optional[np.ndarray], default None
+        Indices of the rows to iterate over. Only the rows of one block are read at a time,
+        so a memory-mapped array is never copied as a whole. Defaults to all rows.
+
+    Yields
+    ------
+    Tuple[int, np.ndarray]
+        Index of the first row (within rows) and the dense block.
+    """
+
+    n_rows = data.shape[0] if rows is None else len(rows)
+    for start in range(0, n_rows, chunk_size):
+        chunk = data[start:start + chunk_size] if rows is None else data[rows[start:start + chunk_size]]
+        yield start, chunk.toarray() if sparse.issparse(chunk) else np.asarray(chunk)
+
+
+def _dense_rows(data: npt.ArrayLike | sparse.spmatrix, rows: npt.ArrayLike) -> np.ndarray:
+    """Return the selected rows of a dense or sparse 2D array as dense array."""
+
+    selected = data[np.asarray(rows)]
+
+    return selected.toarray() if sparse.issparse(selected) else np.asarray(selected)
+
+
+def _percentile(data: npt.ArrayLike | sparse.spmatrix, q: int | float, rows: Optional[np.ndarray] = None) -> float:
+    """
+    Compute a percentile over all values of a dense or sparse 2D array.
+
+    For sparse input the implicit zeros are accounted for without densifying.
+    Values are expected to be non-negative (counts).
+
+    Parameters
+    ----------
+    data : npt.ArrayLike | sparse.spmatrix
+        2D array of values.
+    q : int | float
+        Percentile to compute, within [0, 100].
+    rows : Optional[np.ndarray], default None
+        Indices of the rows to include. Integer counts of the rows are tallied block by block.
+
+    Returns
+    -------
+    float
+        The q-th percentile of all values.
+
+    Raises
+    ------
+    ValueError
+        If q is not within [0, 100].
+    """
+
+    if rows is not None:
+        if sparse.issparse(data):
+            return _percentile(data[rows], q)
+        if data.dtype.kind not in 'iu':
+            return np.percentile(_dense_rows(data, rows), q)
+        if not 0 <= q <= 100:
+            raise ValueError("Percentiles must be in the range [0, 100]")
+
+        # tally the counts, the sorted values are then given by the cumulative tallies
+        tally = np.zeros(1, dtype=np.int64)
+        for _, chunk in _iter_row_chunks(data, rows=rows):
+            chunk_tally = np.bincount(chunk.ravel())
+            if len(chunk_tally) > len(tally):
+                tally = np.pad(tally, (0, len(chunk_tally) - len(tally)))
+            tally[:len(chunk_tally)] += chunk_tally
+        ends = np.cumsum(tally)
+
+        pos = q / 100 * (ends[-1] - 1)
+        lower, upper = int(np.floor(pos)), int(np.ceil(pos))
+        value_lower, value_upper = np.searchsorted(ends, [lower, upper], side='right')
+
+        return value_lower + (value_upper - value_lower) * (pos - lower)
+
+    if not sparse.issparse(data):
+        return np.percentile(data, q)
+    if not 0 <= q <= 100:
+        raise ValueError("Percentiles must be in the range [0, 100]")
+
+    values = np.sort(data.data)
+    n_total = data.shape[0] * data.shape[1]
+    n_zero = n_total - len(values)
+
+    # linear interpolation as in np.percentile
+    pos = q / 100 * (n_total - 1)
+    lower, upper = int(np.floor(pos)), int(np.ceil(pos))
+
+    def value_at(i):
+        return 0 if i < n_zero else values[i - n_zero]
+
+    return value_at(lower) + (value_at(upper) - value_at(lower)) * (pos - lower)
+
 # ///////////////////////////////////////// final wrapper \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
 
 @beartype
@@ -1113,14 +1546,16 @@ def add_fld_metrics(
     n_threads: int = 8,
     subset_plot_path: Optional[Union[str, Path]] = None,
     subset_quantiles: Optional[List[Union[int, float]]] = None,
-    return_distributions: bool = False
-) -> Union[Tuple[pd.DataFrame, npt.NDArray, ad.AnnData], ad.AnnData]:
+    return_distributions: bool = False,
+    chunk_size: int = insertsizes.DENSE_CHUNK_SIZE
+) -> Union[Tuple[pd.DataFrame, npt.NDArray | sparse.spmatrix, ad.AnnData], ad.AnnData]:
 
     """
     Add insert size metrics to an AnnData object.
 
     This function processes a fragment length distribution (FLD) count table (output of peakqc.insertsize function)
     and adds the FLD scores, mean insertsize, and count of fragments per barcode to an AnnData object.
+    Barcodes of the count table that are not in the AnnData object are dropped before scoring.
     It can also generate density plots for the whole sample or subsets (by quantiles).
     
     Nucleosomal signal can either calculated using the momentum method (differential quotient) or
@@ -1135,7 +1570,8 @@ def add_fld_metrics(
     adata : sc.AnnData
         Path to AnnData object to add the insertsize metrics and fld_scoring to.
     insertsize_table: Path to read in the count table.
-                     This is the output file of the peakqc.insertsize_from_fragments function.
+                     This is the output file of the peakqc.insertsize_from_fragments function
+                     in any of the formats supported by peakqc.insertsizes.read_count_table.
     barcode_col : str, default None
         Name of the column in the adata.obs dataframe that contains the barcodes.
         Otherwise it is assumed that the index contains the barcodes.
@@ -1172,6 +1608,8 @@ def add_fld_metrics(
         If None, the default [0, 25, 50, 75, 100] is used.
     return_distributions : bool, default False
         If true, the fragment length distributions are returned.
+    chunk_size : int, default insertsizes.DENSE_CHUNK_SIZE
+        Number of barcodes densified at once if the count table holds sparse distributions.
 
     Returns
     -------
@@ -1193,26 +1631,40 @@ def add_fld_metrics(
     
     
     if insertsize_table:
-      count_table = pd.read_csv(insertsize_table, sep = "\t", index_col=0)
-            
-      dists_arr = np.array(
-            [list(map(int, dist.split(','))) for dist in count_table['dist']],
-             dtype=np.int64
-      )
+      # TSV, Parquet or memory-mapped npy store (see insertsizes.write_count_table)
+      count_table, dists_arr = insertsizes.read_count_table(insertsize_table)
     else:
-      raiseValueError("Provide path to insertsize count table.")
+      raise ValueError("Provide path to insertsize count table.")
+
+    # background barcodes that are not part of the AnnData object are not scored
+    # dense (memory-mapped) distributions are not copied, the kept rows are read chunk-wise instead
+    rows = None
+    keep = count_table.index.isin(adata_barcodes)
+    if not keep.all():
+        count_table = count_table[keep]
+        if sparse.issparse(dists_arr):
+            dists_arr = dists_arr[np.flatnonzero(keep)]
+        else:
+            rows = np.flatnonzero(keep)
                
 
     means = count_table['mean_insertsize'].copy()
     insert_counts = count_table['insertsize_count'].copy()
       
+    # sparse distributions are only densified in chunks of chunk_size barcodes
+    sparse_chunks = chunk_size if sparse.issparse(dists_arr) else None
+
     # Monte Carlo Sampling (Optional)
     if sample_size is not None:
         dists_arr_subsampled, _ = parallel_multinomial_subsampling(
-            dists_arr, insert_counts, sample_size=sample_size, n_simulations=mc_samples, seed=mc_seed, n_threads=n_threads
+            dists_arr, insert_counts, sample_size=sample_size, n_simulations=mc_samples, seed=mc_seed, n_threads=n_threads,
+            chunk_size=sparse_chunks, rows=rows
         )
+        # the subsampled distributions only hold the kept rows
+        subsampled_rows = None
     else:
         dists_arr_subsampled = dists_arr
+        subsampled_rows = rows
          
   
     barcodes = count_table.index.copy()
@@ -1221,8 +1673,8 @@ def add_fld_metrics(
 
 
     if plot:
-        max_abundance = np.percentile(dists_arr_subsampled, max_abundance).astype('int')
-        density_plot(dists_arr_subsampled, max_abundance=max_abundance, save_density=save_density)
+        max_abundance = int(_percentile(dists_arr_subsampled, max_abundance, rows=subsampled_rows))
+        density_plot(dists_arr_subsampled, max_abundance=max_abundance, save_density=save_density, rows=subsampled_rows)
     
     # calculate scores using the convolution method  
     conv_scores = score_by_conv(data=dists_arr_subsampled,
@@ -1236,7 +1688,9 @@ def add_fld_metrics(
                                 plot_mask=plot,
                                 plot_ov=plot,
                                 save_overview=save_overview,
-                                sample=sample)
+                                sample=sample,
+                                chunk_size=sparse_chunks,
+                                rows=subsampled_rows)
 
     inserts_df = pd.DataFrame({
                       'fld_score': conv_scores,
@@ -1259,13 +1713,12 @@ def add_fld_metrics(
       for q in range(1, len(subset_quantiles)):
           subset_barcodes = inserts_df[inserts_df['quantile'] == q].index  
           subset_indices = [barcodes.get_loc(b) for b in subset_barcodes if b in barcodes]
-          subset_arrays = [dists_arr_subsampled[i] for i in subset_indices]
   
-          if subset_arrays:
-              subset_dict[q] = np.vstack(subset_arrays)
-              max_abundance = np.percentile(subset_dict[q], 100).astype('int')
-              density_plot(subset_dict[q], max_abundance=max_abundance, save_density=f"{subset_plot_path}_quantile_{q}.png")
-          del subset_arrays
+          if subset_indices:
+              subset_dict[q] = np.asarray(subset_indices) if subsampled_rows is None else subsampled_rows[subset_indices]
+              max_abundance = int(_percentile(dists_arr_subsampled, 100, rows=subset_dict[q]))
+              density_plot(dists_arr_subsampled, max_abundance=max_abundance, save_density=f"{subset_plot_path}_quantile_{q}.png",
+                           rows=subset_dict[q])
   
       # Multi-plot setup
       num_plots = len(subset_dict)
@@ -1281,9 +1734,9 @@ def add_fld_metrics(
   
       axes = axes.flatten()
   
-      for i, (q, data) in enumerate(subset_dict.items()):
-          max_abundance = np.percentile(data, 100).astype('int')
-          density_plot(data, max_abundance=max_abundance, ax=axes[i], fig=fig)
+      for i, (q, subset_rows) in enumerate(subset_dict.items()):
+          max_abundance = int(_percentile(dists_arr_subsampled, 100, rows=subset_rows))
+          density_plot(dists_arr_subsampled, max_abundance=max_abundance, ax=axes[i], fig=fig, rows=subset_rows)
           axes[i].set_title(f"Quantile {q}")
   
 
@@ -1295,7 +1748,7 @@ def add_fld_metrics(
       plt.savefig(f"{subset_plot_path}_multi_density.png", dpi=600)
       plt.close()
 
-    adata.obs = adata.obs.join(inserts_df)
+    adata.obs = adata.obs.join(inserts_df, on=barcode_col)
 
     adata.obs['fld_score'] = adata.obs['fld_score'].fillna(0)
     adata.obs['mean_fragment_size'] = adata.obs['mean_fragment_size'].fillna(0)
@@ -1303,6 +1756,6 @@ def add_fld_metrics(
 
 
     if return_distributions:
-        return inserts_df, dists_arr, adata
+        return inserts_df, dists_arr if rows is None else dists_arr[rows], adata
     
     return adata
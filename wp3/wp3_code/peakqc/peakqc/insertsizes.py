@@ -1,9 +1,89 @@
 import duckdb
+import glob
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+import gzip
+import hashlib
+import io
+import multiprocessing as mp
+import json
+import logging
+import os
+import re
+import shutil
 import pandas as pd
 import numpy as np
-from typing import List, Optional, Union
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple, Union
 from beartype import beartype
+from beartype.typing import Literal
 from pathlib import Path
+import pysam
+import anndata as ad
+from scipy import sparse
+from peakqc.general import _is_gz_file, check_module, open_bam
+
+logger = logging.getLogger(__name__)
+
+# Marker written into meta.json of binary count-table stores
+COUNT_TABLE_FORMAT = "peakqc-count-table"
+COUNT_TABLE_VERSION = 1
+
+# Number of lines fetched from a tabix index before they are handed to DuckDB
+TABIX_CHUNK_SIZE = 1000000
+
+# Column types of fragment files (chrom, start, end, barcode, count) if they are not sniffed
+FRAGMENT_SCHEMA = ('VARCHAR', 'INTEGER', 'INTEGER', 'VARCHAR', 'INTEGER')
+
+# Sizes are stored as SMALLINT in the fragments table of insert_bed_to_duckdb, longer ones are clipped
+MAX_STORED_SIZE = 32767
+
+# Default size budget (bytes) of the histogram cache of insertsize_from_fragments
+CACHE_SIZE_LIMIT = 10 * 1024 ** 3
+
+# Chromosome names treated as mitochondrial by qc_from_fragments
+MITO_CHROMS = ('chrM', 'chrMT', 'M', 'MT')
+
+# Number of rows densified at once when sparse distributions are converted
+DENSE_CHUNK_SIZE = 10000
+
+# Bytes of a fragment file parsed at once by a worker of the numpy backend
+NUMPY_CHUNK_SIZE = 64 * 1024 ** 2
+
+# Rows per row group of Parquet fragment stores
+PARQUET_ROW_GROUP_SIZE = 1000000
+
+# Marker written into meta.json of cut-site pileups
+PILEUP_FORMAT = "peakqc-pileup"
+PILEUP_VERSION = 2
+
+
+@dataclass
+class DuckDBConfig:
+    """
+    Resource and profiling settings for the DuckDB connections of the insert size functions.
+
+    Attributes:
+        memory_limit: Memory limit for DuckDB, e.g. '8GB'.
+        threads: Number of DuckDB threads. None keeps DuckDB's default (all cores).
+        temp_directory: Directory used to spill intermediates of out-of-core aggregations.
+        preserve_insertion_order: Keep the input order of rows. Disabling it lowers the memory
+            footprint of large inserts and aggregations; results that need an order sort explicitly.
+        explicit_schema: Read fragment files with the fixed schema chrom, start, end, barcode, count
+            instead of sniffing them with read_csv_auto. Lines starting with '#' and additional
+            columns are ignored.
+        profile_path: If set, the DuckDB profile (operator tree, timings, cardinalities, memory) of
+            every query is collected and written to this JSON file.
+    """
+
+    memory_limit: str = '8GB'
+    threads: Optional[int] = None
+    temp_directory: Optional[str | Path] = None
+    preserve_insertion_order: bool = False
+    explicit_schema: bool = True
+    profile_path: Optional[str | Path] = None
 
 
 @beartype
@@ -11,219 +91,391 @@ def insertsize_from_fragments(
     fragments: str | Path,
     min_size: int = 0,
     max_size: int = 1000,
+    regions: Optional[str | List[str]] = None,
+    barcodes: Optional[List[str] | str | Path | ad.AnnData] = None,
+    barcode_col: Optional[str] = None,
     memory_limit: str = '8GB',
-    count_table_path: Optional[str | Path] = None
-) -> pd.DataFrame:
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv',
+    output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe',
+    cache_dir: Optional[str | Path] = None,
+    cache_size_limit: int = CACHE_SIZE_LIMIT,
+    backend: Literal['duckdb', 'numpy'] = 'duckdb',
+    chunk_size: int = NUMPY_CHUNK_SIZE,
+    sample_size: Optional[int] = None,
+    seed: int = 42
+) -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
     """
     Process fragment file and calculate size distributions per barcode.
+
+    Plain, gzip and bgzip compressed fragment files are supported. For bgzip files with a
+    tabix index, regions are fetched through the index instead of decompressing the whole file.
+
+    With cache_dir, the histograms are stored as npy count-table store keyed by the fragment file
+    (path, size, mtime) and all parameters that change the result. Repeated calls load the store
+    instead of scanning the file again. Modifying the fragment file invalidates its entries.
+
+    The 'numpy' backend does not use DuckDB. Plain files are split into byte ranges aligned to line
+    ends, compressed files are decompressed in the main process and handed out in blocks. Worker
+    processes parse the blocks with pandas and count the sizes with np.bincount. Both backends
+    return identical results, see benchmark_backends.
+
+    With sample_size, the distribution of every barcode is built from a uniform sample of at most
+    sample_size of its fragments, drawn during the scan (see add_fld_metrics, which downsamples to
+    the same size). The sample is reproducible for a given seed. insertsize_count and
+    mean_insertsize are always computed from all fragments. The numpy backend draws the sample from
+    the aggregated histograms, so its draws differ from those of the DuckDB backend.
     
     Args:
-        fragments: Path to input fragment file
+        fragments: Path to input fragment file (.bed, .bed.gz or bgzip) or Parquet fragment store
         min_size: Minimum size threshold
         max_size: Maximum size threshold
+        regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'
+        barcodes: Optional barcode whitelist as list, path to a file with one barcode per line or
+            AnnData object. Other barcodes are dropped during the scan, before aggregation.
+        barcode_col: Column of adata.obs holding the barcodes if barcodes is an AnnData object.
+            Defaults to the obs index.
         memory_limit: Memory limit for DuckDB
-        count_table_path: Optional path to save the count table as TSV
+        n_threads: Number of DuckDB threads or worker processes of the numpy backend. Defaults to all cores.
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+        count_table_path: Optional path to save the count table
+        count_table_format: Format of the saved count table. See write_count_table.
+        output: 'dataframe' returns the count table with a dense dist column. 'sparse' returns the
+            barcode statistics and a CSR matrix (barcodes x sizes) without building dense arrays.
+            'numpy' returns the barcode statistics and a C-contiguous int32 array (barcodes x sizes).
+        cache_dir: Optional directory of the histogram cache.
+        cache_size_limit: Size of the cache directory in bytes. Least recently used entries are
+            removed when it is exceeded.
+        backend: Engine computing the histograms, 'duckdb' or 'numpy'.
+        chunk_size: Number of bytes parsed at once by a worker of the numpy backend.
+        sample_size: Optional maximum number of fragments per barcode in the distributions.
+        seed: Seed of the fragment sample.
 
     Returns:
-        count_table: DataFrame with barcode statistics and distributions
+        count_table: DataFrame with barcode statistics and distributions, or a tuple of the
+            statistics and the sparse or dense distributions if output is 'sparse' or 'numpy'
+
+    Raises:
+        ValueError: If a fragment store is passed to the numpy backend or partials are requested
+            for sampled distributions.
     """
-    con = duckdb.connect()
-    con.execute(f"SET memory_limit='{memory_limit}'")
-    
-    count_table = con.execute("""
-        WITH fragment_sizes AS (
-            SELECT 
-                column3 AS barcode,
-                (CAST(column2 AS INTEGER) - CAST(column1 AS INTEGER) - 9) AS size,
-                CAST(column4 AS INTEGER) as count
-            FROM read_csv_auto(?, delim='\t', header=False)
-            WHERE (CAST(column2 AS INTEGER) - CAST(column1 AS INTEGER) - 9) BETWEEN ? AND ?
-        ),
-        barcode_stats AS (
-            SELECT 
-                barcode,
-                SUM(count) as insertsize_count,
-                AVG(size) as mean_insertsize
-            FROM fragment_sizes
-            GROUP BY barcode
-        ),
-        all_combinations AS (
-            SELECT 
-                b.barcode,
-                s.size
-            FROM (SELECT DISTINCT barcode FROM fragment_sizes) b
-            CROSS JOIN generate_series(?, ?) s(size)
-        ),
-        size_counts AS (
-            SELECT 
-                barcode,
-                size,
-                COUNT(*) as fragment_count
-            FROM fragment_sizes
-            GROUP BY barcode, size
-        ),
-        size_arrays AS (
-            SELECT 
-                ac.barcode,
-                ARRAY_AGG(COALESCE(sc.fragment_count, 0) ORDER BY ac.size) AS dist
-            FROM all_combinations ac
-            LEFT JOIN size_counts sc 
-                ON ac.barcode = sc.barcode 
-                AND ac.size = sc.size
-            GROUP BY ac.barcode
-        )
-        SELECT 
-            bs.*,
-            sa.dist
-        FROM barcode_stats bs
-        JOIN size_arrays sa ON bs.barcode = sa.barcode
-    """, [fragments, min_size, max_size, min_size, max_size]).df()
-    
-    count_table.set_index('barcode', inplace=True)
+    if sample_size is not None and count_table_format == 'partial':
+        raise ValueError("Partials need full distributions. Sample after merge_partials instead.")
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    barcodes = _resolve_barcodes(barcodes, barcode_col=barcode_col)
+
+    cached = None
+    if cache_dir is not None:
+        key = _cache_key(fragments, min_size=min_size, max_size=max_size, regions=_parse_regions(regions),
+                         barcodes=barcodes, explicit_schema=config.explicit_schema,
+                         sample_size=sample_size, seed=seed,
+                         # full histograms are identical across backends, samples are not
+                         **({'backend': backend} if sample_size is not None else {}))
+        cached = _cache_load(cache_dir, key)
+
+    if cached is not None:
+        stats, dists = cached
+    elif backend == 'numpy':
+        if _is_fragment_store(fragments):
+            raise ValueError("The numpy backend reads fragment files only, use backend='duckdb' for fragment stores.")
+        stats, dists = _numpy_count_table(str(fragments), min_size=min_size, max_size=max_size,
+                                          regions=_parse_regions(regions), barcodes=barcodes,
+                                          n_workers=config.threads or mp.cpu_count(), chunk_size=chunk_size)
+        if sample_size is not None:
+            dists = _sample_histograms(dists, sample_size, seed=seed)
+    else:
+        con = _connect(config)
+        whitelist = _register_barcodes(con, barcodes)
+        _register_fragments(con, fragments, regions=regions, barcodes=whitelist,
+                            explicit_schema=config.explicit_schema)
+        stats, dists = _sparse_count_table(con, 'fragment_src', '"end" - start - 9', min_size, max_size,
+                                           sample_size=sample_size, sample_key='chrom, start, "end"', seed=seed)
+        con.close()
 
+    if cached is None and cache_dir is not None:
+        _cache_store(cache_dir, key, stats, dists, min_size=min_size, size_limit=cache_size_limit)
 
     if count_table_path is not None:
-        output_df = count_table.copy()
-        output_df['dist'] = output_df['dist'].apply(lambda x: ','.join(map(str, x)))
-        output_df.to_csv(count_table_path, sep='\t', index = True)
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
 
-    con.close()
-    
-    return count_table
+    return _format_output(stats, dists, output)
+
+
+@beartype
+def benchmark_backends(
+    fragments: str | Path,
+    backends: Tuple[Literal['duckdb', 'numpy'], ...] | List[Literal['duckdb', 'numpy']] = ('duckdb', 'numpy'),
+    n_runs: int = 3,
+    **kwargs
+) -> pd.DataFrame:
+    """
+    Time the backends of insertsize_from_fragments on the same fragment file.
+
+    Every run scans the file again; the cache is not used. The histograms of every backend are
+    compared with those of the first one.
+
+    Args:
+        fragments: Path to input fragment file (.bed, .bed.gz or bgzip)
+        backends: Backends to compare.
+        n_runs: Number of runs per backend.
+        **kwargs: Further arguments of insertsize_from_fragments, e.g. n_threads or barcodes.
+
+    Returns:
+        DataFrame with one row per run: backend, run, seconds, fragments per second, MB per second
+        and whether the result equals the one of the first backend.
+    """
+    kwargs = {key: value for key, value in kwargs.items() if key not in ('cache_dir', 'output', 'count_table_path')}
+    file_mb = _path_stat(fragments).st_size / 1024 ** 2
+
+    runs = []
+    reference = None
+    for backend in backends:
+        for run in range(n_runs):
+            start_time = time.perf_counter()
+            stats, dists = insertsize_from_fragments(fragments, backend=backend, output='sparse', **kwargs)
+            seconds = time.perf_counter() - start_time
+
+            if reference is None:
+                reference = (stats, dists)
+            identical = (list(stats.index) == list(reference[0].index)
+                         and (stats['insertsize_count'].to_numpy() == reference[0]['insertsize_count'].to_numpy()).all()
+                         and np.allclose(stats['mean_insertsize'], reference[0]['mean_insertsize'])
+                         and (dists != reference[1]).nnz == 0)
+
+            runs.append({'backend': backend, 'run': run, 'seconds': seconds,
+                         'fragments_per_s': dists.sum() / seconds, 'mb_per_s': file_mb / seconds,
+                         'identical': bool(identical)})
+
+    return pd.DataFrame(runs)
     
 
 @beartype
 def insert_bed_to_duckdb(
-  fragment_files: List[str],
-  db_path: str,
-  summarize: bool = False,
-  memory_limit: str = '8GB',
-  count_table_path: Optional[str | Path] = None) -> pd.DataFrame:
+    fragment_files: str | List[str],
+    db_path: str,
+    summarize: bool = False,
+    min_size: int = 0,
+    max_size: int = 1000,
+    regions: Optional[str | List[str]] = None,
+    memory_limit: str = '8GB',
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv'
+) -> pd.DataFrame:
     """
     Insert data from a fragment .bed file into the DuckDB database and optionally summarize the data. summarize = True will count the number of fragments, calculate the mean fragment length, and creates a fragment length distribution array for the respective barcode. The summarized data is stored inside the count_table table and the whole data is stored in the fragments table.
+
+    Ingestion is incremental: every file is recorded in the manifest table with its size, mtime and
+    sha256. Files that did not change since the last run are skipped, changed files have their rows
+    replaced. Each file is read only once; the summary is computed from the freshly inserted rows.
+    All new or changed files are read in one multi-file scan per compression type, so DuckDB can
+    parallelize over files. Throughput (rows/s, MB/s) is logged at INFO level on the
+    'peakqc.insertsizes' logger.
     
     Args:
-        fragment_files (List[str]): List of paths to the .bed files.
+        fragment_files (str | List[str]): List of paths to the .bed files or a glob pattern. Files may be gzip or bgzip compressed.
         db_path (str): Path to the DuckDB database where data will be stored.
         summarize (bool): Whether to summarize the data while inserting it. Default is False.
+        min_size: Minimum size threshold for the summarized distributions.
+        max_size: Maximum size threshold for the summarized distributions.
+        regions: Optional region(s) to restrict the inserted fragments to, e.g. 'chr1' or 'chr1:1-100000'.
+            Uses the tabix index of bgzip compressed files if available.
         memory_limit: Memory limit for DuckDB.
-        count_table_path: Optional path to save the count table as TSV.
+        n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+        count_table_path: Optional path to save the count table.
+        count_table_format: Format of the saved count table. See write_count_table.
     Returns:
-        count_table: DataFrame with barcode statistics and distributions
+        count_table: DataFrame with barcode statistics and distributions of all files summarized
+            with min_size and max_size, one row per barcode. Files summarized with another size
+            range are left out with a warning.
+
+    Raises:
+        ValueError: If the database was created without the manifest (older peakqc version).
+        FileNotFoundError: If a glob pattern matches no files.
     """
-    con = duckdb.connect(db_path)
-    con.execute(f"SET memory_limit='{memory_limit}'")
-    
-    con.execute("""
-    CREATE TABLE IF NOT EXISTS fragments (
-        chrom STRING,
-        start INTEGER,
-        end INTEGER,
-        barcode STRING,
-        size INTEGER,
-        count INTEGER
-    );
-    """)
-    
-    if summarize:
-      con.execute("""
-      CREATE TABLE IF NOT EXISTS count_table (
-          barcode STRING,
-          insertsize_count INTEGER,
-          mean_insertsize DOUBLE,
-          dist ARRAY<INTEGER>
-      );
-      """)
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    con = _connect(config, db_path)
+    try:
+        _create_fragment_schema(con)
 
-    
-    for fragment_file in fragment_files:
-      con.execute("""
-      INSERT INTO fragments
-      SELECT
-          column1 AS chrom,
-          CAST(column2 AS INTEGER) AS start,
-          CAST(column3 AS INTEGER) AS end,
-          column4 AS barcode,
-          (CAST(column3 AS INTEGER) - CAST(column2 AS INTEGER)) AS size,
-          CAST(column5 AS INTEGER) AS count
-      FROM read_csv_auto(?, delim='\t', header=False);
-      """, [fragment_file])
-
-  
-      if summarize:
-          con.execute("""
-          INSERT INTO count_table
-          WITH fragment_sizes AS (
-              SELECT barcode, size, count
-              FROM fragments
-              WHERE size BETWEEN ? AND ?
-              AND barcode IN (SELECT DISTINCT barcode FROM read_csv_auto(?, delim='\t', header=False))
-          ),
-          barcode_stats AS (
-              SELECT barcode,
-                     SUM(count) AS insertsize_count,
-                     AVG(size) AS mean_insertsize
-              FROM fragment_sizes
-              GROUP BY barcode
-          ),
-          size_counts AS (
-              SELECT 
-                  barcode,
-                  size,
-                  COUNT(*) AS size_count
-              FROM fragment_sizes
-              GROUP BY barcode, size
-          ),
-          size_arrays AS (
-              SELECT 
-                  sc.barcode,
-                  ARRAY_AGG(COALESCE(sc.size_count, 0) ORDER BY sc.size) AS dist
-              FROM size_counts sc
-              GROUP BY sc.barcode
-          )
-          SELECT 
-              bs.*, 
-              sa.dist
-          FROM barcode_stats bs
-          JOIN size_arrays sa ON bs.barcode = sa.barcode;
-          """, [min_size, max_size, fragment_file])
+        # files ingested with other settings are treated as changed
+        params = json.dumps({'regions': _parse_regions(regions), 'summarize': summarize,
+                             'min_size': min_size, 'max_size': max_size})
 
-    con.execute("""
-    CREATE INDEX IF NOT EXISTS idx_barcode ON fragments (barcode);
-    """)
-    
-    con.execute("""
-    CREATE INDEX IF NOT EXISTS idx_barcode ON count_table (barcode);
-    """)
+        if isinstance(fragment_files, str):
+            pattern = fragment_files
+            fragment_files = sorted(glob.glob(pattern))
+            if not fragment_files:
+                raise FileNotFoundError(f"No fragment files match '{pattern}'.")
 
-    count_table = con.execute("""
-    SELECT * FROM count_table;
-    """).df()
-    
+        pending = []
+        for fragment_file in fragment_files:
+            path = os.path.abspath(fragment_file)
+            stat = _path_stat(path)
+            known = con.execute("""
+            SELECT file_id, size, mtime, sha256, params FROM manifest WHERE path = ?
+            """, [path]).fetchone()
+
+            if known is not None and known[1:3] == (stat.st_size, stat.st_mtime) and known[4] == params:
+                continue
+
+            sha256 = _file_sha256(path)
+            if known is not None and known[3] == sha256 and known[4] == params:
+                # touched but identical, e.g. copied again
+                con.execute("UPDATE manifest SET size = ?, mtime = ? WHERE file_id = ?",
+                            [stat.st_size, stat.st_mtime, known[0]])
+                continue
+
+            pending.append((path, stat, sha256, known))
+
+        if pending:
+            started = time.perf_counter()
+            con.execute("BEGIN TRANSACTION")
+            try:
+                next_id = con.execute("SELECT COALESCE(MAX(file_id) + 1, 0) FROM manifest").fetchone()[0]
+                batch = []
+                for path, stat, sha256, known in pending:
+                    if known is not None:
+                        file_id = known[0]
+                        con.execute("DELETE FROM fragments WHERE file_id = ?", [file_id])
+                        con.execute("DELETE FROM count_table WHERE file_id = ?", [file_id])
+                        con.execute("DELETE FROM manifest WHERE file_id = ?", [file_id])
+                    else:
+                        file_id = next_id
+                        next_id += 1
+                    batch.append((file_id, path, stat, sha256))
+
+                batch_df = pd.DataFrame({'file_id': [b[0] for b in batch], 'path': [b[1] for b in batch]})
+                con.register('ingest_batch', batch_df)
+
+                con.execute("""
+                CREATE OR REPLACE TEMP TABLE ingest_staged (
+                    file_id INTEGER, chrom VARCHAR, start INTEGER, "end" INTEGER, barcode VARCHAR, count INTEGER
+                )
+                """)
+                for paths in _scan_groups([b[1] for b in batch], regions):
+                    _register_fragments(con, paths, regions=regions, explicit_schema=config.explicit_schema)
+                    con.execute("""
+                    INSERT INTO ingest_staged
+                    SELECT b.file_id, f.chrom, f.start, f."end", f.barcode, f.count
+                    FROM fragment_src f
+                    JOIN ingest_batch b ON f.filename = b.path;
+                    """)
+
+                # extend the barcode and chromosome dictionaries by the keys seen for the first time
+                for table, key, id_col in [('barcodes', 'barcode', 'barcode_id'), ('chroms', 'chrom', 'chrom_id')]:
+                    con.execute(f"""
+                    INSERT INTO {table}
+                    SELECT (SELECT COALESCE(MAX({id_col}) + 1, 0) FROM {table}) + ROW_NUMBER() OVER (ORDER BY new.{key}) - 1,
+                           new.{key}
+                    FROM (SELECT DISTINCT {key} FROM ingest_staged) new
+                    ANTI JOIN {table} USING ({key});
+                    """)
+
+                # sorted rows give tight zone maps for barcode and position filters
+                con.execute(f"""
+                INSERT INTO fragments
+                SELECT
+                    s.file_id,
+                    b.barcode_id,
+                    c.chrom_id,
+                    s.start,
+                    s."end",
+                    LEAST(s."end" - s.start - 9, {MAX_STORED_SIZE})::SMALLINT AS size,
+                    s.count
+                FROM ingest_staged s
+                JOIN barcodes b USING (barcode)
+                JOIN chroms c USING (chrom)
+                ORDER BY b.barcode_id, c.chrom_id, s.start;
+                """)
+                con.execute("DROP TABLE ingest_staged")
+
+                con.unregister('ingest_batch')
+
+                n_fragments = dict(con.execute("""
+                SELECT file_id, COUNT(*) FROM fragments
+                WHERE file_id IN (SELECT UNNEST(?))
+                GROUP BY file_id
+                """, [[b[0] for b in batch]]).fetchall())
+
+                for file_id, path, stat, sha256 in batch:
+                    if summarize:
+                        _insert_file_summary(con, file_id, min_size, max_size)
+                    con.execute("""
+                    INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, current_timestamp)
+                    """, [file_id, path, stat.st_size, stat.st_mtime, sha256, params, n_fragments.get(file_id, 0)])
+
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
 
-    count_table.set_index('barcode', inplace=True)
+            elapsed = time.perf_counter() - started
+            n_rows = sum(n_fragments.values())
+            n_mb = sum(b[2].st_size for b in batch) / 1e6
+            logger.info("Ingested %d file(s) with %d fragments (%.1f MB) in %.1f s: %.0f rows/s, %.1f MB/s",
+                        len(batch), n_rows, n_mb, elapsed, n_rows / elapsed, n_mb / elapsed)
+
+        con.execute("""
+        CREATE INDEX IF NOT EXISTS idx_barcode ON fragments (barcode_id);
+        """)
     
+        if summarize:
+            con.execute("""
+            CREATE INDEX IF NOT EXISTS idx_count_table_barcode ON count_table (barcode);
+            """)
+
+        # only summaries of the same size range can be merged into one histogram per barcode
+        file_ranges = {file_id: (json.loads(file_params).get('min_size'), json.loads(file_params).get('max_size'))
+                       for file_id, file_params in con.execute("SELECT file_id, params FROM manifest").fetchall()}
+        same_range = [file_id for file_id, size_range in file_ranges.items() if size_range == (min_size, max_size)]
+        n_other = con.execute("""
+        SELECT COUNT(DISTINCT file_id) FROM count_table WHERE file_id NOT IN (SELECT UNNEST(?::INTEGER[]))
+        """, [same_range]).fetchone()[0]
+        if n_other:
+            logger.warning("The count table of %d file(s) summarized with another size range than %d-%d is not "
+                           "included. Ingest them again with this range to include them.", n_other, min_size, max_size)
+
+        summaries = con.execute("""
+        SELECT barcode, insertsize_count, mean_insertsize, dist FROM count_table
+        WHERE file_id IN (SELECT UNNEST(?::INTEGER[]))
+        ORDER BY file_id, barcode;
+        """, [same_range]).df()
+    finally:
+        con.close()
+
+    # barcodes spanning several files are combined into one row
+    dists = sparse.csr_matrix(_dists_to_matrix(summaries['dist']).reshape(len(summaries), max_size - min_size + 1))
+    n_fragments = np.asarray(dists.sum(axis=1)).ravel()
+    stats, dists = _merge_histograms(summaries['barcode'].to_numpy(), summaries['insertsize_count'].to_numpy(),
+                                     np.rint(summaries['mean_insertsize'].to_numpy() * n_fragments).astype(np.int64),
+                                     dists)
 
     if count_table_path is not None:
-        output_df = count_table.copy()
-        
-        output_df['dist'] = output_df['dist'].apply(lambda x: ','.join(map(str, x)))
-        
-        output_df.to_csv(count_table_path, sep='\t', index=True)
-    
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
 
-    con.close()
-    
-    return count_table
+    return _format_output(stats, dists, 'dataframe')
     
 
 def insertsize_from_duckdb(
     db_path: str, 
     min_size: int = 0, 
     max_size: int = 1000, 
+    barcodes: Optional[List[str] | str | Path | ad.AnnData] = None,
+    barcode_col: Optional[str] = None,
     memory_limit: str = '8GB', 
-    count_table_path: Optional[str | Path] = None
-) -> pd.DataFrame:
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv',
+    output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe',
+    sample_size: Optional[int] = None,
+    seed: int = 42
+) -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
     """
     Summarizes all fragments in the DuckDB database.
     Calculates size distributions per barcode from the fragments table in the database.
@@ -232,75 +484,2385 @@ def insertsize_from_duckdb(
         db_path: Path to the DuckDB database
         min_size: Minimum size threshold for fragments
         max_size: Maximum size threshold for fragments
+        barcodes: Optional barcode whitelist as list, path to a file with one barcode per line or
+            AnnData object. Applied as semi-join before aggregation.
+        barcode_col: Column of adata.obs holding the barcodes if barcodes is an AnnData object.
         memory_limit: Memory limit for DuckDB
-        count_table_path: Optional path to save the summary table as TSV
+        n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+        count_table_path: Optional path to save the summary table
+        count_table_format: Format of the saved count table. See write_count_table.
+        output: 'dataframe' returns the count table with a dense dist column. 'sparse' returns the
+            barcode statistics and a CSR matrix (barcodes x sizes) without building dense arrays.
+            'numpy' returns the barcode statistics and a C-contiguous int32 array (barcodes x sizes).
+        sample_size: Optional maximum number of fragments per barcode in the distributions, see
+            insertsize_from_fragments.
+        seed: Seed of the fragment sample.
 
     Returns:
-        count_table: DataFrame with barcode statistics and distributions
+        count_table: DataFrame with barcode statistics and distributions, or a tuple of the
+            statistics and the sparse or dense distributions if output is 'sparse' or 'numpy'
+
+    Raises:
+        ValueError: If partials are requested for sampled distributions.
     """
+    if sample_size is not None and count_table_format == 'partial':
+        raise ValueError("Partials need full distributions. Sample after merge_partials instead.")
 
-    con = duckdb.connect(db_path)
-    con.execute(f"SET memory_limit='{memory_limit}'")
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    with FragmentStore(db_path, config=config) as store:
+        stats, dists = store.histogram(min_size=min_size, max_size=max_size, barcodes=barcodes,
+                                       barcode_col=barcode_col, output='sparse', sample_size=sample_size, seed=seed)
 
+    if count_table_path is not None:
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
 
-    count_table = con.execute("""
-        WITH fragment_sizes AS (
-            SELECT 
-                barcode,
-                size,
-                count
-            FROM fragments
-            WHERE size BETWEEN ? AND ?
-        ),
-        barcode_stats AS (
-            SELECT 
-                barcode,
-                SUM(count) AS insertsize_count,
-                AVG(size) AS mean_insertsize
-            FROM fragment_sizes
-            GROUP BY barcode
-        ),
-        all_combinations AS (
-            SELECT 
-                b.barcode,
-                s.size
-            FROM (SELECT DISTINCT barcode FROM fragment_sizes) b
-            CROSS JOIN generate_series(?, ?) s(size)
-        ),
-        size_counts AS (
-            SELECT 
-                barcode,
-                size,
-                COUNT(*) AS fragment_count
-            FROM fragment_sizes
-            GROUP BY barcode, size
-        ),
-        size_arrays AS (
-            SELECT 
-                ac.barcode,
-                ARRAY_AGG(COALESCE(sc.fragment_count, 0) ORDER BY ac.size) AS dist
-            FROM all_combinations ac
-            LEFT JOIN size_counts sc 
-                ON ac.barcode = sc.barcode 
-                AND ac.size = sc.size
-            GROUP BY ac.barcode
-        )
-        SELECT 
-            bs.*,
-            sa.dist
-        FROM barcode_stats bs
-        JOIN size_arrays sa ON bs.barcode = sa.barcode
-    """, [min_size, max_size, min_size, max_size]).df()
+    return _format_output(stats, dists, output)
+
+
+class FragmentStore:
+    """
+    Persistent, read-only session on a fragments database written by insert_bed_to_duckdb.
+
+    The database is opened once, so its buffer cache is kept between queries. Every query runs on
+    its own cursor of the shared connection, so methods can be called from several threads at the
+    same time; cursor() hands out further cursors for custom SQL. With profiling enabled in the
+    config, queries run on the profiled main connection instead and must not be issued concurrently.
+
+    Example:
+        with FragmentStore('fragments.duckdb') as store:
+            count_table = store.histogram(barcodes=adata)
+            fragments = store.fragments(barcodes=['AAACGAAAGACGCAAC-1'], regions='chr1:1-100000')
+
+    Attributes:
+        db_path: Path to the DuckDB database.
+        config: DuckDB resource and profiling settings of the connection.
+    """
+
+    @beartype
+    def __init__(
+        self,
+        db_path: str | Path,
+        memory_limit: str = '8GB',
+        n_threads: Optional[int] = None,
+        config: Optional[DuckDBConfig] = None
+    ):
+        """
+        Open the database read-only.
+
+        Args:
+            db_path: Path to the DuckDB database.
+            memory_limit: Memory limit for DuckDB
+            n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+            config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+
+        Raises:
+            FileNotFoundError: If the database does not exist.
+        """
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"Database '{db_path}' does not exist.")
+
+        self.db_path = str(db_path)
+        self.config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+        self._con = _connect(self.config, self.db_path, read_only=True)
+
+    def __enter__(self) -> 'FragmentStore':
+        """Return the store for use as context manager."""
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Close the store when the context is left."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the connection and all its cursors."""
+        self._con.close()
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """Return a new cursor on the shared database, e.g. for queries from another thread."""
+        return self._con.cursor()
+
+    @beartype
+    def histogram(
+        self,
+        min_size: int = 0,
+        max_size: int = 1000,
+        barcodes: Optional[List[str] | str | Path | ad.AnnData] = None,
+        barcode_col: Optional[str] = None,
+        regions: Optional[str | List[str]] = None,
+        output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe',
+        sample_size: Optional[int] = None,
+        seed: int = 42
+    ) -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
+        """
+        Calculate size distributions per barcode over all ingested files.
+
+        Args:
+            min_size: Minimum size threshold
+            max_size: Maximum size threshold
+            barcodes: Optional barcode whitelist as list, path to a file with one barcode per line or
+                AnnData object. Applied as semi-join before aggregation.
+            barcode_col: Column of adata.obs holding the barcodes if barcodes is an AnnData object.
+            regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'
+            output: 'dataframe', 'sparse' or 'numpy', see insertsize_from_fragments.
+            sample_size: Optional maximum number of fragments per barcode in the distributions, see
+                insertsize_from_fragments.
+            seed: Seed of the fragment sample.
+
+        Returns:
+            count_table: DataFrame with barcode statistics and distributions, or a tuple of the
+                statistics and the sparse or dense distributions if output is 'sparse' or 'numpy'
+        """
+        with self._query() as con:
+            # aggregate on the integer barcode keys, strings are only looked up for the result
+            source = f"""(
+                SELECT f.barcode_id AS barcode, f.size, f.count, f.file_id, f.chrom_id, f.start, f."end"
+                {self._from(con, barcodes, barcode_col, regions)}
+            )"""
+            stats, dists = _sparse_count_table(con, source, 'size', min_size, max_size, sample_size=sample_size,
+                                               sample_key='file_id, chrom_id, start, "end"', seed=seed)
+            stats = _decode_barcodes(con, stats)
+
+        return _format_output(stats, dists, output)
+
+    @beartype
+    def fragments(
+        self,
+        barcodes: Optional[List[str] | str | Path | ad.AnnData] = None,
+        barcode_col: Optional[str] = None,
+        regions: Optional[str | List[str]] = None
+    ) -> pd.DataFrame:
+        """
+        Look up the fragments of barcodes and/or regions.
+
+        Args:
+            barcodes: Barcodes as list, path to a file with one barcode per line or AnnData object.
+            barcode_col: Column of adata.obs holding the barcodes if barcodes is an AnnData object.
+            regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'
+
+        Returns:
+            DataFrame with chrom, start, end, barcode, count, size and the path of the source file
+
+        Raises:
+            ValueError: If neither barcodes nor regions are given.
+        """
+        if barcodes is None and regions is None:
+            raise ValueError("Select fragments by barcodes and/or regions; use histogram() for all fragments.")
+
+        with self._query() as con:
+            return con.execute(f"""
+                SELECT ch.chrom, f.start, f."end", b.barcode, f.count, f.size, m.path
+                {self._from(con, barcodes, barcode_col, regions, decode=True)}
+                ORDER BY f.file_id, f.chrom_id, f.start
+            """).df()
+
+    @beartype
+    def distributions(
+        self,
+        barcodes: List[str],
+        min_size: int = 0,
+        max_size: int = 1000
+    ) -> Tuple[pd.DataFrame, np.ndarray]:
+        """
+        Look up the size distributions of a few barcodes over all ingested files.
+
+        The barcode IDs are resolved first and then filtered as constants, so DuckDB skips all row
+        groups of the barcode sorted fragments table that cannot contain them.
+
+        Args:
+            barcodes: Barcodes to look up.
+            min_size: Minimum size threshold
+            max_size: Maximum size threshold
+
+        Returns:
+            stats: DataFrame with insertsize_count and mean_insertsize in the order of barcodes
+            dists: Dense int32 array (barcodes x sizes)
+
+        Raises:
+            KeyError: If a barcode is not in the database.
+        """
+        with self._query() as con:
+            ids = con.execute(f"""
+                SELECT barcode, barcode_id FROM barcodes
+                WHERE barcode IN ({', '.join(_sql_str(barcode) for barcode in barcodes) or 'NULL'})
+            """).df().set_index('barcode')['barcode_id']
+            missing = [barcode for barcode in barcodes if barcode not in ids.index]
+            if missing:
+                raise KeyError(f"Barcodes not found in '{self.db_path}': {missing[:10]}")
+
+            source = f"""(
+                SELECT barcode_id AS barcode, size, count FROM fragments
+                WHERE barcode_id IN ({', '.join(str(i) for i in ids.unique())})
+            )"""
+            stats, dists = _sparse_count_table(con, source, 'size', min_size, max_size)
+            stats = _decode_barcodes(con, stats)
+
+        return _reorder_distributions(stats, dists, barcodes, max_size - min_size + 1)
+
+    def files(self) -> pd.DataFrame:
+        """Return the manifest of the ingested files."""
+        with self._query() as con:
+            return con.execute("SELECT * FROM manifest ORDER BY file_id").df()
 
-    count_table.set_index('barcode', inplace=True)
+    @beartype
+    def summary(self, output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe') -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
+        """
+        Return the per-file summaries stored by insert_bed_to_duckdb(summarize=True).
+
+        Args:
+            output: 'dataframe', 'sparse' or 'numpy', see insertsize_from_fragments.
+
+        Returns:
+            Statistics and distributions per file and barcode with the path of the file
+        """
+        with self._query() as con:
+            summary = con.execute("""
+                SELECT m.path, c.barcode, c.insertsize_count, c.mean_insertsize, c.dist
+                FROM count_table c
+                JOIN manifest m USING (file_id)
+                ORDER BY c.file_id, c.barcode
+            """).df().set_index('barcode')
+
+        if output == 'dataframe':
+            summary['dist'] = [np.asarray(dist, dtype=np.int32) for dist in summary['dist']]
+            return summary
+
+        dists = _dists_to_matrix(summary.pop('dist'))
+        return _format_output(summary, sparse.csr_matrix(dists), output)
+
+    @contextmanager
+    def _query(self):
+        """Yield a fresh cursor (or the profiled connection) and close it afterwards."""
+        if isinstance(self._con, _ProfiledConnection):
+            yield self._con
+            return
+
+        cursor = self._con.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def _from(
+        self,
+        con: 'DuckDBConnection',
+        barcodes: Optional[List[str] | str | Path | ad.AnnData],
+        barcode_col: Optional[str],
+        regions: Optional[str | List[str]],
+        decode: bool = False
+    ) -> str:
+        """
+        Build the FROM and WHERE clauses selecting fragments (alias f) by barcodes and regions.
+
+        With decode, the chroms (ch), barcodes (b) and manifest (m) tables are joined as well.
+        """
+        parsed_regions = _parse_regions(regions)
+        tables = ["fragments f"]
+        if decode or parsed_regions:
+            tables.append("JOIN chroms ch ON f.chrom_id = ch.chrom_id")
+        if decode:
+            tables.append("JOIN barcodes b ON f.barcode_id = b.barcode_id")
+            tables.append("JOIN manifest m ON f.file_id = m.file_id")
+
+        clauses = []
+        if _register_barcodes(con, barcodes, barcode_col=barcode_col):
+            clauses.append("""f.barcode_id IN (SELECT barcode_id FROM barcodes
+                                                WHERE barcode IN (SELECT barcode FROM barcode_whitelist))""")
+        if parsed_regions:
+            clauses.append(_region_condition(parsed_regions, 'ch.chrom', 'f.start', 'f."end"'))
+
+        return "FROM " + " ".join(tables) + (" WHERE " + " AND ".join(clauses) if clauses else "")
+
+
+@beartype
+def qc_from_fragments(
+    fragments: str | Path,
+    min_size: int = 0,
+    max_size: int = 1000,
+    regions: Optional[str | List[str]] = None,
+    barcodes: Optional[List[str] | str | Path | ad.AnnData] = None,
+    barcode_col: Optional[str] = None,
+    mito_chroms: Tuple[str, ...] | List[str] = MITO_CHROMS,
+    memory_limit: str = '8GB',
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv',
+    output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe'
+) -> Tuple[pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray], pd.DataFrame, pd.DataFrame]:
+    """
+    Calculate the size distributions together with fragment QC metrics per barcode in a single scan.
+
+    The fragments are aggregated once into (barcode, chrom, size) counts; the histograms and all
+    QC metrics are derived from this aggregate. QC metrics cover all fragments, the histograms
+    only sizes between min_size and max_size.
+
+    QC metrics:
+        unique_fragments: Number of fragments (rows of the fragment file).
+        total_fragments: Number of read pairs, i.e. the sum of the count column.
+        duplicate_rate: 1 - unique_fragments / total_fragments.
+        mito_fragments: Number of fragments on mitochondrial chromosomes.
+        mito_fraction: mito_fragments / unique_fragments.
+
+    Args:
+        fragments: Path to input fragment file (.bed, .bed.gz or bgzip) or Parquet fragment store
+        min_size: Minimum size threshold of the histograms
+        max_size: Maximum size threshold of the histograms
+        regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'
+        barcodes: Optional barcode whitelist. See insertsize_from_fragments.
+        barcode_col: Column of adata.obs holding the barcodes if barcodes is an AnnData object.
+        mito_chroms: Names of the mitochondrial chromosome(s).
+        memory_limit: Memory limit for DuckDB
+        n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+        count_table_path: Optional path to save the count table
+        count_table_format: Format of the saved count table. See write_count_table.
+        output: 'dataframe', 'sparse' or 'numpy', see insertsize_from_fragments.
+
+    Returns:
+        count_table: Histograms in the layout given by output
+        qc_table: DataFrame indexed by barcode with the QC metrics
+        chrom_counts: DataFrame (barcodes x chromosomes) with the number of fragments
+    """
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    con = _connect(config)
+
+    whitelist = _register_barcodes(con, barcodes, barcode_col=barcode_col)
+    _register_fragments(con, fragments, regions=regions, barcodes=whitelist,
+                        explicit_schema=config.explicit_schema)
+
+    # sizes outside the histogram range share one NULL group, they only count for the QC metrics
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE fragment_counts AS
+        SELECT
+            barcode,
+            chrom,
+            CASE WHEN "end" - start - 9 BETWEEN ? AND ? THEN "end" - start - 9 END AS size,
+            COUNT(*) AS n_fragments,
+            SUM(count) AS count
+        FROM fragment_src
+        GROUP BY ALL
+    """, [min_size, max_size])
+
+    stats, dists = _sparse_count_table(con, "(SELECT * FROM fragment_counts WHERE size IS NOT NULL)", 'size',
+                                       min_size, max_size, n_fragments='n_fragments')
+
+    qc_table = con.execute("""
+        SELECT
+            barcode,
+            CAST(SUM(n_fragments) AS BIGINT) AS unique_fragments,
+            CAST(SUM(count) AS BIGINT) AS total_fragments,
+            1 - SUM(n_fragments) / SUM(count) AS duplicate_rate,
+            CAST(COALESCE(SUM(n_fragments) FILTER (WHERE chrom IN (SELECT UNNEST(?))), 0) AS BIGINT) AS mito_fragments
+        FROM fragment_counts
+        GROUP BY barcode
+        ORDER BY barcode
+    """, [list(mito_chroms)]).df().set_index('barcode')
+    qc_table['mito_fraction'] = qc_table['mito_fragments'] / qc_table['unique_fragments']
+
+    chrom_counts = con.execute("""
+        SELECT barcode, chrom, CAST(SUM(n_fragments) AS BIGINT) AS n_fragments
+        FROM fragment_counts
+        GROUP BY barcode, chrom
+    """).df().pivot(index='barcode', columns='chrom', values='n_fragments')
+    chrom_counts = chrom_counts.reindex(qc_table.index).fillna(0).astype(np.int64)
+    chrom_counts.columns.name = None
+
+    con.close()
 
     if count_table_path is not None:
-        output_df = count_table.copy()
-        output_df['dist'] = output_df['dist'].apply(lambda x: ','.join(map(str, x)))
-        output_df.to_csv(count_table_path, sep='\t', index=True)
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
+
+    return _format_output(stats, dists, output), qc_table, chrom_counts
+
+
+@beartype
+def insertsize_by_regions(
+    fragments: str | Path,
+    regions_bed: str | Path,
+    min_size: int = 0,
+    max_size: int = 1000,
+    barcodes: Optional[List[str] | str | Path | ad.AnnData] = None,
+    barcode_col: Optional[str] = None,
+    memory_limit: str = '8GB',
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv',
+    output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe'
+) -> Dict[str, pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]]:
+    """
+    Calculate size distributions per barcode separately for fragments inside and outside of a set of regions.
+
+    The regions (e.g. TSS windows, peaks or a blacklist) are merged and sorted, and every fragment is
+    matched to the last region starting before the fragment end with an ASOF join. A fragment is inside
+    if it overlaps that region. Both histograms are built from a single scan of the fragments.
+
+    Args:
+        fragments: Path to input fragment file (.bed, .bed.gz or bgzip) or Parquet fragment store
+        regions_bed: BED file (optionally gzip compressed) with the regions in the first three columns
+        min_size: Minimum size threshold
+        max_size: Maximum size threshold
+        barcodes: Optional barcode whitelist. See insertsize_from_fragments.
+        barcode_col: Column of adata.obs holding the barcodes if barcodes is an AnnData object.
+        memory_limit: Memory limit for DuckDB
+        n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+        count_table_path: Optional path to save the count tables. '_inside' and '_outside' are
+            appended to the file name.
+        count_table_format: Format of the saved count tables. See write_count_table.
+        output: 'dataframe', 'sparse' or 'numpy', see insertsize_from_fragments.
+
+    Returns:
+        Dictionary with the count tables of the fragments 'inside' and 'outside' of the regions
+    """
+    regions = _merge_intervals(_read_bed_regions(regions_bed))
+
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    con = _connect(config)
+
+    whitelist = _register_barcodes(con, barcodes, barcode_col=barcode_col)
+    _register_fragments(con, fragments, barcodes=whitelist, explicit_schema=config.explicit_schema)
+
+    con.register('_regions_df', regions)
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE region_index AS
+        SELECT chrom::VARCHAR AS chrom, start::BIGINT AS start, "end"::BIGINT AS "end"
+        FROM _regions_df
+        ORDER BY chrom, start
+    """)
+    con.unregister('_regions_df')
+
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE region_counts AS
+        SELECT
+            COALESCE(r."end" > f.start, false) AS inside,
+            f.barcode,
+            (f."end" - f.start - 9) AS size,
+            COUNT(*) AS n_fragments,
+            SUM(f.count) AS count
+        FROM fragment_src f
+        ASOF LEFT JOIN region_index r
+            ON f.chrom = r.chrom AND f."end" > r.start
+        WHERE (f."end" - f.start - 9) BETWEEN ? AND ?
+        GROUP BY ALL
+    """, [min_size, max_size])
+
+    tables = {}
+    for key, condition in [('inside', 'inside'), ('outside', 'NOT inside')]:
+        source = f"(SELECT * FROM region_counts WHERE {condition})"
+        stats, dists = _sparse_count_table(con, source, 'size', min_size, max_size, n_fragments='n_fragments')
+
+        if count_table_path is not None:
+            path = Path(count_table_path)
+            write_count_table(stats, path.with_name(f"{path.stem}_{key}{path.suffix}"),
+                              format=count_table_format, min_size=min_size, dists=dists)
+
+        tables[key] = _format_output(stats, dists, output)
 
     con.close()
 
-    return count_table
+    return tables
+
+
+@beartype
+def insertsize_from_bam(
+    bamfile: str | Path | List[str | Path],
+    barcodes: Optional[List[str]] = None,
+    barcode_tag: Optional[str] = 'CB',
+    chunk_size: int = 100000,
+    regions: Optional[str | List[str]] = None,
+    sample_label: Optional[Literal['filename', 'read_group'] | Dict[str, str]] = None,
+    min_size: int = 0,
+    max_size: int = 1000,
+    min_mapq: int = 30,
+    max_distance: int = 1000,
+    n_threads: int = 8,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv'
+) -> pd.DataFrame:
+    """
+    Calculate size distributions per barcode directly from one or more indexed BAM files.
+
+    Fragments are taken from properly paired reads (one per pair, the leftmost mate) using the
+    same filters as bam_sinto_bed.sh: a minimum mapping quality of both mates and a maximum
+    fragment length (template length). Reads flagged as duplicates are skipped. The fragment is
+    shifted like sinto does (+4/-5), so its size is its template length - 18, the same size as
+    for the corresponding fragment file entry.
+    Work is split by chromosome through the BAM index and processed by multiple processes.
+
+    With sample_label set, every fragment of a file is labeled with the file name (without .bam)
+    or the sample (SM, otherwise ID) of its read group instead of a barcode tag. This replaces the
+    add_barcode.py + sinto fragments route for bulk data.
+
+    Args:
+        bamfile: Path or list of paths to coordinate sorted BAM files.
+        barcodes: Optional list of barcodes (or sample labels) to keep.
+        barcode_tag: Read tag containing the barcode. Ignored if sample_label is set.
+        chunk_size: Number of fragments buffered per worker before they are added to the histograms.
+        regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'.
+            Fragments are assigned to the region their leftmost read starts in.
+        sample_label: Label fragments per file ('filename') or per read group ('read_group'). A
+            dictionary maps every BAM path to its label.
+        min_size: Minimum size threshold
+        max_size: Maximum size threshold
+        min_mapq: Minimum mapping quality of both mates.
+        max_distance: Maximum template length of a fragment.
+        n_threads: Number of worker processes.
+        count_table_path: Optional path to save the count table
+        count_table_format: Format of the saved count table. See write_count_table.
+
+    Returns:
+        count_table: DataFrame with barcode statistics and distributions
+
+    Raises:
+        ValueError: If neither barcode_tag nor sample_label is given.
+    """
+    if barcode_tag is None and sample_label is None:
+        raise ValueError("Either barcode_tag or sample_label has to be set.")
+
+    bamfiles = [str(f) for f in bamfile] if isinstance(bamfile, list) else [str(bamfile)]
+    parsed_regions = _parse_regions(regions)
+
+    tasks = []
+    for path in bamfiles:
+        if isinstance(sample_label, dict):
+            label_mode, file_label = 'filename', sample_label[path]
+        else:
+            label_mode = sample_label
+            file_label = os.path.basename(path)[:-4] if path.endswith('.bam') else os.path.basename(path)
+        for chrom, start, end in _bam_chunks(path, parsed_regions):
+            tasks.append((path, file_label, chrom, start, end, barcode_tag, label_mode, min_mapq,
+                          max_distance, min_size, max_size, chunk_size))
+
+    n_bins = max_size - min_size + 1
+    label_index = {}
+    keys, key_counts = [], []
+    size_sums = np.zeros(0, dtype=np.int64)
+
+    with mp.Pool(n_threads, initializer=_init_bam_worker, initargs=(barcodes,)) as pool:
+        for labels, rows, bins, chunk_counts, chunk_sums in pool.imap_unordered(_bam_worker, tasks):
+            for label in labels:
+                label_index.setdefault(label, len(label_index))
+            size_sums = np.concatenate([size_sums, np.zeros(len(label_index) - len(size_sums), dtype=np.int64)])
+
+            task_rows = np.fromiter((label_index[label] for label in labels), dtype=np.int64, count=len(labels))
+            size_sums[task_rows] += chunk_sums
+            keys.append(task_rows[rows] * n_bins + bins)
+            key_counts.append(chunk_counts)
+
+    keys, n_fragments = _sum_keys(np.concatenate(keys or [np.zeros(0, dtype=np.int64)]),
+                                  np.concatenate(key_counts or [np.zeros(0, dtype=np.int64)]))
+    dists = sparse.csr_matrix((n_fragments, (keys // n_bins, keys % n_bins)),
+                              shape=(len(label_index), n_bins), dtype=np.int32)
+    stats = _stats_from_sparse(list(label_index), dists, size_sums)
+
+    if count_table_path is not None:
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
+
+    return _format_output(stats, dists, 'dataframe')
+
+
+@beartype
+def insertsize_from_sample_sheet(
+    sample_sheet: str | Path | pd.DataFrame | Dict[str, str],
+    min_size: int = 0,
+    max_size: int = 1000,
+    regions: Optional[str | List[str]] = None,
+    memory_limit: str = '8GB',
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None,
+    min_mapq: int = 30,
+    max_distance: int = 1000,
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv',
+    output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe',
+    sample_size: Optional[int] = None,
+    seed: int = 42
+) -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
+    """
+    Calculate one size distribution per sample for bulk data from a sample sheet.
+
+    Every fragment file or BAM file is labeled with its sample, so neither add_barcode.py nor a
+    merged fragment file are needed. All fragment files are aggregated by one multi-file DuckDB scan
+    grouped by file, BAM files are processed in parallel by insertsize_from_bam. Several files of the
+    same sample are summed up. The result can be passed to add_fld_metrics via count_table_path.
+
+    Args:
+        sample_sheet: Table (tsv/csv file or DataFrame) with the columns 'sample' and 'path', or a
+            dictionary mapping sample names to paths. Paths ending with .bam are read as BAM files,
+            all others as fragment files.
+        min_size: Minimum size threshold
+        max_size: Maximum size threshold
+        regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'
+        memory_limit: Memory limit for DuckDB
+        n_threads: Number of DuckDB threads and BAM worker processes.
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads for DuckDB.
+        min_mapq: Minimum mapping quality of both mates (BAM input only).
+        max_distance: Maximum template length of a fragment (BAM input only).
+        count_table_path: Optional path to save the count table
+        count_table_format: Format of the saved count table. See write_count_table.
+        output: 'dataframe', 'sparse' or 'numpy', see insertsize_from_fragments.
+        sample_size: Optional maximum number of fragments per sample in the distributions. The
+            sample is drawn from the merged per-sample histograms, which are small for bulk data.
+        seed: Seed of the fragment sample.
+
+    Returns:
+        count_table: Per-sample statistics and distributions (samples x sizes) in the order of the
+            sample sheet
+
+    Raises:
+        ValueError: If the sample sheet lacks the 'sample' or 'path' column or partials are
+            requested for sampled distributions.
+    """
+    if sample_size is not None and count_table_format == 'partial':
+        raise ValueError("Partials need full distributions. Sample after merge_partials instead.")
+    sheet = _read_sample_sheet(sample_sheet)
+    is_bam = sheet['path'].str.endswith('.bam').to_numpy()
+
+    parts = []
+    if (~is_bam).any():
+        config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+        con = _connect(config)
+        con.register('sample_paths', sheet[~is_bam])
+
+        scans = []
+        for i, paths in enumerate(_scan_groups(sheet.loc[~is_bam, 'path'].tolist(), regions)):
+            name = _register_fragments(con, paths, regions=regions, explicit_schema=config.explicit_schema,
+                                       name=f'fragment_src_{i}')
+            scans.append(f"""
+                SELECT s.sample AS barcode, f."end" - f.start - 9 AS size, f.count
+                FROM {name} f
+                JOIN sample_paths s ON f.filename = s.path
+            """)
+
+        parts.append(_sparse_count_table(con, f"({' UNION ALL '.join(scans)})", 'size', min_size, max_size))
+        con.close()
+
+    if is_bam.any():
+        bam_sheet = sheet[is_bam]
+        table = insertsize_from_bam(bam_sheet['path'].tolist(), barcode_tag=None,
+                                    sample_label=dict(zip(bam_sheet['path'], bam_sheet['sample'])),
+                                    min_size=min_size, max_size=max_size, min_mapq=min_mapq,
+                                    max_distance=max_distance, n_threads=n_threads or mp.cpu_count())
+        dists = sparse.csr_matrix(_dists_to_matrix(table.pop('dist')).reshape(len(table), max_size - min_size + 1))
+        parts.append((table, dists))
+
+    stats = pd.concat([part[0] for part in parts])
+    dists = sparse.vstack([part[1] for part in parts], format='csr')
+
+    # files of the same sample in both inputs are summed, means weighted by the fragment counts
+    samples = pd.unique(sheet['sample'])
+    samples = samples[pd.Index(samples).isin(stats.index)]
+    rows = pd.Index(samples).get_indexer(stats.index)
+    merge = sparse.csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(samples), len(rows)))
+    n_fragments = np.asarray(dists.sum(axis=1)).ravel()
+    size_sums = merge @ (stats['mean_insertsize'].to_numpy() * n_fragments)
+    dists = (merge @ dists).astype(np.int32).tocsr()
+    stats = pd.DataFrame({'insertsize_count': (merge @ stats['insertsize_count'].to_numpy()).astype(np.int64),
+                          'mean_insertsize': size_sums / np.asarray(dists.sum(axis=1)).ravel()},
+                         index=pd.Index(samples, name='barcode'))
+    if sample_size is not None:
+        dists = _sample_histograms(dists, sample_size, seed=seed)
+
+    if count_table_path is not None:
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
+
+    return _format_output(stats, dists, output)
+
+
+@beartype
+def fragments_to_parquet(
+    fragment_files: str | List[str] | pd.DataFrame | Dict[str, str],
+    out_dir: str | Path,
+    regions: Optional[str | List[str]] = None,
+    mode: Literal['error', 'overwrite', 'append'] = 'error',
+    compression: str = 'zstd',
+    row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+    memory_limit: str = '8GB',
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None
+) -> str:
+    """
+    Convert fragment files into a Parquet fragment store partitioned by sample and chromosome.
+
+    The store is a hive partitioned directory (out_dir/sample=.../chrom=.../*.parquet) with typed,
+    compressed start, end, barcode and count columns. Rows are sorted by start within a partition,
+    so the row group statistics allow skipping row groups outside of queried regions.
+    All functions reading fragment files accept the store (or a single sample directory
+    out_dir/sample=...) in place of a fragment file; chromosome partitions outside of the requested
+    regions are not read.
+
+    Args:
+        fragment_files: Fragment file(s) as list or glob pattern, labeled by their file name
+            without extensions, or a sample sheet (see insertsize_from_sample_sheet).
+        out_dir: Directory of the store.
+        regions: Optional region(s) to restrict the stored fragments to.
+        mode: 'error' refuses to write into a non-empty out_dir, 'overwrite' replaces its content and
+            'append' adds the files, e.g. of further samples.
+        compression: Parquet compression codec.
+        row_group_size: Number of rows per Parquet row group.
+        memory_limit: Memory limit for DuckDB
+        n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+
+    Returns:
+        Path of the store.
+
+    Raises:
+        FileExistsError: If out_dir is not empty and mode is 'error'.
+        FileNotFoundError: If a glob pattern matches no files.
+    """
+    if isinstance(fragment_files, (pd.DataFrame, dict)):
+        sheet = _read_sample_sheet(fragment_files)
+    else:
+        if isinstance(fragment_files, str):
+            pattern = fragment_files
+            fragment_files = sorted(glob.glob(pattern))
+            if not fragment_files:
+                raise FileNotFoundError(f"No fragment files match '{pattern}'.")
+        sheet = pd.DataFrame({'sample': [re.sub(r'(\.(bed|tsv|txt|gz|bgz))+$', '', os.path.basename(path))
+                                         for path in fragment_files],
+                              'path': [os.path.abspath(path) for path in fragment_files]})
+
+    out_dir = str(out_dir)
+    if mode == 'error' and os.path.isdir(out_dir) and os.listdir(out_dir):
+        raise FileExistsError(f"'{out_dir}' is not empty. Use mode='overwrite' or mode='append'.")
+
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    con = _connect(config)
+    con.register('sample_paths', sheet)
+
+    scans = []
+    for i, paths in enumerate(_scan_groups(sheet['path'].tolist(), regions)):
+        name = _register_fragments(con, paths, regions=regions, explicit_schema=config.explicit_schema,
+                                   name=f'fragment_src_{i}')
+        scans.append(f"""
+            SELECT s.sample, f.chrom, f.start, f."end", f.barcode, f.count
+            FROM {name} f
+            JOIN sample_paths s ON f.filename = s.path
+        """)
+
+    write_mode = {'error': 'OVERWRITE_OR_IGNORE true', 'overwrite': 'OVERWRITE true',
+                  'append': "APPEND true, FILENAME_PATTERN 'fragments_{uuid}'"}[mode]
+    con.execute(f"""
+        COPY ({' UNION ALL '.join(scans)} ORDER BY sample, chrom, start)
+        TO {_sql_str(out_dir)}
+        (FORMAT parquet, PARTITION_BY (sample, chrom), COMPRESSION {compression},
+         ROW_GROUP_SIZE {row_group_size}, {write_mode})
+    """)
+    con.close()
+
+    return out_dir
+
+
+@beartype
+def cutsite_pileup(
+    fragments: str | Path,
+    out_dir: str | Path,
+    bin_size: int = 100,
+    groups: Optional[Dict[str, str] | pd.Series] = None,
+    regions: Optional[str | List[str]] = None,
+    memory_limit: str = '8GB',
+    n_threads: Optional[int] = None,
+    config: Optional[DuckDBConfig] = None
+) -> str:
+    """
+    Count Tn5 cut sites per genomic bin and barcode (or group of barcodes) in one fragment scan.
+
+    Both ends of a fragment are cut sites (start and end - 1). The binned counts are aggregated by
+    DuckDB, which spills to disk if needed, and streamed in genomic order into memory-mapped arrays,
+    so Python never holds more than a batch of bins. The coverage is stored as a CSR matrix with one
+    row per bin and one column per label, and only non-zero counts are kept, so its size grows with
+    the number of covered (bin, label) pairs instead of genome bins x labels. The pileup directory
+    contains:
+
+    - indptr.npy, indices.npy, data.npy: CSR arrays of the cut sites per bin (rows, genomic order)
+      and column
+    - bins.tsv: genomic-bin index with chrom, offset (first row of the chromosome) and n_bins
+    - barcodes.txt: column labels
+    - meta.json: format marker, bin_size and the shape of the matrix
+
+    Use read_pileup to load the bins of a region.
+
+    Args:
+        fragments: Path to input fragment file (.bed, .bed.gz or bgzip) or Parquet fragment store
+        out_dir: Directory of the pileup.
+        bin_size: Bin size in bp.
+        groups: Optional mapping of barcodes to column labels, e.g. cell types or samples. Other
+            barcodes are dropped. By default every barcode gets its own column.
+        regions: Optional region(s) to restrict the fragments to, e.g. 'chr1' or 'chr1:1-100000'
+        memory_limit: Memory limit for DuckDB
+        n_threads: Number of DuckDB threads. Defaults to DuckDB's choice (all cores).
+        config: DuckDB resource and profiling settings. Overrides memory_limit and n_threads.
+
+    Returns:
+        Path of the pileup directory.
+    """
+    config = config or DuckDBConfig(memory_limit=memory_limit, threads=n_threads)
+    con = _connect(config)
+    _register_fragments(con, fragments, regions=regions, explicit_schema=config.explicit_schema)
+
+    source = "(SELECT chrom, start, \"end\", barcode AS label FROM fragment_src)"
+    if groups is not None:
+        con.register('pileup_groups', pd.DataFrame({'barcode': list(dict(groups).keys()),
+                                                    'label': [str(label) for label in dict(groups).values()]}))
+        source = """(
+            SELECT f.chrom, f.start, f."end", g.label
+            FROM fragment_src f
+            JOIN pileup_groups g USING (barcode)
+        )"""
+
+    # both cut sites of a fragment from a single scan
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE pileup AS
+        SELECT chrom, bin, label, CAST(COUNT(*) AS INTEGER) AS n
+        FROM (SELECT chrom, label, UNNEST([start // {bin_size}, ("end" - 1) // {bin_size}]) AS bin FROM {source})
+        GROUP BY ALL
+    """)
+
+    chroms = con.execute("SELECT chrom, MAX(bin) + 1 AS n_bins FROM pileup GROUP BY chrom").df()
+    chroms = chroms.iloc[sorted(range(len(chroms)), key=lambda i: _natural_key(chroms['chrom'][i]))]
+    chroms['offset'] = np.concatenate([[0], np.cumsum(chroms['n_bins'].to_numpy())[:-1]]).astype(np.int64)
+    labels = con.execute("SELECT DISTINCT label FROM pileup ORDER BY label").df()['label'].tolist()
+
+    n_rows = int(chroms['n_bins'].sum())
+    nnz = con.execute("SELECT COUNT(*) FROM pileup").fetchone()[0]
+
+    out_dir = str(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    indptr = np.lib.format.open_memmap(os.path.join(out_dir, 'indptr.npy'), mode='w+', dtype=np.int64,
+                                       shape=(n_rows + 1,))
+    indices = np.lib.format.open_memmap(os.path.join(out_dir, 'indices.npy'), mode='w+', dtype=np.int64,
+                                        shape=(nnz,))
+    data = np.lib.format.open_memmap(os.path.join(out_dir, 'data.npy'), mode='w+', dtype=np.int32, shape=(nnz,))
+
+    con.register('pileup_chroms', chroms[['chrom', 'offset']])
+    con.register('pileup_labels', pd.DataFrame({'label': labels, 'column': np.arange(len(labels))}))
+    batches = con.execute("""
+        SELECT c.offset + p.bin AS row, l.column, p.n
+        FROM pileup p
+        JOIN pileup_chroms c USING (chrom)
+        JOIN pileup_labels l USING (label)
+        ORDER BY row, l.column
+    """).fetch_record_batch(TABIX_CHUNK_SIZE)
+    pos = 0
+    for batch in batches:
+        rows = batch.column('row').to_numpy()
+        indices[pos:pos + len(rows)] = batch.column('column').to_numpy()
+        data[pos:pos + len(rows)] = batch.column('n').to_numpy()
+        pos += len(rows)
+        # entries per row, turned into row offsets below
+        filled, n_filled = np.unique(rows, return_counts=True)
+        indptr[filled + 1] += n_filled
+    np.cumsum(indptr, out=indptr)
+    for array in (indptr, indices, data):
+        array.flush()
+    del indptr, indices, data
+    con.close()
+
+    chroms[['chrom', 'offset', 'n_bins']].to_csv(os.path.join(out_dir, 'bins.tsv'), sep='\t', index=False)
+    with open(os.path.join(out_dir, 'barcodes.txt'), 'w') as f:
+        f.write(''.join(f"{label}\n" for label in labels))
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'format': PILEUP_FORMAT, 'version': PILEUP_VERSION, 'bin_size': bin_size,
+                   'shape': [n_rows, len(labels)]}, f)
+
+    return out_dir
+
+
+@beartype
+def read_pileup(
+    path: str | Path,
+    region: Optional[str] = None,
+    mmap: bool = True
+) -> Tuple[pd.DataFrame, sparse.csr_matrix]:
+    """
+    Read the bins of a cut-site pileup written by cutsite_pileup.
+
+    Args:
+        path: Pileup directory.
+        region: Optional region, e.g. 'chr1' or 'chr1:1-100000'. Only its bins are returned.
+        mmap: Whether to memory-map the CSR arrays instead of loading them. Only the slice of the
+            region is read.
+
+    Returns:
+        bins: DataFrame with chrom, start and end of the bins
+        coverage: CSR matrix of the cut sites per bin and column (see barcodes.txt)
+
+    Raises:
+        ValueError: If path is not a pileup.
+        KeyError: If the chromosome of the region has no cut sites.
+    """
+    path = str(path)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != PILEUP_FORMAT or meta.get('version') != PILEUP_VERSION:
+        raise ValueError(f"'{path}' is not a pileup written by this version of cutsite_pileup.")
+
+    bin_size = meta['bin_size']
+    n_rows, n_columns = meta['shape']
+    index = pd.read_csv(os.path.join(path, 'bins.tsv'), sep='\t', dtype={'chrom': str}).set_index('chrom')
+    indptr, indices, data = (np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+                             for name in ('indptr', 'indices', 'data'))
+
+    def rows(first: int, last: int) -> sparse.csr_matrix:
+        lo, hi = indptr[first], indptr[last]
+        return sparse.csr_matrix((np.asarray(data[lo:hi]), np.asarray(indices[lo:hi]),
+                                  np.asarray(indptr[first:last + 1]) - lo), shape=(last - first, n_columns))
+
+    if region is None:
+        chrom_of_row = np.repeat(index.index.to_numpy(), index['n_bins'].to_numpy())
+        starts = np.arange(n_rows) - np.repeat(index['offset'].to_numpy(), index['n_bins'].to_numpy())
+        bins = pd.DataFrame({'chrom': chrom_of_row, 'start': starts * bin_size, 'end': (starts + 1) * bin_size})
+        return bins, rows(0, n_rows)
+
+    chrom, start, end = _parse_regions(region)[0]
+    if chrom not in index.index:
+        raise KeyError(f"No cut sites on '{chrom}' in '{path}'.")
+    offset, n_bins = index.loc[chrom, ['offset', 'n_bins']]
+    first = 0 if start is None else min(start // bin_size, n_bins)
+    last = n_bins if end is None else min(-(-end // bin_size), n_bins)
+
+    positions = np.arange(first, last) * bin_size
+    bins = pd.DataFrame({'chrom': chrom, 'start': positions, 'end': positions + bin_size})
+
+    return bins, rows(offset + first, offset + last)
+
+
+@beartype
+def write_count_table(
+    count_table: pd.DataFrame,
+    path: str | Path,
+    format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'tsv',
+    min_size: int = 0,
+    dists: Optional[np.ndarray | sparse.spmatrix] = None
+) -> None:
+    """
+    Write a count table to disk.
+
+    'tsv' writes the legacy table with a comma-joined dist column. 'npy' writes a directory
+    holding the distributions as a dense int32 matrix (dist.npy) plus a barcode index
+    (barcodes.txt) and the insertsize_count and mean_insertsize sidecars, which can be loaded
+    memory-mapped. Sparse distributions are kept sparse in the 'npy' store (dist.npz).
+    'parquet' writes a single file with dist as a fixed-size list column.
+
+    'partial' writes an 'npy' store with sparse distributions, the exact sum of the fragment sizes
+    per barcode (size_sum.npy) and kind 'partial' in meta.json. Partials of different shards or
+    machines, e.g. one per VM or per chromosome, are combined exactly by merge_partials. They
+    have to be written from full (not sampled) distributions.
+
+    Args:
+        count_table: Count table as returned by the insertsize functions (indexed by barcode)
+        path: Output path. For 'npy' and 'partial' this is a directory.
+        format: Output format. One of 'tsv', 'npy', 'parquet' or 'partial'.
+        min_size: Fragment size of the first bin, stored as metadata for binary formats.
+        dists: Distributions (barcodes x sizes) if count_table has no dist column, e.g. the
+            sparse output of the insertsize functions.
+    """
+    if dists is None:
+        dists = _dists_to_matrix(count_table['dist'])
+    stats = count_table.drop(columns='dist', errors='ignore')
+
+    if format == 'tsv':
+        output_df = stats.copy()
+        output_df['dist'] = [','.join(map(str, row)) for row in _iter_dense_rows(dists)]
+        output_df.to_csv(path, sep='\t', index=True)
+        return
+
+    barcodes = stats.index.astype(str).to_numpy()
+    insert_counts = stats['insertsize_count'].to_numpy(dtype=np.int64)
+    means = stats['mean_insertsize'].to_numpy(dtype=np.float64)
+    meta = {'format': COUNT_TABLE_FORMAT,
+            'version': COUNT_TABLE_VERSION,
+            'min_size': min_size,
+            'max_size': min_size + dists.shape[1] - 1}
+
+    if format == 'partial':
+        dists = sparse.csr_matrix(dists, dtype=np.int32)
+        n_fragments = np.asarray(dists.sum(axis=1)).ravel()
+        # means are size_sum / n_fragments, rounding restores the integer sums exactly
+        size_sums = np.rint(np.nan_to_num(means) * n_fragments).astype(np.int64)
+        meta['kind'] = 'partial'
+
+    if format in ('npy', 'partial'):
+        os.makedirs(path, exist_ok=True)
+        # only one of dist.npy / dist.npz may exist in a store
+        for name in ['dist.npy', 'dist.npz']:
+            if os.path.isfile(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        if sparse.issparse(dists):
+            sparse.save_npz(os.path.join(path, 'dist.npz'), sparse.csr_matrix(dists, dtype=np.int32))
+        else:
+            np.save(os.path.join(path, 'dist.npy'), np.ascontiguousarray(dists, dtype=np.int32))
+        np.save(os.path.join(path, 'insertsize_count.npy'), insert_counts)
+        np.save(os.path.join(path, 'mean_insertsize.npy'), means)
+        if format == 'partial':
+            np.save(os.path.join(path, 'size_sum.npy'), size_sums)
+        with open(os.path.join(path, 'barcodes.txt'), 'w') as f:
+            f.write(''.join(f"{barcode}\n" for barcode in barcodes))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    elif format == 'parquet':
+        check_module('pyarrow')
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if sparse.issparse(dists):
+            dists = dists.toarray()
+        dists = np.ascontiguousarray(dists, dtype=np.int32)
+        dist_col = pa.FixedSizeListArray.from_arrays(pa.array(dists.ravel()), dists.shape[1])
+        table = pa.table({'barcode': pa.array(barcodes, type=pa.string()),
+                          'insertsize_count': insert_counts,
+                          'mean_insertsize': means,
+                          'dist': dist_col})
+        table = table.replace_schema_metadata({COUNT_TABLE_FORMAT: json.dumps(meta)})
+        pq.write_table(table, path)
+
+
+@beartype
+def read_count_table(
+    path: str | Path,
+    mmap: bool = True
+) -> Tuple[pd.DataFrame, np.ndarray | sparse.csr_matrix]:
+    """
+    Read a count table written by write_count_table or by the insertsize functions.
+
+    The format is detected from the path: a directory is read as 'npy' store, a .parquet file
+    as Parquet and anything else as the legacy TSV.
+
+    Args:
+        path: Path to the count table.
+        mmap: Whether to memory-map the distributions of a 'npy' store instead of loading them.
+
+    Returns:
+        stats: DataFrame indexed by barcode with insertsize_count and mean_insertsize
+        dists: 2D array (barcodes x sizes) of the fragment length distributions. Sparse
+            'npy' stores are returned as CSR matrix.
+    """
+    path = str(path)
+
+    if os.path.isdir(path):
+        if os.path.isfile(os.path.join(path, 'dist.npz')):
+            dists = sparse.csr_matrix(sparse.load_npz(os.path.join(path, 'dist.npz')))
+        else:
+            dists = np.load(os.path.join(path, 'dist.npy'), mmap_mode='r' if mmap else None)
+        with open(os.path.join(path, 'barcodes.txt')) as f:
+            barcodes = f.read().splitlines()
+        stats = pd.DataFrame({'insertsize_count': np.load(os.path.join(path, 'insertsize_count.npy')),
+                              'mean_insertsize': np.load(os.path.join(path, 'mean_insertsize.npy'))},
+                             index=pd.Index(barcodes, name='barcode'))
+
+    elif path.endswith('.parquet'):
+        check_module('pyarrow')
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, memory_map=mmap)
+        dist_col = table.column('dist').combine_chunks()
+        # the flattened child array of a fixed-size list is contiguous, reshape without copying
+        dists = dist_col.values.to_numpy(zero_copy_only=True).reshape(len(dist_col), dist_col.type.list_size)
+        stats = pd.DataFrame({'insertsize_count': table.column('insertsize_count').to_numpy(),
+                              'mean_insertsize': table.column('mean_insertsize').to_numpy()},
+                             index=pd.Index(table.column('barcode').to_pylist(), name='barcode'))
+
+    else:
+        count_table = pd.read_csv(path, sep='\t', index_col=0)
+        dists = np.array(count_table.pop('dist').str.split(',').tolist(), dtype=np.int64)
+        stats = count_table[['insertsize_count', 'mean_insertsize']]
+
+    return stats, dists
+
+
+@beartype
+def merge_partials(
+    partials: str | List[str | Path],
+    count_table_path: Optional[str | Path] = None,
+    count_table_format: Literal['tsv', 'npy', 'parquet', 'partial'] = 'partial',
+    output: Literal['dataframe', 'sparse', 'numpy'] = 'dataframe',
+    sample_size: Optional[int] = None,
+    seed: int = 42
+) -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
+    """
+    Combine partial count tables (see write_count_table with format 'partial') into one.
+
+    Distributions, insertsize_count and the size sums of equal barcodes are added, so the result
+    equals the count table of all underlying fragments. Written as 'partial' again, merged
+    tables can be merged further, e.g. per machine first and across machines afterwards.
+
+    Args:
+        partials: Paths to the partial stores or a glob pattern.
+        count_table_path: Optional path to save the merged count table
+        count_table_format: Format of the saved count table. See write_count_table.
+        output: 'dataframe', 'sparse' or 'numpy', see insertsize_from_fragments.
+        sample_size: Optional maximum number of fragments per barcode in the distributions, drawn
+            after merging. See insertsize_from_fragments.
+        seed: Seed of the fragment sample.
+
+    Returns:
+        count_table: DataFrame with barcode statistics and distributions, or a tuple of the
+            statistics and the sparse or dense distributions if output is 'sparse' or 'numpy'
+
+    Raises:
+        FileNotFoundError: If a glob pattern matches no partials.
+        ValueError: If a path is not a partial store, the size ranges of the partials differ or a
+            sampled result is to be saved as partial.
+    """
+    if isinstance(partials, str):
+        pattern = partials
+        partials = sorted(glob.glob(pattern))
+        if not partials:
+            raise FileNotFoundError(f"No partials match '{pattern}'.")
+    if sample_size is not None and count_table_format == 'partial' and count_table_path is not None:
+        raise ValueError("Partials need full distributions. Save the merged table without sample_size.")
+
+    parts = [_read_partial(path) for path in partials]
+    ranges = {(meta['min_size'], meta['max_size']) for meta, *_ in parts}
+    if len(ranges) > 1:
+        raise ValueError(f"The partials cover different size ranges: {sorted(ranges)}")
+    min_size = ranges.pop()[0]
+
+    stats, dists = _merge_histograms(np.concatenate([part[1] for part in parts]),
+                                     np.concatenate([part[2] for part in parts]),
+                                     np.concatenate([part[3] for part in parts]),
+                                     sparse.vstack([part[4] for part in parts], format='csr'))
+    if sample_size is not None:
+        dists = _sample_histograms(dists, sample_size, seed=seed)
+
+    if count_table_path is not None:
+        write_count_table(stats, count_table_path, format=count_table_format, min_size=min_size, dists=dists)
+
+    return _format_output(stats, dists, output)
+
+
+@beartype
+def get_distribution(
+    source: str | Path | FragmentStore,
+    barcode: str,
+    min_size: int = 0,
+    max_size: int = 1000
+) -> np.ndarray:
+    """
+    Look up the size distribution of a single barcode without loading the whole count table.
+
+    Args:
+        source: Fragments database of insert_bed_to_duckdb (path or open FragmentStore) or count
+            table written by write_count_table.
+        barcode: Barcode to look up.
+        min_size: Minimum size threshold (databases only, count tables keep their size range).
+        max_size: Maximum size threshold (databases only).
+
+    Returns:
+        1D int32 array with the counts per size
+    """
+    return get_distributions(source, [barcode], min_size=min_size, max_size=max_size)[1][0]
+
+
+@beartype
+def get_distributions(
+    source: str | Path | FragmentStore,
+    barcodes: List[str],
+    min_size: int = 0,
+    max_size: int = 1000
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Look up the size distributions of selected barcodes without loading the whole count table.
+
+    Databases are queried through FragmentStore.distributions. 'npy' stores only read the barcode
+    index and the requested rows of the memory-mapped distributions; Parquet count tables only read
+    the row groups whose barcode statistics match. TSV count tables have to be read completely.
+
+    Args:
+        source: Fragments database of insert_bed_to_duckdb (path or open FragmentStore) or count
+            table written by write_count_table.
+        barcodes: Barcodes to look up.
+        min_size: Minimum size threshold (databases only, count tables keep their size range).
+        max_size: Maximum size threshold (databases only).
+
+    Returns:
+        stats: DataFrame with insertsize_count and mean_insertsize in the order of barcodes
+        dists: Dense int32 array (barcodes x sizes)
+
+    Raises:
+        KeyError: If a barcode is not found.
+    """
+    if isinstance(source, FragmentStore):
+        return source.distributions(barcodes, min_size=min_size, max_size=max_size)
+    if _is_duckdb_file(source):
+        with FragmentStore(source) as store:
+            return store.distributions(barcodes, min_size=min_size, max_size=max_size)
+
+    path = str(source)
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'barcodes.txt')) as f:
+            index = pd.Index(f.read().splitlines())
+        rows = index.get_indexer(barcodes)
+        _check_found(barcodes, rows, path)
+
+        if os.path.isfile(os.path.join(path, 'dist.npz')):
+            dists = sparse.load_npz(os.path.join(path, 'dist.npz')).tocsr()[rows].toarray()
+        else:
+            # fancy indexing a memory map only reads the pages of the requested rows
+            dists = np.load(os.path.join(path, 'dist.npy'), mmap_mode='r')[rows]
+        stats = pd.DataFrame({'insertsize_count': np.load(os.path.join(path, 'insertsize_count.npy'), mmap_mode='r')[rows],
+                              'mean_insertsize': np.load(os.path.join(path, 'mean_insertsize.npy'), mmap_mode='r')[rows]},
+                             index=pd.Index(barcodes, name='barcode'))
+        return stats, np.ascontiguousarray(dists, dtype=np.int32)
+
+    if path.endswith('.parquet'):
+        check_module('pyarrow')
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, filters=[('barcode', 'in', list(barcodes))])
+        dist_col = table.column('dist').combine_chunks()
+        dists = dist_col.values.to_numpy(zero_copy_only=False).reshape(len(dist_col), dist_col.type.list_size)
+        stats = pd.DataFrame({'insertsize_count': table.column('insertsize_count').to_numpy(),
+                              'mean_insertsize': table.column('mean_insertsize').to_numpy()},
+                             index=pd.Index(table.column('barcode').to_pylist(), name='barcode'))
+    else:
+        stats, dists = read_count_table(path)
+
+    rows = stats.index.get_indexer(barcodes)
+    _check_found(barcodes, rows, path)
+
+    return stats.iloc[rows].rename_axis('barcode'), np.ascontiguousarray(dists[rows], dtype=np.int32)
+
+
+class _ProfiledConnection:
+    """
+    Wrap a DuckDB connection and collect the profile of every executed query.
+
+    Results of SELECT statements are fetched lazily, so the profile of a query is collected
+    when the next query is executed or the connection is closed.
+    """
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, config: DuckDBConfig):
+        self._con = con
+        self._config = config
+        self._pending = False
+        self.profiles = []
+        con.execute("PRAGMA enable_profiling='no_output'")
+        con.execute("SET profiling_mode='detailed'")
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def _collect(self) -> None:
+        if self._pending:
+            profile = json.loads(self._con.get_profiling_information(format='json'))
+            if profile.get('query_name'):
+                self.profiles.append(profile)
+            self._pending = False
+
+    def execute(self, query: str, parameters=None) -> duckdb.DuckDBPyConnection:
+        self._collect()
+        result = self._con.execute(query, parameters)
+        self._pending = True
+        return result
+
+    def close(self) -> None:
+        self._collect()
+        report = {'config': {key: str(value) if isinstance(value, Path) else value
+                             for key, value in asdict(self._config).items()},
+                  'queries': [{'query': profile['query_name'].strip(),
+                               'latency': profile.get('latency'),
+                               'cpu_time': profile.get('cpu_time'),
+                               'rows_returned': profile.get('rows_returned'),
+                               'peak_buffer_memory': profile.get('system_peak_buffer_memory'),
+                               'peak_temp_dir_size': profile.get('system_peak_temp_dir_size'),
+                               'plan': profile.get('children', [])}
+                              for profile in self.profiles]}
+        with open(self._config.profile_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        self._con.close()
+
+
+# Connection type accepted by the helpers below
+DuckDBConnection = Union[duckdb.DuckDBPyConnection, _ProfiledConnection]
+
+
+def _connect(config: DuckDBConfig, db_path: Optional[str] = None, read_only: bool = False) -> DuckDBConnection:
+    """Open a DuckDB connection with the resource settings of config, wrapped for profiling if requested."""
+    con = duckdb.connect(db_path if db_path is not None else ':memory:', read_only=read_only)
+    con.execute(f"SET memory_limit='{config.memory_limit}'")
+    con.execute(f"SET preserve_insertion_order={str(config.preserve_insertion_order).lower()}")
+    if config.threads is not None:
+        con.execute(f"SET threads={config.threads}")
+    if config.temp_directory is not None:
+        con.execute(f"SET temp_directory={_sql_str(config.temp_directory)}")
+
+    if config.profile_path is not None:
+        return _ProfiledConnection(con, config)
+    return con
+
+
+def _format_output(
+    stats: pd.DataFrame,
+    dists: sparse.csr_matrix,
+    output: Literal['dataframe', 'sparse', 'numpy']
+) -> pd.DataFrame | Tuple[pd.DataFrame, sparse.csr_matrix | np.ndarray]:
+    """Return histograms built by _sparse_count_table in the output layout requested by the caller."""
+    if output == 'sparse':
+        return stats, dists
+    if output == 'numpy':
+        # filled straight from the CSR buffers, no per-row Python objects
+        return stats, dists.toarray(order='C')
+
+    stats['dist'] = list(_iter_dense_rows(dists))
+    return stats
+
+
+def _dists_to_matrix(dists: pd.Series) -> np.ndarray:
+    """Stack a column of per-barcode distributions into a 2D int32 array."""
+    if len(dists) == 0:
+        return np.zeros((0, 0), dtype=np.int32)
+
+    return np.ascontiguousarray(np.stack(dists.to_numpy()), dtype=np.int32)
+
+
+def _iter_dense_rows(dists: np.ndarray | sparse.spmatrix, chunk_size: int = DENSE_CHUNK_SIZE):
+    """Yield the rows of dense or sparse distributions, densifying at most chunk_size rows at once."""
+    for start in range(0, dists.shape[0], chunk_size):
+        chunk = dists[start:start + chunk_size]
+        yield from (chunk.toarray() if sparse.issparse(chunk) else chunk)
+
+
+@beartype
+def _sparse_count_table(
+    con: DuckDBConnection,
+    source: str,
+    size_expr: str,
+    min_size: int,
+    max_size: int,
+    n_fragments: Optional[str] = None,
+    sample_size: Optional[int] = None,
+    sample_key: Optional[str] = None,
+    seed: int = 42
+) -> Tuple[pd.DataFrame, sparse.csr_matrix]:
+    """
+    Aggregate fragments into (barcode, size, count) triplets and return them as CSR matrix.
+
+    Only sizes that occur are materialized, so no barcode x size cross join is needed.
+
+    With sample_size, the distribution of every barcode is built from a uniform sample (without
+    replacement) of at most sample_size of its fragments, drawn during the aggregation: every
+    fragment gets the key hash(sample_key, seed) and the fragments with the sample_size smallest
+    keys are kept (bottom-k sample). The sample only depends on the fragments and the seed, not on
+    the number of threads or the order of the input. insertsize_count and mean_insertsize are
+    computed from all fragments.
+
+    Args:
+        con: Open DuckDB connection.
+        source: Table or view with barcode and count columns.
+        size_expr: SQL expression computing the fragment size from the source columns.
+        min_size: Minimum size threshold
+        max_size: Maximum size threshold
+        n_fragments: Column holding the number of fragments per row if the source is already
+            aggregated. By default every row is one fragment.
+        sample_size: Maximum number of fragments per barcode in the distributions.
+        sample_key: SQL expression identifying a fragment, e.g. 'chrom, start, "end"'. Required
+            with sample_size.
+        seed: Seed of the sample.
+
+    Returns:
+        stats: DataFrame indexed by barcode with insertsize_count and mean_insertsize
+        dists: CSR matrix (barcodes x sizes) with the rows in the order of stats
+
+    Raises:
+        ValueError: If sample_size is combined with an aggregated source or given without sample_key.
+    """
+    if sample_size is None:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE size_counts AS
+            SELECT
+                barcode,
+                {size_expr} AS size,
+                {f"SUM({n_fragments})" if n_fragments else "COUNT(*)"} AS n_fragments,
+                SUM(count) AS n_reads
+            FROM {source}
+            WHERE {size_expr} BETWEEN ? AND ?
+            GROUP BY ALL
+        """, [min_size, max_size])
+
+        con.execute("""
+            CREATE OR REPLACE TEMP TABLE barcode_stats AS
+            SELECT
+                barcode,
+                CAST(ROW_NUMBER() OVER (ORDER BY barcode) - 1 AS INTEGER) AS barcode_idx,
+                CAST(SUM(n_reads) AS BIGINT) AS insertsize_count,
+                SUM(size * n_fragments) / SUM(n_fragments) AS mean_insertsize
+            FROM size_counts
+            GROUP BY barcode
+        """)
+    else:
+        if n_fragments is not None or sample_key is None:
+            raise ValueError("Sampling needs a source with one row per fragment and a sample_key.")
+
+        # one pass: full statistics and the bottom-k sample of every barcode
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE barcode_sample AS
+            SELECT
+                barcode,
+                CAST(ROW_NUMBER() OVER (ORDER BY barcode) - 1 AS INTEGER) AS barcode_idx,
+                CAST(SUM(count) AS BIGINT) AS insertsize_count,
+                AVG({size_expr}) AS mean_insertsize,
+                min_by({size_expr}, hash({sample_key}, ?), ?) AS sizes
+            FROM {source}
+            WHERE {size_expr} BETWEEN ? AND ?
+            GROUP BY barcode
+        """, [seed, sample_size, min_size, max_size])
+
+        con.execute("""
+            CREATE OR REPLACE TEMP TABLE size_counts AS
+            SELECT barcode, size, COUNT(*) AS n_fragments
+            FROM (SELECT barcode, UNNEST(sizes) AS size FROM barcode_sample)
+            GROUP BY ALL
+        """)
+        con.execute("""
+            CREATE OR REPLACE TEMP TABLE barcode_stats AS
+            SELECT barcode, barcode_idx, insertsize_count, mean_insertsize FROM barcode_sample
+        """)
+        con.execute("DROP TABLE barcode_sample")
+
+    stats = con.execute("""
+        SELECT barcode, insertsize_count, mean_insertsize
+        FROM barcode_stats
+        ORDER BY barcode_idx
+    """).df().set_index('barcode')
+
+    triplets = con.execute("""
+        SELECT b.barcode_idx, CAST(s.size - ? AS INTEGER) AS bin, CAST(s.n_fragments AS INTEGER) AS n
+        FROM size_counts s
+        JOIN barcode_stats b USING (barcode)
+    """, [min_size]).fetchnumpy()
+
+    dists = sparse.csr_matrix((triplets['n'], (triplets['barcode_idx'], triplets['bin'])),
+                              shape=(len(stats), max_size - min_size + 1), dtype=np.int32)
+
+    con.execute("DROP TABLE size_counts")
+    con.execute("DROP TABLE barcode_stats")
+
+    return stats, dists
+
+
+def _sample_histograms(dists: sparse.csr_matrix, sample_size: int, seed: int = 42) -> sparse.csr_matrix:
+    """
+    Draw a uniform sample without replacement of at most sample_size fragments from every histogram.
+
+    Used for inputs that are aggregated outside of DuckDB (numpy backend, BAM files).
+    """
+    rng = np.random.default_rng(seed)
+    dists = dists.tocsr(copy=True)
+    for row in np.flatnonzero(np.asarray(dists.sum(axis=1)).ravel() > sample_size):
+        values = dists.data[dists.indptr[row]:dists.indptr[row + 1]]
+        values[:] = rng.multivariate_hypergeometric(values.astype(np.int64), sample_size)
+    dists.eliminate_zeros()
+
+    return dists
+
+
+def _create_fragment_schema(con: DuckDBConnection) -> None:
+    """
+    Create the tables used by insert_bed_to_duckdb.
+
+    Barcodes and chromosomes are dictionary encoded: fragments only stores their integer IDs,
+    the strings live in the barcodes and chroms tables. Lookup tables are used instead of ENUMs
+    as ENUM types cannot be extended when later files add new chromosomes.
+    """
+    existing = con.execute("""
+        SELECT table_name FROM information_schema.tables WHERE table_schema = 'main'
+    """).df()['table_name'].tolist()
+    if 'fragments' in existing and ('manifest' not in existing or 'barcodes' not in existing):
+        raise ValueError("The database was created by an older peakqc version with a different schema. "
+                         "Please ingest the fragment files into a new database.")
+
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS manifest (
+            file_id INTEGER PRIMARY KEY,
+            path VARCHAR UNIQUE,
+            size BIGINT,
+            mtime DOUBLE,
+            sha256 VARCHAR,
+            params VARCHAR,
+            n_fragments BIGINT,
+            ingested_at TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS barcodes (
+            barcode_id INTEGER PRIMARY KEY,
+            barcode VARCHAR UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS chroms (
+            chrom_id SMALLINT PRIMARY KEY,
+            chrom VARCHAR UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS fragments (
+            file_id INTEGER,
+            barcode_id INTEGER,
+            chrom_id SMALLINT,
+            start INTEGER,
+            "end" INTEGER,
+            size SMALLINT,
+            count INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS count_table (
+            file_id INTEGER,
+            barcode VARCHAR,
+            insertsize_count BIGINT,
+            mean_insertsize DOUBLE,
+            dist INTEGER[]
+        );
+    """)
+
+
+def _insert_file_summary(con: DuckDBConnection, file_id: int, min_size: int, max_size: int) -> None:
+    """Summarize the fragments of one ingested file into the count_table table."""
+    source = f"(SELECT barcode_id AS barcode, size, count FROM fragments WHERE file_id = {file_id})"
+    stats, dists = _sparse_count_table(con, source, 'size', min_size, max_size)
+    stats = _decode_barcodes(con, stats)
+    for offset in range(0, len(stats), DENSE_CHUNK_SIZE):
+        block = dists[offset:offset + DENSE_CHUNK_SIZE].toarray()
+        rows = stats.iloc[offset:offset + DENSE_CHUNK_SIZE]
+        summary = pd.DataFrame({'file_id': file_id,
+                                'barcode': rows.index,
+                                'insertsize_count': rows['insertsize_count'].to_numpy(),
+                                'mean_insertsize': rows['mean_insertsize'].to_numpy(),
+                                'dist': list(block)})
+        con.register('summary_df', summary)
+        con.execute("INSERT INTO count_table SELECT * FROM summary_df")
+        con.unregister('summary_df')
+
+
+def _decode_barcodes(con: DuckDBConnection, stats: pd.DataFrame) -> pd.DataFrame:
+    """Replace the barcode_id index of stats by the barcode strings of the barcodes dictionary."""
+    names = con.execute("SELECT barcode_id, barcode FROM barcodes").df().set_index('barcode_id')['barcode']
+    stats.index = pd.Index(names.reindex(stats.index).to_numpy(), name='barcode')
+    return stats
+
+
+def _read_sample_sheet(sample_sheet: str | Path | pd.DataFrame | Dict[str, str]) -> pd.DataFrame:
+    """Normalize a sample sheet (file, DataFrame or sample -> path dictionary) to sample and absolute path columns."""
+    if isinstance(sample_sheet, dict):
+        sheet = pd.DataFrame({'sample': list(sample_sheet.keys()), 'path': list(sample_sheet.values())})
+    elif isinstance(sample_sheet, pd.DataFrame):
+        sheet = sample_sheet
+    else:
+        sheet = pd.read_csv(sample_sheet, sep=None, engine='python', dtype=str)
+    if not {'sample', 'path'}.issubset(sheet.columns):
+        raise ValueError("The sample sheet needs the columns 'sample' and 'path'.")
+
+    return pd.DataFrame({'sample': sheet['sample'].astype(str),
+                         'path': [os.path.abspath(path) for path in sheet['path']]})
+
+
+def _merge_histograms(
+    barcodes: np.ndarray,
+    insert_counts: np.ndarray,
+    size_sums: np.ndarray,
+    dists: sparse.csr_matrix
+) -> Tuple[pd.DataFrame, sparse.csr_matrix]:
+    """
+    Add up the rows of equal barcodes exactly; means are recomputed from the summed sizes.
+
+    Returns:
+        stats: DataFrame indexed by the sorted unique barcodes with insertsize_count and mean_insertsize
+        dists: CSR matrix (barcodes x sizes) with the rows in the order of stats
+    """
+    unique, inverse = np.unique(np.asarray(barcodes, dtype=str), return_inverse=True)
+    merge = sparse.csr_matrix((np.ones(len(inverse), dtype=np.int64), (inverse, np.arange(len(inverse)))),
+                              shape=(len(unique), len(inverse)))
+
+    dists = (merge @ dists).astype(np.int32).tocsr()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (merge @ size_sums.astype(np.int64)) / np.asarray(dists.sum(axis=1)).ravel()
+    stats = pd.DataFrame({'insertsize_count': merge @ insert_counts.astype(np.int64), 'mean_insertsize': means},
+                         index=pd.Index(unique.astype(object), name='barcode'))
+
+    return stats, dists
+
+
+def _read_partial(path: str | Path) -> Tuple[dict, np.ndarray, np.ndarray, np.ndarray, sparse.csr_matrix]:
+    """Read meta data, barcodes, insertsize_count, size sums and distributions of a partial store."""
+    path = str(path)
+    meta_path = os.path.join(path, 'meta.json')
+    meta = {}
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta.get('format') != COUNT_TABLE_FORMAT or meta.get('kind') != 'partial':
+        raise ValueError(f"'{path}' is not a partial count table (see write_count_table format 'partial').")
+
+    with open(os.path.join(path, 'barcodes.txt')) as f:
+        barcodes = np.asarray(f.read().splitlines(), dtype=object)
+    dists = sparse.load_npz(os.path.join(path, 'dist.npz')).tocsr()
+
+    return (meta, barcodes, np.load(os.path.join(path, 'insertsize_count.npy')),
+            np.load(os.path.join(path, 'size_sum.npy')), dists)
+
+
+def _reorder_distributions(
+    stats: pd.DataFrame,
+    dists: sparse.csr_matrix,
+    barcodes: List[str],
+    n_bins: int
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Return looked up distributions in the requested barcode order; barcodes without fragments in range get empty rows."""
+    rows = stats.index.get_indexer(barcodes)
+    found = rows >= 0
+
+    result = np.zeros((len(barcodes), n_bins), dtype=np.int32)
+    result[found] = dists[rows[found]].toarray()
+    stats = stats.reindex(barcodes)
+    stats['insertsize_count'] = stats['insertsize_count'].fillna(0).astype(np.int64)
+    return stats.rename_axis('barcode'), result
+
+
+def _check_found(barcodes: List[str], rows: np.ndarray, path: str) -> None:
+    """Raise a KeyError naming the barcodes that were not found (rows of -1)."""
+    if (rows < 0).any():
+        missing = [barcode for barcode, row in zip(barcodes, rows) if row < 0]
+        raise KeyError(f"Barcodes not found in '{path}': {missing[:10]}")
+
+
+def _is_duckdb_file(path: str | Path) -> bool:
+    """Check for the magic bytes of a DuckDB database file."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(12)[8:12] == b'DUCK'
+
+
+def _file_sha256(path: str, block_size: int = 1 << 24) -> str:
+    """Hash a file (or all files of a fragment store) in blocks without loading it into memory."""
+    digest = hashlib.sha256()
+    for file in _store_files(path) if _is_fragment_store(path) else [path]:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _path_stat(path: str | Path) -> os.stat_result | SimpleNamespace:
+    """Stat a fragment file; for fragment stores the total size and the latest mtime of its files."""
+    if not _is_fragment_store(path):
+        return os.stat(path)
+
+    stats = [os.stat(file) for file in _store_files(path)]
+    latest = max(stats, key=lambda stat: stat.st_mtime_ns)
+    return SimpleNamespace(st_size=sum(stat.st_size for stat in stats), st_mtime=latest.st_mtime,
+                           st_mtime_ns=latest.st_mtime_ns)
+
+
+def _is_fragment_store(path: str | Path) -> bool:
+    """Check if a path is a Parquet fragment store written by fragments_to_parquet."""
+    return os.path.isdir(path) and len(_store_files(path)) > 0
+
+
+def _store_files(path: str | Path) -> List[str]:
+    """List the Parquet files of a fragment store."""
+    return sorted(glob.glob(os.path.join(str(path), '**', '*.parquet'), recursive=True))
+
+
+@beartype
+def _resolve_barcodes(
+    barcodes: Optional[List[str] | str | Path | ad.AnnData],
+    barcode_col: Optional[str] = None
+) -> Optional[List[str]]:
+    """
+    Turn a barcode whitelist given as list, file or AnnData object into a list of barcodes.
+
+    Args:
+        barcodes: List of barcodes, path to a text file with one barcode per line or AnnData object.
+        barcode_col: Column of adata.obs holding the barcodes. Defaults to the obs index.
+
+    Returns:
+        List of barcodes or None if no whitelist was given.
+    """
+    if barcodes is None:
+        return None
+    if isinstance(barcodes, ad.AnnData):
+        return (barcodes.obs[barcode_col] if barcode_col else barcodes.obs.index).astype(str).tolist()
+    if isinstance(barcodes, (str, Path)):
+        with open(barcodes) as f:
+            return [line.strip() for line in f if line.strip()]
+    return list(barcodes)
+
+
+def _scan_groups(paths: List[str], regions: Optional[str | List[str]] = None) -> List[List[str]]:
+    """Group fragment files into multi-file scans: one per compression type, indexed region queries and stores per file."""
+    scans = {}
+    for path in paths:
+        if _is_fragment_store(path) or (regions is not None and _is_gz_file(path) and _has_tabix_index(path)):
+            scans[path] = [path]
+        else:
+            scans.setdefault(_is_gz_file(path), []).append(path)
+    return list(scans.values())
+
+
+def _register_barcodes(
+    con: DuckDBConnection,
+    barcodes: Optional[List[str] | str | Path | ad.AnnData],
+    barcode_col: Optional[str] = None
+) -> bool:
+    """Store a barcode whitelist as temporary table barcode_whitelist. Returns False if no whitelist was given."""
+    barcodes = _resolve_barcodes(barcodes, barcode_col=barcode_col)
+    if barcodes is None:
+        return False
+
+    whitelist = pd.DataFrame({'barcode': pd.unique(pd.Series(barcodes, dtype=object))})
+    con.register('_barcode_df', whitelist)
+    con.execute("CREATE OR REPLACE TEMP TABLE barcode_whitelist AS SELECT barcode::VARCHAR AS barcode FROM _barcode_df")
+    con.unregister('_barcode_df')
+    return True
+
+
+def _cache_key(fragments: str | Path, **params) -> str:
+    """Hash the identity of a fragment file (path, size, mtime) together with the histogram parameters."""
+    path = os.path.abspath(fragments)
+    stat = _path_stat(path)
+    identity = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': COUNT_TABLE_VERSION}
+    if params.get('barcodes') is not None:
+        params['barcodes'] = hashlib.sha256('\n'.join(sorted(params['barcodes'])).encode()).hexdigest()
+    return hashlib.sha256(json.dumps({**identity, **params}, sort_keys=True).encode()).hexdigest()
+
+
+def _cache_load(cache_dir: str | Path, key: str) -> Optional[Tuple[pd.DataFrame, np.ndarray | sparse.csr_matrix]]:
+    """Load a cached count table and mark it as recently used. Returns None on a cache miss."""
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(entry, 'meta.json')):
+        return None
+    os.utime(entry)
+    stats, dists = read_count_table(entry, mmap=False)
+    return stats, sparse.csr_matrix(dists)
+
+
+def _cache_store(
+    cache_dir: str | Path,
+    key: str,
+    stats: pd.DataFrame,
+    dists: sparse.csr_matrix,
+    min_size: int,
+    size_limit: int
+) -> None:
+    """Write a count table into the cache and evict least recently used entries beyond size_limit."""
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    # write to a temporary directory first, so readers never see a partial entry
+    tmp_entry = f"{entry}.tmp{os.getpid()}"
+    write_count_table(stats, tmp_entry, format='npy', min_size=min_size, dists=dists)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # stored concurrently by another process
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name == key or not os.path.isfile(os.path.join(path, 'meta.json')):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.stat(path).st_mtime, size, path))
+
+    total = sum(size for _, size, _ in entries) + sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+    for _, size, path in sorted(entries):
+        if total <= size_limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _natural_key(chrom: str) -> List[str | int]:
+    """Sort key ordering chromosome names naturally (chr2 before chr10)."""
+    return [int(token) if token.isdigit() else token for token in re.split(r'(\d+)', chrom)]
+
+
+def _sql_str(value: str | Path) -> str:
+    """Quote a value as SQL string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+@beartype
+def _parse_regions(regions: Optional[str | List[str]]) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    """
+    Parse samtools style regions into sorted, merged (chrom, start, end) tuples.
+
+    Args:
+        regions: Region string(s) like 'chr1' or 'chr1:1-100000' (1-based, inclusive).
+
+    Returns:
+        List of (chrom, start, end) with 0-based half-open coordinates. start and end are
+        None for whole chromosomes.
+
+    Raises:
+        ValueError: If a region string cannot be parsed.
+    """
+    if regions is None:
+        return []
+    if isinstance(regions, str):
+        regions = [regions]
+
+    parsed = {}
+    for region in regions:
+        match = re.fullmatch(r"([^:\s]+)(?::([\d,]+)-([\d,]+))?", region.strip())
+        if match is None:
+            raise ValueError(f"Could not parse region '{region}'. Expected 'chrom' or 'chrom:start-end'.")
+        chrom, start, end = match.groups()
+        if start is None:
+            parsed[chrom] = [(None, None)]
+        elif parsed.get(chrom) != [(None, None)]:
+            parsed.setdefault(chrom, []).append((int(start.replace(',', '')) - 1, int(end.replace(',', ''))))
+
+    merged = []
+    for chrom, intervals in parsed.items():
+        if intervals == [(None, None)]:
+            merged.append((chrom, None, None))
+            continue
+        intervals.sort()
+        cur_start, cur_end = intervals[0]
+        for start, end in intervals[1:]:
+            if start <= cur_end:
+                cur_end = max(cur_end, end)
+            else:
+                merged.append((chrom, cur_start, cur_end))
+                cur_start, cur_end = start, end
+        merged.append((chrom, cur_start, cur_end))
+
+    return merged
+
+
+def _read_bed_regions(bed: str | Path) -> pd.DataFrame:
+    """Read chrom, start and end of a (gzip compressed) BED file."""
+    return pd.read_csv(bed, sep='\t', header=None, usecols=range(3), names=['chrom', 'start', 'end'],
+                       dtype={'chrom': str, 'start': np.int64, 'end': np.int64}, comment='#')
+
+
+def _merge_intervals(regions: pd.DataFrame) -> pd.DataFrame:
+    """Sort BED intervals and merge overlapping or book-ended intervals per chromosome."""
+    merged = []
+    for chrom, group in regions.sort_values(['chrom', 'start']).groupby('chrom', sort=False):
+        starts = group['start'].to_numpy()
+        ends = group['end'].to_numpy()
+        # a new interval begins where the start lies behind every previous end
+        is_first = np.ones(len(starts), dtype=bool)
+        is_first[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1]
+        first = np.flatnonzero(is_first)
+        merged.append(pd.DataFrame({'chrom': chrom, 'start': starts[first],
+                                    'end': np.maximum.reduceat(ends, first)}))
+
+    if not merged:
+        return pd.DataFrame({'chrom': pd.Series(dtype=str), 'start': pd.Series(dtype=np.int64),
+                             'end': pd.Series(dtype=np.int64)})
+    return pd.concat(merged, ignore_index=True)
+
+
+def _has_tabix_index(fragments: str) -> bool:
+    """Check whether a tabix (.tbi) or CSI (.csi) index exists next to the fragment file."""
+    return os.path.isfile(fragments + '.tbi') or os.path.isfile(fragments + '.csi')
+
+
+@beartype
+def _register_fragments(
+    con: DuckDBConnection,
+    fragments: str | Path | List[str],
+    regions: Optional[str | List[str]] = None,
+    barcodes: bool = False,
+    explicit_schema: bool = False,
+    name: str = 'fragment_src'
+) -> str:
+    """
+    Expose fragment file(s) as temporary view or table with columns chrom, start, end, barcode, count and filename.
+
+    gzip/bgzip files are detected with peakqc.general._is_gz_file. If regions are given and the file
+    is bgzip compressed with a tabix index, only the index blocks of these regions are read. Otherwise
+    the regions are applied as filter on a full scan. Several files are read in a single multi-file
+    scan and must share the same compression. A Parquet fragment store (see fragments_to_parquet)
+    is read on its own; its chromosome partitions are pruned by the regions.
+
+    Args:
+        con: Open DuckDB connection.
+        fragments: Path to the fragment file or store, or list of paths.
+        regions: Optional region(s) to restrict the fragments to.
+        barcodes: Keep only barcodes of the barcode_whitelist table (see _register_barcodes).
+        explicit_schema: Use the fixed fragment schema instead of sniffing the file (see DuckDBConfig).
+        name: Name of the created view or table.
+
+    Returns:
+        Name of the created view or table.
+
+    Raises:
+        ValueError: If a fragment store is scanned together with other files.
+    """
+    files = [str(f) for f in fragments] if isinstance(fragments, list) else [str(fragments)]
+    parsed_regions = _parse_regions(regions)
+
+    if any(_is_fragment_store(f) for f in files):
+        if len(files) > 1:
+            raise ValueError("A fragment store has to be read on its own, not in a multi-file scan.")
+        _drop_relation(con, name)
+        con.execute(f"""
+            CREATE OR REPLACE TEMP VIEW {name} AS
+            SELECT chrom, start, "end", barcode, count, {_sql_str(files[0])} AS filename
+            FROM read_parquet({_sql_str(os.path.join(files[0], '**', '*.parquet'))}, hive_partitioning=true,
+                              hive_types={{'sample': VARCHAR, 'chrom': VARCHAR}})
+            {_scan_filter(parsed_regions, barcodes, columns=('chrom', 'start', '"end"', 'barcode'))}
+        """)
+        return name
+
+    compressed = _is_gz_file(files[0])
+
+    if len(files) == 1 and parsed_regions and compressed and _has_tabix_index(files[0]):
+        _load_tabix_regions(con, files[0], parsed_regions, name, barcodes=barcodes)
+        return name
+
+    if explicit_schema:
+        columns = ", ".join(f"'column{i}': '{dtype}'" for i, dtype in enumerate(FRAGMENT_SCHEMA))
+        read_options = (f"comment='#', quote='', escape='', strict_mode=false, auto_detect=false, "
+                        f"columns={{{columns}}}")
+    else:
+        read_options = "auto_detect=true"
+
+    _drop_relation(con, name)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP VIEW {name} AS
+        SELECT
+            column0 AS chrom,
+            CAST(column1 AS INTEGER) AS start,
+            CAST(column2 AS INTEGER) AS "end",
+            column3 AS barcode,
+            CAST(column4 AS INTEGER) AS count,
+            filename
+        FROM read_csv([{', '.join(_sql_str(f) for f in files)}], delim='\\t', header=False,
+                      filename=true, compression='{'gzip' if compressed else 'none'}', {read_options})
+        {_scan_filter(parsed_regions, barcodes)}
+    """)
+
+    return name
+
+
+def _drop_relation(con: DuckDBConnection, name: str) -> None:
+    """Drop a view or table regardless of which of the two it is."""
+    for kind in ('VIEW', 'TABLE'):
+        try:
+            con.execute(f"DROP {kind} IF EXISTS {name}")
+        except duckdb.CatalogException:
+            pass
+
+
+def _scan_filter(
+    regions: List[Tuple[str, Optional[int], Optional[int]]],
+    barcodes: bool = False,
+    columns: Tuple[str, str, str, str] = ('column0', 'column1', 'column2', 'column3')
+) -> str:
+    """Build a WHERE clause keeping fragments that overlap any of the parsed regions and belong to whitelisted barcodes."""
+    clauses = [_region_condition(regions, *columns[:3])] if regions else []
+    if barcodes:
+        # semi-join, so the whitelist is applied inside the scan
+        clauses.append(f"{columns[3]} IN (SELECT barcode FROM barcode_whitelist)")
+
+    return "WHERE " + " AND ".join(clauses) if clauses else ""
+
+
+def _region_condition(
+    regions: List[Tuple[str, Optional[int], Optional[int]]],
+    chrom_col: str,
+    start_col: str,
+    end_col: str
+) -> str:
+    """Build a SQL condition matching fragments that overlap any of the parsed regions."""
+    conditions = []
+    for chrom, start, end in regions:
+        if start is None:
+            conditions.append(f"{chrom_col} = {_sql_str(chrom)}")
+        else:
+            conditions.append(f"({chrom_col} = {_sql_str(chrom)} AND CAST({end_col} AS INTEGER) > {start} "
+                              f"AND CAST({start_col} AS INTEGER) < {end})")
+
+    return "(" + " OR ".join(conditions) + ")"
+
+
+def _load_tabix_regions(
+    con: DuckDBConnection,
+    fragments: str,
+    regions: List[Tuple[str, Optional[int], Optional[int]]],
+    name: str,
+    barcodes: bool = False
+) -> None:
+    """Fetch the regions of an indexed bgzip fragment file into a temporary DuckDB table."""
+    _drop_relation(con, name)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {name} (
+            chrom VARCHAR,
+            start INTEGER,
+            "end" INTEGER,
+            barcode VARCHAR,
+            count INTEGER,
+            filename VARCHAR
+        )
+    """)
+
+    semi_join = "WHERE barcode IN (SELECT barcode FROM barcode_whitelist)" if barcodes else ""
+
+    def insert(lines):
+        chunk = pd.read_csv(io.StringIO('\n'.join(lines)), sep='\t', header=None, usecols=range(5),
+                            names=['chrom', 'start', 'end', 'barcode', 'count'],
+                            dtype={'chrom': str, 'barcode': str})
+        con.register('_tabix_chunk', chunk)
+        con.execute(f"INSERT INTO {name} SELECT *, ? FROM _tabix_chunk {semi_join}", [fragments])
+        con.unregister('_tabix_chunk')
+
+    with pysam.TabixFile(fragments) as tbx:
+        contigs = set(tbx.contigs)
+        prev_chrom, prev_end = None, None
+        for chrom, start, end in regions:
+            if chrom not in contigs:
+                continue
+            # fragments overlapping the previous (merged) region of the chromosome were already fetched
+            min_start = prev_end if chrom == prev_chrom else None
+            lines = []
+            for line in tbx.fetch(chrom, start, end):
+                if min_start is not None and int(line.split('\t', 2)[1]) < min_start:
+                    continue
+                lines.append(line)
+                if len(lines) >= TABIX_CHUNK_SIZE:
+                    insert(lines)
+                    lines = []
+            if lines:
+                insert(lines)
+            prev_chrom, prev_end = chrom, end
+
+
+def _stats_from_sparse(
+    barcodes: List[str],
+    dists: sparse.csr_matrix,
+    size_sums: np.ndarray
+) -> pd.DataFrame:
+    """
+    Build the statistics of a count table from (barcodes x sizes) histograms and per-barcode size sums.
+
+    Every barcode has at least one fragment in the size range, the rows are in the order of barcodes.
+    """
+    insert_counts = np.asarray(dists.sum(axis=1), dtype=np.int64).ravel()
+
+    return pd.DataFrame({'insertsize_count': insert_counts,
+                         'mean_insertsize': size_sums / insert_counts},
+                        index=pd.Index(np.asarray(barcodes, dtype=object), name='barcode'))
+
+
+def _bam_chunks(
+    bamfile: str,
+    regions: List[Tuple[str, Optional[int], Optional[int]]]
+) -> List[Tuple[Optional[str], Optional[int], Optional[int]]]:
+    """Split a BAM file into (chrom, start, end) work units using its index."""
+    with open_bam(bamfile, 'rb', verbosity=0) as bam:
+        if not bam.has_index():
+            # without an index the file can only be read sequentially
+            return [(None, None, None)]
+
+        if regions:
+            return [region for region in regions if region[0] in bam.references]
+
+        return [(stat.contig, None, None) for stat in bam.get_index_statistics() if stat.mapped > 0]
+
+
+def _init_bam_worker(barcodes: Optional[List[str]]) -> None:
+    """Share the barcode whitelist with the BAM worker processes."""
+    global bam_barcodes
+    bam_barcodes = set(barcodes) if barcodes is not None else None
+
+
+def _bam_worker(
+    task: Tuple[str, str, Optional[str], Optional[int], Optional[int], Optional[str], Optional[str], int, int, int, int, int]
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count fragment sizes of one BAM work unit.
+
+    The histogram is kept as flat keys (row * n_bins + size bin) with counts, as in _numpy_worker,
+    so memory grows with the number of distinct (label, size) pairs instead of labels x sizes.
+
+    Returns:
+        labels: Barcodes or sample labels of the rows
+        rows, bins, counts: Histogram triplets, rows index labels
+        size_sums: Sum of the fragment sizes per label
+    """
+    (bamfile, file_label, chrom, start, end, barcode_tag, sample_label, min_mapq, max_distance,
+     min_size, max_size, chunk_size) = task
+    n_bins = max_size - min_size + 1
+    barcodes = globals().get('bam_barcodes')
+
+    label_index = {}
+    keys, key_counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    size_sums = np.zeros(0, dtype=np.int64)
+    buffer_rows, buffer_sizes = [], []
+
+    def flush():
+        nonlocal size_sums
+        size_sums = np.concatenate([size_sums, np.zeros(len(label_index) - len(size_sums), dtype=np.int64)])
+        rows = np.asarray(buffer_rows, dtype=np.int64)
+        sizes = np.asarray(buffer_sizes, dtype=np.int64)
+        np.add.at(size_sums, rows, sizes)
+
+        chunk_keys, chunk_counts = _sum_keys(rows * n_bins + sizes - min_size, np.ones(len(rows), dtype=np.int64))
+        keys.append(chunk_keys)
+        key_counts.append(chunk_counts)
+        # merge the flushed keys once they outgrow the merged ones, which keeps the merging linear
+        if sum(map(len, keys[1:])) > max(len(keys[0]), chunk_size):
+            merged = _sum_keys(np.concatenate(keys), np.concatenate(key_counts))
+            keys[:], key_counts[:] = [merged[0]], [merged[1]]
+        buffer_rows.clear()
+        buffer_sizes.clear()
+
+    with open_bam(bamfile, 'rb', verbosity=0) as bam:
+        read_groups = {rg['ID']: rg.get('SM', rg['ID']) for rg in bam.header.to_dict().get('RG', [])}
+
+        reads = bam.fetch(until_eof=True) if chrom is None else bam.fetch(chrom, start, end)
+        for read in reads:
+            # properly paired, both mates mapped, primary non-duplicate alignments that pass QC, counted once per pair
+            if read.flag & 0xF0F != 0x3 or read.template_length <= 0:
+                continue
+            if start is not None and read.reference_start < start:
+                continue
+            if read.mapping_quality < min_mapq or (read.has_tag('MQ') and read.get_tag('MQ') < min_mapq):
+                continue
+            if read.template_length > max_distance:
+                continue
+
+            # sinto fragments span template_length - 9 bp, their size is 9 bp shorter as for fragment files
+            size = read.template_length - 18
+            if size < min_size or size > max_size:
+                continue
+
+            if sample_label == 'filename':
+                label = file_label
+            elif sample_label == 'read_group':
+                if not read.has_tag('RG'):
+                    continue
+                label = read_groups.get(read.get_tag('RG'), read.get_tag('RG'))
+            else:
+                if not read.has_tag(barcode_tag):
+                    continue
+                label = read.get_tag(barcode_tag)
+
+            if barcodes is not None and label not in barcodes:
+                continue
+
+            row = label_index.get(label)
+            if row is None:
+                row = label_index[label] = len(label_index)
+            buffer_rows.append(row)
+            buffer_sizes.append(size)
+
+            if len(buffer_rows) >= chunk_size:
+                flush()
+
+    flush()
+    keys, counts = _sum_keys(np.concatenate(keys), np.concatenate(key_counts))
+
+    return list(label_index), keys // n_bins, keys % n_bins, counts, size_sums
+
+
+def _numpy_count_table(
+    fragments: str,
+    min_size: int,
+    max_size: int,
+    regions: List[Tuple[str, Optional[int], Optional[int]]],
+    barcodes: Optional[List[str]],
+    n_workers: int,
+    chunk_size: int
+) -> Tuple[pd.DataFrame, sparse.csr_matrix]:
+    """
+    Count fragment sizes per barcode with worker processes instead of DuckDB.
+
+    Returns:
+        stats: DataFrame indexed by barcode with insertsize_count and mean_insertsize
+        dists: CSR matrix (barcodes x sizes) with the rows in the order of stats
+    """
+    n_bins = max_size - min_size + 1
+    if _is_gz_file(fragments):
+        # compressed files cannot be split, they are decompressed here and handed out in blocks
+        with gzip.open(fragments, 'rb') as f:
+            sources = _line_blocks(iter(lambda: f.read(chunk_size), b''))
+            results = _run_numpy_workers(sources, min_size, max_size, regions, barcodes, n_workers)
+    else:
+        n_ranges = max(n_workers, -(-os.path.getsize(fragments) // chunk_size))
+        sources = _byte_ranges(fragments, n_ranges)
+        results = _run_numpy_workers(sources, min_size, max_size, regions, barcodes, n_workers)
+
+    labels, rows, bins, n_fragments, reads, size_sums = results
+    order = np.argsort(np.asarray(labels, dtype=object), kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    dists = sparse.csr_matrix((n_fragments, (rank[rows], bins)), shape=(len(labels), n_bins), dtype=np.int32)
+    stats = pd.DataFrame({'insertsize_count': reads[order],
+                          'mean_insertsize': size_sums[order] / np.asarray(dists.sum(axis=1)).ravel()},
+                         index=pd.Index(np.asarray(labels, dtype=object)[order], name='barcode'))
+
+    return stats, dists
+
+
+def _run_numpy_workers(
+    sources,
+    min_size: int,
+    max_size: int,
+    regions: List[Tuple[str, Optional[int], Optional[int]]],
+    barcodes: Optional[List[str]],
+    n_workers: int
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Distribute byte ranges or blocks to _numpy_worker processes and sum their histograms.
+
+    At most two tasks per worker are pending, so decompressed blocks do not pile up in memory.
+
+    Returns:
+        labels: Barcodes in order of appearance
+        rows, bins, n_fragments: Histogram triplets, rows index labels
+        reads: Sum of the count column per label
+        size_sums: Sum of the fragment sizes per label
+    """
+    n_bins = max_size - min_size + 1
+    label_index = {}
+    keys, key_counts = [], []
+    reads = np.zeros(0, dtype=np.int64)
+    size_sums = np.zeros(0, dtype=np.int64)
+
+    def merge(result):
+        nonlocal reads, size_sums
+        labels, task_keys, task_counts, task_reads, task_sums = result
+        for label in labels:
+            label_index.setdefault(label, len(label_index))
+        grow = len(label_index) - len(reads)
+        reads = np.concatenate([reads, np.zeros(grow, dtype=np.int64)])
+        size_sums = np.concatenate([size_sums, np.zeros(grow, dtype=np.int64)])
+
+        rows = np.fromiter((label_index[label] for label in labels), dtype=np.int64, count=len(labels))
+        reads[rows] += task_reads
+        size_sums[rows] += task_sums
+        keys.append(rows[task_keys // n_bins] * n_bins + task_keys % n_bins)
+        key_counts.append(task_counts)
+
+    with mp.Pool(n_workers, initializer=_init_numpy_worker, initargs=(barcodes,)) as pool:
+        pending = deque()
+        for source in sources:
+            pending.append(pool.apply_async(_numpy_worker, ((source, min_size, max_size, regions),)))
+            if len(pending) >= 2 * n_workers:
+                merge(pending.popleft().get())
+        while pending:
+            merge(pending.popleft().get())
+
+    keys, n_fragments = _sum_keys(np.concatenate(keys or [np.zeros(0, dtype=np.int64)]),
+                                  np.concatenate(key_counts or [np.zeros(0, dtype=np.int64)]))
+
+    return list(label_index), keys // n_bins, keys % n_bins, n_fragments, reads, size_sums
+
+
+def _byte_ranges(path: str, n_ranges: int) -> List[Tuple[str, int, int]]:
+    """Split a plain text file into (path, start, end) byte ranges that begin at line starts."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_ranges):
+            f.seek(max(size * i // n_ranges, bounds[-1]))
+            # the line containing the split point belongs to the previous range
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+
+    return [(path, start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _line_blocks(chunks):
+    """Regroup raw byte chunks into blocks that end at line ends."""
+    rest = b''
+    for chunk in chunks:
+        block = rest + chunk
+        cut = block.rfind(b'\n') + 1
+        rest = block[cut:]
+        if cut:
+            yield block[:cut]
+    if rest:
+        yield rest
+
+
+def _sum_keys(keys: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum the counts of equal keys."""
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    return unique_keys, np.bincount(inverse, weights=counts, minlength=len(unique_keys)).astype(np.int64)
+
+
+def _init_numpy_worker(barcodes: Optional[List[str]]) -> None:
+    """Share the barcode whitelist with the numpy backend worker processes."""
+    global numpy_barcodes
+    numpy_barcodes = pd.Index(barcodes) if barcodes is not None else None
+
+
+def _numpy_worker(
+    task: Tuple[Tuple[str, int, int] | bytes, int, int, List[Tuple[str, Optional[int], Optional[int]]]]
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count fragment sizes of one byte range or block of a fragment file.
+
+    The histogram is kept as flat keys (row * n_bins + size bin) with counts, so barcodes that
+    occur in a single block do not need a full row.
+
+    Returns:
+        labels: Barcodes of the rows
+        keys: Flat histogram keys
+        counts: Number of fragments per key
+        reads: Sum of the count column per label
+        size_sums: Sum of the fragment sizes per label
+    """
+    source, min_size, max_size, regions = task
+    n_bins = max_size - min_size + 1
+    barcodes = globals().get('numpy_barcodes')
+
+    if isinstance(source, tuple):
+        path, start, end = source
+        with open(path, 'rb') as f:
+            f.seek(start)
+            source = f.read(end - start)
+
+    frags = _parse_fragment_block(source)
+    sizes = (frags['end'] - frags['start'] - 9).to_numpy()
+    keep = (sizes >= min_size) & (sizes <= max_size)
+    if regions:
+        keep &= _region_mask(frags, regions)
+    if barcodes is not None:
+        keep &= barcodes.get_indexer(frags['barcode']) >= 0
+
+    rows, labels = pd.factorize(frags['barcode'].to_numpy()[keep])
+    sizes = sizes[keep]
+    reads = np.bincount(rows, weights=frags['count'].to_numpy()[keep], minlength=len(labels)).astype(np.int64)
+    size_sums = np.bincount(rows, weights=sizes, minlength=len(labels)).astype(np.int64)
+    keys, counts = _sum_keys(rows.astype(np.int64) * n_bins + sizes - min_size, np.ones(len(rows), dtype=np.int64))
+
+    return list(labels), keys, counts, reads, size_sums
+
+
+def _parse_fragment_block(block: bytes) -> pd.DataFrame:
+    """Parse the chrom, start, end, barcode and count columns of a block of fragment lines."""
+    names = ['chrom', 'start', 'end', 'barcode', 'count']
+    if not block.strip():
+        return pd.DataFrame({name: pd.Series(dtype=object if name in ('chrom', 'barcode') else np.int64)
+                             for name in names})
+
+    return pd.read_csv(io.BytesIO(block), sep='\t', header=None, names=names, usecols=range(5),
+                       comment='#', quoting=3, dtype={'chrom': str, 'start': np.int64, 'end': np.int64,
+                                                      'barcode': str, 'count': np.int64})
+
+
+def _region_mask(frags: pd.DataFrame, regions: List[Tuple[str, Optional[int], Optional[int]]]) -> np.ndarray:
+    """Flag fragments that overlap any of the parsed regions."""
+    chroms = frags['chrom'].to_numpy()
+    starts, ends = frags['start'].to_numpy(), frags['end'].to_numpy()
 
+    mask = np.zeros(len(frags), dtype=bool)
+    for chrom, start, end in regions:
+        hit = chroms == chrom
+        if start is not None:
+            hit &= (ends > start) & (starts < end)
+        mask |= hit
 
+    return mask
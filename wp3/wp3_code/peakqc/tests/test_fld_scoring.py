@@ -156,6 +156,31 @@ def test_moving_average(disturbed_sine):
     assert diff_smooth < 15
 
 
+def test_moving_average_matches_loop():
+    """Test that the vectorized filter is bit-identical to the per-element loop, including the edges."""
+    rng = np.random.default_rng(0)
+    data = np.vstack([rng.random(1001), rng.integers(0, 50, 1001)])
+
+    def loop(series, n):
+        smoothed = []
+        for i in range(len(series)):
+            if n < i <= len(series) - n:
+                step_sum = 0
+                for j in range(-n, n):
+                    step_sum += series[i + j]
+                smoothed.append(step_sum / (n * 2))
+            else:
+                smoothed.append(series[i])
+        return np.array(smoothed)
+
+    for n in [1, 4, 10]:
+        assert np.array_equal(fld.moving_average(data, n=n), np.array([loop(row, n) for row in data]))
+        assert np.array_equal(fld.moving_average(data[1], n=n), loop(data[1], n))
+
+    twice = np.array([loop(loop(row, 10), 10) for row in data])
+    assert np.array_equal(fld.multi_ma(data, n=2, window_size=10), twice)
+
+
 def test_multi_ma(stack_sines):
     """Test that the multi_ma function works as expected by comparing a smoothed disturbed sine wave to the original."""
     sine_stack, dist_stack = stack_sines
@@ -202,6 +227,61 @@ def test_call_peaks(good_modulation):
     assert len(peaks) == 2
 
 
+@pytest.mark.parametrize("n_threads,block_size", [(1, None), (2, None), (2, 7)])
+def test_call_peaks_blocks(n_threads, block_size):
+    """Test that block-wise peak calling matches scipy.signal.find_peaks per row."""
+    from scipy.signal import find_peaks
+
+    rng = np.random.default_rng(0)
+    data = fld.custom_conv(rng.poisson(3, (50, 1001)).astype(float), plot_wavl=False)
+    data[3] = 0  # row without peaks
+
+    peaks = fld.call_peaks(data, n_threads=n_threads, block_size=block_size)
+
+    assert len(peaks) == len(data)
+    for row, row_peaks in zip(data, peaks):
+        assert np.array_equal(row_peaks, find_peaks(row, distance=50, width=10)[0])
+
+
+def test_peak_list():
+    """Test the CSR peak container and the vectorized filtering and scoring against per-cell loops."""
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(40, 1000)) * 100
+    peak_arrays = [np.sort(rng.choice(1000, rng.integers(0, 6), replace=False)) for _ in range(40)]
+    peaks = fld.PeakList.from_list(peak_arrays)
+
+    assert len(peaks) == 40
+    assert all(np.array_equal(a, b) for a, b in zip(peaks, peak_arrays))
+    assert np.array_equal(peaks.counts, [len(p) for p in peak_arrays])
+    with pytest.raises(ValueError):
+        fld.PeakList([1, 2], [0, 1])
+    with pytest.raises(TypeError):
+        peaks[np.array([0, 1])]
+    assert np.array_equal(peaks[-1], peak_arrays[-1])
+    assert len(peaks[5:10]) == 5
+
+    filtered = fld.filter_peaks(peaks, reference=data, peaks_thr=10, operator="smaller")
+    assert isinstance(filtered, fld.PeakList)
+    assert all(np.array_equal(f, p[data[i, p] <= 10]) for i, (f, p) in enumerate(zip(filtered, peak_arrays)))
+
+    expected = []
+    for i, p in enumerate(peak_arrays):
+        if len(p) == 1:
+            expected.append(data[i, p[0]] / 100)
+        else:
+            expected.append(sum(max(data[i, p[j - 1]] * 2 - abs(p[j] - p[j - 1] - 180) / 100, 0) for j in range(1, len(p))))
+    assert np.allclose(fld.distances_score(peaks, data, 180, 100), expected)
+
+    mask = fld.build_score_mask(plot_mask=False)
+    expected = []
+    for i, p in enumerate(peak_arrays):
+        if len(p) == 1:
+            expected.append(data[i, p[0]] * mask[0][p[0]])
+        else:
+            expected.append(sum(data[i, p[j]] * mask[min(j, 3)][p[j]] for j in range(1, len(p))))
+    assert np.allclose(fld.score_mask(peak_arrays, data, np.ones(40), plot_mask=False), expected)
+
+
 def test_filter_peaks(disturbed_sine):
     """Test that the filter_peaks function works as expected."""
     peaks = np.array([50, 250, 400, 500, 999])
@@ -304,6 +384,25 @@ def test_custom_conv(good_modulation, bad_modulation):
     assert np.sum(good_fit) > np.sum(bad_fit)
 
 
+@pytest.mark.parametrize("length,kernel_length", [(1001, 450), (1001, 451), (50, 8), (30, 61)])
+def test_batch_convolve(length, kernel_length):
+    """Test that all batch_convolve backends match np.convolve in 'same' mode."""
+    from scipy import sparse
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 20, (25, length)).astype(float)
+    kernel = rng.normal(size=kernel_length)
+    expected = np.array([np.convolve(row, kernel, mode='same') for row in data])
+
+    for backend in ['auto', 'direct', 'fft', 'toeplitz']:
+        assert np.allclose(fld.batch_convolve(data, kernel, backend=backend), expected)
+    assert np.allclose(fld.batch_convolve(sparse.csr_matrix(data), kernel), expected)
+
+    # custom_conv forwards the backend and fftconvolve convolves every cell
+    convolved = fld.custom_conv(data, mode='convolve', plot_wavl=False)
+    assert np.allclose(fld.custom_conv(data, mode='fftconvolve', plot_wavl=False), convolved)
+
+
 def test_cos_wavelet():
     """Test that the cos_wavelet function works as expected."""
     # check for the correct wavelength
@@ -405,6 +504,32 @@ def test_score_by_conv(good_modulation, bad_modulation):
     assert good_score > bad_score
 
 
+def test_score_by_conv_sparse(good_modulation, bad_modulation):
+    """Test that sparse input is scored chunk-wise with the same result as dense input."""
+    from scipy import sparse
+
+    data = np.round(np.array([good_modulation, bad_modulation, good_modulation]))
+    kwargs = dict(insert_counts=data.sum(axis=1), plot_wavl=False, plot_mask=False, plot_ov=False, n_threads=1)
+
+    dense_scores = fld.score_by_conv(data, **kwargs)
+    sparse_scores = fld.score_by_conv(sparse.csr_matrix(data), chunk_size=2, **kwargs)
+
+    assert np.allclose(dense_scores, sparse_scores)
+
+
+def test_score_by_conv_chunks_save_once(good_modulation, bad_modulation, tmp_path, monkeypatch):
+    """Test that the wavelet and mask plots are saved once, not once per chunk."""
+    saved = []
+    monkeypatch.setattr(fld.plt, 'savefig', lambda path, *args, **kwargs: saved.append(str(path)))
+
+    data = np.round(np.array([good_modulation, bad_modulation, good_modulation]))
+    fld.score_by_conv(data, insert_counts=data.sum(axis=1), chunk_size=1, n_threads=1, plot_ov=False,
+                      save_wavl=str(tmp_path / 'wavl.png'), save_mask=str(tmp_path / 'mask.png'))
+    fld.plt.close('all')
+
+    assert sorted(saved) == [str(tmp_path / 'mask.png'), str(tmp_path / 'wavl.png')]
+
+
 def test_plot_wavelet_transformation(cosine_modulation):
     """Test that the plot_wavelet_transformation function works as expected."""
     wavelengths = [25, 50, 75, 100, 125, 150, 175, 200]
@@ -472,3 +597,47 @@ def test_add_fld_metrices(adata, fragments, bamfile):
     assert 'fld_score' in adata_f.obs.columns
     assert 'mean_fragment_size' in adata_f.obs.columns
     assert 'n_fragments' in adata_f.obs.columns
+
+
+def test_parallel_multinomial_subsampling_chunks():
+    """Test that the subsampling only depends on the seed, not on chunking or sparse input."""
+    from scipy import sparse
+
+    rng = np.random.default_rng(0)
+    dists = rng.poisson(2, (30, 100))
+    dists[::3] *= 20
+    insert_counts = dists.sum(axis=1)
+
+    mean, std = fld.parallel_multinomial_subsampling(dists, insert_counts, sample_size=300, n_simulations=4, n_threads=2)
+    chunked, _ = fld.parallel_multinomial_subsampling(dists, insert_counts, sample_size=300, n_simulations=4,
+                                                      n_threads=2, chunk_size=7)
+    sparse_mean, _ = fld.parallel_multinomial_subsampling(sparse.csr_matrix(dists), insert_counts, sample_size=300,
+                                                          n_simulations=4, n_threads=2, chunk_size=11)
+
+    assert np.array_equal(chunked, mean)
+    assert np.array_equal(sparse_mean.toarray(), mean)
+    # rows above the sample size are subsampled, the others are kept
+    assert np.array_equal(mean[insert_counts <= 300], dists[insert_counts <= 300])
+    assert np.all(mean[insert_counts > 300].sum(axis=1) <= 300 + 100)
+
+
+def test_row_subset_memmap(tmp_path):
+    """Test that a row subset of a memmap is read chunk-wise with the same results as the copied rows."""
+    rng = np.random.default_rng(1)
+    dists = rng.poisson(2, (40, 100))
+    memmap = np.lib.format.open_memmap(tmp_path / "dists.npy", mode='w+', dtype=dists.dtype, shape=dists.shape)
+    memmap[:] = dists
+    rows = np.flatnonzero(rng.random(40) < 0.6)
+    subset = dists[rows]
+    insert_counts = subset.sum(axis=1)
+
+    for q in (0, 37.5, 90, 100):
+        assert np.isclose(fld._percentile(memmap, q, rows=rows), np.percentile(subset, q))
+
+    kwargs = dict(insert_counts=insert_counts, plot_wavl=False, plot_mask=False, plot_ov=False, n_threads=1)
+    assert np.allclose(fld.score_by_conv(memmap, rows=rows, chunk_size=7, **kwargs), fld.score_by_conv(subset, **kwargs))
+
+    mean, _ = fld.parallel_multinomial_subsampling(subset, insert_counts, sample_size=150, n_simulations=3, n_threads=1)
+    rows_mean, _ = fld.parallel_multinomial_subsampling(memmap, insert_counts, sample_size=150, n_simulations=3,
+                                                        n_threads=1, chunk_size=9, rows=rows)
+    assert np.array_equal(rows_mean, mean)
@@ -6,7 +6,6 @@ import os
 import numpy as np
 import pandas as pd
 import pytest
-from multiprocessing import Lock
 import peakqc.insertsizes as insertsizes
 
 
@@ -41,128 +40,99 @@ def fragments():
 
 
 @pytest.fixture
-def chunk():
-    """Return a chunk of a fragments file."""
+def synthetic_fragments(tmp_path):
+    """Return a small synthetic fragments file (chrom, start, end, barcode, count)."""
 
-    return pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'insertsizes_related', 'example_chunk.csv'))
+    rng = np.random.default_rng(42)
+    n = 5000
+    starts = rng.integers(0, 1000000, n)
+    frags = pd.DataFrame({'chrom': rng.choice(['chr1', 'chr2', 'chrM'], n),
+                          'start': starts,
+                          'end': starts + rng.integers(10, 1100, n),
+                          'barcode': rng.choice([f'BC{i:02d}' for i in range(30)], n),
+                          'count': rng.integers(1, 4, n)})
+    frags = frags.sort_values(['chrom', 'start'])
 
+    path = tmp_path / 'fragments.bed'
+    frags.to_csv(path, sep='\t', header=False, index=False)
 
-def test_init_pool_processes():
-    """Test the init_pool_processes function."""
+    return str(path)
 
-    # Create a mock lock object
-    lock_instance = Lock()
 
-    # Call the function with the mock lock
-    insertsizes.init_pool_processes(lock_instance)
-
-    # Check that the lock is set to the mock lock
-    assert insertsizes.lock == lock_instance
-
-
-def test_check_in_list():
-    """Check the _check_in_list function."""
-
-    # Create a mock list of cell barcodes
-    mock_list = ['ATTGCTAACCGGC', 'ACAAGGCTTGGCA', 'ACGTTGCTTGGCA', 'ACGTTGCTTGGCA']
-
-    # Check that the function returns True for a barcode in the list
-    assert insertsizes._check_in_list('ATTGCTAACCGGC', mock_list) is True
-
-
-def test_check_true():
-    """Check the _check_true function."""
-    mock_list = ['ATTGCTAACCGGC', 'ACAAGGCTTGGCA', 'ACGTTGCTTGGCA', 'ACGTTGCTTGGCA']
-    # check that the function returns True for any input
-    assert insertsizes._check_true('NOT in the LIST', mock_list) is True
-
-
-def test_custom_callback(capfd):
-    """Test the custom_callback function."""
-
-    # Create an exception to pass to the callback
-    test_exception = Exception("Test exception")
-
-    # Call the _custom_callback function with the test exception
-    insertsizes._custom_callback(test_exception)
-
-    # Capture the output
-    out, err = capfd.readouterr()
-
-    # Assert that the output contains the exception message
-    assert "Test exception" in out
-
-
-def test_count_fragments_worker(chunk):
-    """Test the count_fragments_worker function."""
-
-    # Create a mock lock object
-    lock_instance = Lock()
-
-    # Call the function with the mock lock
-    insertsizes.init_pool_processes(lock_instance)
-
-    # Init a dictionary to store the results
-    insertsizes_dict = {'output': {}}
-
-    # Call the function with the mock lock and the mock dictionary
-    insertsizes._count_fragments_worker(chunk, managed_dict=insertsizes_dict)
-
-    # Check that the dictionary contains the expected results
-    assert len(insertsizes_dict['output']) == 18882  # Number of unique cell barcodes in the chunk
-    assert round(insertsizes_dict['output']['AGGGATAAACCACCGAAGGTCA']['mean_insertsize']) == 140  # Mean insert size for a specific cell barcode
-    assert insertsizes_dict['output']['AGGGATAAACCACCGAAGGTCA']['insertsize_count'] == 38  # Number of fragments for a specific cell barcode
-    assert int(insertsizes_dict['output']['AGGGATAAACCACCGAAGGTCA']['dist'].sum()) == 38  # Number of fragments in the distribution for a specific cell barcode
-
-
-def test_add_fragment_counts():
-    """Test the add_fragment_counts function."""
-
-    # Create a mock dictionary of results
-    count_dict = {'AGGGATAAACCACCGAAGGTCA': {'mean_insertsize': 140,
-                                             'insertsize_count': 38,
-                                             'dist': np.array([0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0.,
-                                                               0., 0., 0., 0., 0., 0., 0., 0., 0., 4., 0., 0., 0., 1., 0., 0., 0.,
-                                                               0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0.])}}
-
-    # Call the function with the mock dictionary
-    count_dict = insertsizes._add_fragment(count_dict=count_dict,
-                                           barcode='AGGGATAAACCACCGAAGGTCA',
-                                           size=25,
-                                           count=3,
-                                           max_size=50)
-
-    # Check that the dictionary contains the expected results
-    assert count_dict['AGGGATAAACCACCGAAGGTCA']['insertsize_count'] == 41  # Number of fragments for a specific cell barcode
-    assert int(count_dict['AGGGATAAACCACCGAAGGTCA']['dist'][25] == 3)  # Number of fragments in the distribution for a specific cell barcode
-
-
-def test_update_count_dict():
-    """Test the update_count_dict function."""
-
-    # Create a mock dictionary with a single cell barcode
-    count_dict_1 = {'AGGGATAAACCACCGAAGGTCA': {'mean_insertsize': 5.5,
-                                               'insertsize_count': 2,
-                                               'dist': np.array([0., 0., 0., 0., 1., 1., 0., 0., 0., 0.])}}
-
-    # Create a mock dictionary with multiple cell barcodes
-    count_dict_2 = {'AGGGATAAACCACCGAAGGTCA': {'mean_insertsize': 4.5,
-                                               'insertsize_count': 2,
-                                               'dist': np.array([0., 0., 0., 1., 1., 0., 0., 0., 0., 0.])},
-                    'AGGGATAAACCACCGAAGGTCC': {'mean_insertsize': 10,
-                                               'insertsize_count': 1,
-                                               'dist': np.array([0., 0., 0., 0., 0., 0., 0., 0., 0., 1.])},
-                    }
-
-    # Call the function with the mock dictionaries
-    count_dict = insertsizes._update_count_dict(count_dict_1, count_dict_2)
-
-    # Check that the dictionary contains the expected results
-    assert len(count_dict) == 2  # Number of unique cell barcodes in the dictionary
-    assert count_dict['AGGGATAAACCACCGAAGGTCA']['insertsize_count'] == 4  # Number of fragments for a specific cell barcode
-    assert count_dict['AGGGATAAACCACCGAAGGTCC']['insertsize_count'] == 1  # Number of fragments for a specific cell barcode
-    assert count_dict['AGGGATAAACCACCGAAGGTCA']['dist'][3] == 1  # Number of fragments in the distribution for a specific cell barcode
-    assert count_dict['AGGGATAAACCACCGAAGGTCA']['dist'][4] == 2
+@pytest.fixture
+def synthetic_bams(tmp_path):
+    """Return two small indexed BAM files with CB tagged read pairs, some flagged as duplicates, and a read group each."""
+
+    import pysam
+
+    rng = np.random.default_rng(42)
+    paths = []
+    for sample in ['sampleA', 'sampleB']:
+        header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+                  'SQ': [{'SN': 'chr1', 'LN': 1000000}, {'SN': 'chr2', 'LN': 1000000}],
+                  'RG': [{'ID': 'rg1', 'SM': sample}]}
+        unsorted = str(tmp_path / f'{sample}.unsorted.bam')
+        with pysam.AlignmentFile(unsorted, 'wb', header=header) as bam:
+            for i in range(500):
+                chrom = int(rng.integers(0, 2))
+                start = int(rng.integers(0, 900000))
+                tlen = int(rng.integers(30, 1200))
+                mapq = 10 if i % 50 == 0 else 60
+                for mate in (1, 2):
+                    read = pysam.AlignedSegment(bam.header)
+                    read.query_name = f'{sample}_{i}'
+                    read.query_sequence = 'A' * 30
+                    read.flag = 0x1 | 0x2 | (0x20 if mate == 1 else 0x10) | (0x40 if mate == 1 else 0x80)
+                    if i % 60 == 1:
+                        read.flag |= 0x400
+                    read.reference_id = read.next_reference_id = chrom
+                    read.reference_start = start if mate == 1 else start + tlen - 30
+                    read.next_reference_start = start + tlen - 30 if mate == 1 else start
+                    read.template_length = tlen if mate == 1 else -tlen
+                    read.mapping_quality = mapq
+                    read.cigarstring = '30M'
+                    read.set_tag('CB', f'BC{i % 7}')
+                    read.set_tag('RG', 'rg1')
+                    bam.write(read)
+
+        path = str(tmp_path / f'{sample}.bam')
+        pysam.sort('-o', path, unsorted)
+        pysam.index(path)
+        paths.append(path)
+
+    return paths
+
+
+def test_numpy_worker(synthetic_fragments):
+    """Test that the numpy backend worker counts the sizes of a block per barcode."""
+
+    with open(synthetic_fragments, 'rb') as f:
+        block = f.read()
+    frags = pd.read_csv(synthetic_fragments, sep='\t', header=None, names=['chrom', 'start', 'end', 'barcode', 'count'])
+    frags['size'] = frags['end'] - frags['start'] - 9
+    frags = frags[frags['size'] <= 1000]
+
+    insertsizes._init_numpy_worker(None)
+    labels, keys, counts, reads, size_sums = insertsizes._numpy_worker((block, 0, 1000, []))
+
+    expected = frags.groupby('barcode').agg(n=('size', 'size'), reads=('count', 'sum'), sizes=('size', 'sum')).loc[labels]
+    assert sorted(labels) == sorted(frags['barcode'].unique())
+    assert (np.bincount(keys // 1001, weights=counts, minlength=len(labels)) == expected['n']).all()
+    assert (reads == expected['reads']).all()
+    assert (size_sums == expected['sizes']).all()
+
+    row = labels.index('BC01')
+    dist = np.zeros(1001, dtype=np.int64)
+    dist[keys[keys // 1001 == row] % 1001] = counts[keys // 1001 == row]
+    assert (dist == np.bincount(frags.loc[frags['barcode'] == 'BC01', 'size'], minlength=1001)).all()
+
+    # the barcode whitelist is shared with the worker processes by _init_numpy_worker
+    insertsizes._init_numpy_worker(['BC01', 'BC02'])
+    try:
+        labels, *_ = insertsizes._numpy_worker((block, 0, 1000, []))
+    finally:
+        insertsizes._init_numpy_worker(None)
+    assert sorted(labels) == ['BC01', 'BC02']
 
 
 def test_insertsize_from_fragments(fragments_file, barcodes):
@@ -212,3 +182,633 @@ def test_insertsize_from_bam(bam_file, barcodes):
                                             regions='chr1:1-100000')
 
     assert table.shape[0] == 2705  # Number of unique cell barcodes in the table
+
+
+@pytest.mark.parametrize('fmt', ['tsv', 'npy', 'parquet'])
+def test_count_table_roundtrip(synthetic_fragments, tmp_path, fmt):
+    """Test that count tables survive writing and reading in every format."""
+
+    path = tmp_path / f'count_table.{fmt}'
+    table = insertsizes.insertsize_from_fragments(synthetic_fragments,
+                                                  count_table_path=path,
+                                                  count_table_format=fmt)
+
+    stats, dists = insertsizes.read_count_table(path)
+
+    assert list(stats.index) == list(table.index)
+    assert dists.shape == (table.shape[0], 1001)
+    assert (dists == np.stack(table['dist'].to_numpy())).all()
+    assert np.allclose(stats['mean_insertsize'], table['mean_insertsize'])
+    assert (stats['insertsize_count'].to_numpy() == table['insertsize_count'].to_numpy()).all()
+
+
+def test_insertsize_from_compressed_fragments(synthetic_fragments, tmp_path):
+    """Test gzip, bgzip and tabix-indexed region input of insertsize_from_fragments."""
+
+    import gzip
+    import pysam
+
+    gz_path = str(tmp_path / 'fragments.bed.gz')
+    with open(synthetic_fragments, 'rb') as f_in, gzip.open(gz_path, 'wb') as f_out:
+        f_out.write(f_in.read())
+
+    bgz_path = str(tmp_path / 'fragments.bgz.bed.gz')
+    pysam.tabix_compress(synthetic_fragments, bgz_path)
+    pysam.tabix_index(bgz_path, preset='bed')
+
+    plain = insertsizes.insertsize_from_fragments(synthetic_fragments).sort_index()
+    for path in [gz_path, bgz_path]:
+        table = insertsizes.insertsize_from_fragments(path).sort_index()
+        assert (table['insertsize_count'] == plain['insertsize_count']).all()
+
+    regions = ['chr1:1-300000', 'chr1:200001-500000', 'chr2']
+    plain = insertsizes.insertsize_from_fragments(synthetic_fragments, regions=regions).sort_index()
+    tabix = insertsizes.insertsize_from_fragments(bgz_path, regions=regions).sort_index()
+
+    assert plain['insertsize_count'].sum() < insertsizes.insertsize_from_fragments(synthetic_fragments)['insertsize_count'].sum()
+    assert (tabix['insertsize_count'] == plain['insertsize_count']).all()
+    assert (np.stack(tabix['dist'].to_numpy()) == np.stack(plain['dist'].to_numpy())).all()
+
+
+def test_insertsize_from_bam_labels(synthetic_bams):
+    """Test barcode and per-file sample labels of insertsize_from_bam."""
+
+    table = insertsizes.insertsize_from_bam(synthetic_bams[0], barcode_tag='CB', n_threads=2)
+
+    assert table.shape[0] == 7
+    assert (table['dist'].apply(np.sum) == table['insertsize_count']).all()
+    # pairs with low MAPQ (10 of 500), duplicates (9 of 500) or templates longer than max_distance are removed
+    assert table['insertsize_count'].sum() < 481
+
+    # small buffers merge the flushed histograms many times
+    chunked = insertsizes.insertsize_from_bam(synthetic_bams[0], barcode_tag='CB', n_threads=2, chunk_size=3)
+    chunked = chunked.loc[table.index]
+    assert (chunked['insertsize_count'] == table['insertsize_count']).all()
+    assert np.allclose(chunked['mean_insertsize'], table['mean_insertsize'])
+    assert all(np.array_equal(a, b) for a, b in zip(chunked['dist'], table['dist']))
+
+    filtered = insertsizes.insertsize_from_bam(synthetic_bams[0], barcodes=['BC1', 'BC2'], n_threads=2)
+    assert sorted(filtered.index) == ['BC1', 'BC2']
+    assert (filtered['insertsize_count'] == table.loc[['BC1', 'BC2'], 'insertsize_count']).all()
+
+    regional = insertsizes.insertsize_from_bam(synthetic_bams[0], regions='chr1', n_threads=2)
+    assert regional['insertsize_count'].sum() < table['insertsize_count'].sum()
+
+    by_file = insertsizes.insertsize_from_bam(synthetic_bams, sample_label='filename', n_threads=2)
+    by_rg = insertsizes.insertsize_from_bam(synthetic_bams, sample_label='read_group', n_threads=2)
+
+    assert sorted(by_file.index) == ['sampleA', 'sampleB']
+    assert (by_file.sort_index()['insertsize_count'] == by_rg.sort_index()['insertsize_count']).all()
+    assert by_file.loc['sampleA', 'insertsize_count'] == table['insertsize_count'].sum()
+
+
+def test_insertsize_from_bam_matches_fragments(synthetic_bams, tmp_path):
+    """Test that a BAM file gives the same histograms as its sinto fragment file."""
+
+    import pysam
+
+    # sinto shifts the fragment by +4/-5 and skips duplicates, low MAPQ and long templates
+    rows = []
+    with pysam.AlignmentFile(synthetic_bams[0], 'rb') as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.template_length <= 0 or read.is_duplicate or read.mapping_quality < 30 or read.template_length > 1000:
+                continue
+            rows.append((read.reference_name, read.reference_start + 4,
+                         read.reference_start + read.template_length - 5, read.get_tag('CB'), 1))
+    path = tmp_path / 'sinto.bed'
+    pd.DataFrame(rows).sort_values([0, 1]).to_csv(path, sep='\t', header=False, index=False)
+
+    from_bam = insertsizes.insertsize_from_bam(synthetic_bams[0], n_threads=2).sort_index()
+    from_fragments = insertsizes.insertsize_from_fragments(str(path)).sort_index()
+
+    assert list(from_bam.index) == list(from_fragments.index)
+    assert (from_bam['insertsize_count'] == from_fragments['insertsize_count']).all()
+    assert np.allclose(from_bam['mean_insertsize'], from_fragments['mean_insertsize'])
+    assert all(np.array_equal(a, b) for a, b in zip(from_bam['dist'], from_fragments['dist']))
+
+
+def test_insertsize_sparse_output(synthetic_fragments, tmp_path):
+    """Test that the sparse output matches the dense count table."""
+
+    table = insertsizes.insertsize_from_fragments(synthetic_fragments).sort_index()
+    stats, dists = insertsizes.insertsize_from_fragments(synthetic_fragments, output='sparse',
+                                                         count_table_path=tmp_path / 'store',
+                                                         count_table_format='npy')
+
+    assert list(stats.index) == list(table.index)
+    assert dists.shape == (table.shape[0], 1001)
+    assert (dists.toarray() == np.stack(table['dist'].to_numpy())).all()
+    assert np.allclose(stats['mean_insertsize'], table['mean_insertsize'])
+
+    _, stored = insertsizes.read_count_table(tmp_path / 'store')
+    assert (stored != dists).nnz == 0
+
+
+def test_insert_bed_to_duckdb_incremental(synthetic_fragments, tmp_path, caplog):
+    """Test that unchanged files are skipped and changed files are replaced."""
+
+    import duckdb
+    import logging
+    import shutil
+
+    caplog.set_level(logging.INFO, logger='peakqc.insertsizes')
+
+    first = str(tmp_path / 'first.bed')
+    second = str(tmp_path / 'second.bed')
+    shutil.copy(synthetic_fragments, first)
+    shutil.copy(synthetic_fragments, second)
+    db_path = str(tmp_path / 'fragments.duckdb')
+
+    table = insertsizes.insert_bed_to_duckdb([first, second], db_path, summarize=True)
+    expected = insertsizes.insertsize_from_fragments(first).sort_index()
+
+    # barcodes of both files are combined into one row
+    assert list(table.index) == list(expected.index)
+    assert (np.stack(table['dist'].to_numpy()) == 2 * np.stack(expected['dist'].to_numpy())).all()
+    assert np.allclose(table['mean_insertsize'], expected['mean_insertsize'])
+    assert 'Ingested 2 file(s) with 10000 fragments' in caplog.text
+
+    # touching a file without changing it does not re-ingest it
+    os.utime(second)
+    caplog.clear()
+    insertsizes.insert_bed_to_duckdb([first, second], db_path, summarize=True)
+    assert caplog.text == ''
+    with duckdb.connect(db_path) as con:
+        assert con.execute("SELECT COUNT(*) FROM fragments").fetchone()[0] == 10000
+        ingested = con.execute("SELECT ingested_at FROM manifest ORDER BY file_id").fetchall()
+
+    with open(second) as f:
+        lines = f.readlines()
+    with open(second, 'w') as f:
+        f.writelines(lines[:1000])
+
+    table = insertsizes.insert_bed_to_duckdb([first, second], db_path, summarize=True)
+    with duckdb.connect(db_path) as con:
+        counts = con.execute("SELECT file_id, COUNT(*) FROM fragments GROUP BY file_id ORDER BY file_id").fetchall()
+        assert con.execute("SELECT ingested_at FROM manifest ORDER BY file_id").fetchall()[0] == ingested[0]
+
+    assert counts == [(0, 5000), (1, 1000)]
+    assert expected['dist'].apply(np.sum).sum() < table['dist'].apply(np.sum).sum() <= expected['dist'].apply(np.sum).sum() + 1000
+
+
+def test_insert_bed_to_duckdb_size_ranges(synthetic_fragments, tmp_path, caplog):
+    """Test that summaries of another size range are left out of the merged count table."""
+
+    import shutil
+
+    first = str(tmp_path / 'first.bed')
+    second = str(tmp_path / 'second.bed')
+    shutil.copy(synthetic_fragments, first)
+    shutil.copy(synthetic_fragments, second)
+    db_path = str(tmp_path / 'fragments.duckdb')
+
+    short = insertsizes.insert_bed_to_duckdb([first], db_path, summarize=True, max_size=500)
+    table = insertsizes.insert_bed_to_duckdb([second], db_path, summarize=True, max_size=1000)
+    expected = insertsizes.insertsize_from_fragments(second).sort_index()
+
+    assert len(short['dist'].iloc[0]) == 501
+    assert (table['insertsize_count'] == expected['insertsize_count']).all()
+    assert 'summarized with another size range' in caplog.text
+
+
+def test_insert_bed_to_duckdb_glob(synthetic_fragments, tmp_path):
+    """Test that a glob pattern is ingested in one scan with one file_id per file."""
+
+    import duckdb
+    import shutil
+
+    for sample in ['s1', 's2', 's3']:
+        shutil.copy(synthetic_fragments, tmp_path / f'{sample}.bed')
+    db_path = str(tmp_path / 'fragments.duckdb')
+
+    table = insertsizes.insert_bed_to_duckdb(str(tmp_path / 's*.bed'), db_path, summarize=True, n_threads=2)
+    single = insertsizes.insertsize_from_fragments(synthetic_fragments)
+
+    with duckdb.connect(db_path) as con:
+        counts = con.execute("SELECT file_id, COUNT(*) FROM fragments GROUP BY file_id ORDER BY file_id").fetchall()
+        paths = [row[0] for row in con.execute("SELECT path FROM manifest ORDER BY file_id").fetchall()]
+
+    assert counts == [(0, 5000), (1, 5000), (2, 5000)]
+    assert [os.path.basename(p) for p in paths] == ['s1.bed', 's2.bed', 's3.bed']
+    assert table.shape[0] == single.shape[0]
+    assert (table['insertsize_count'] == 3 * single['insertsize_count']).all()
+
+    with pytest.raises(FileNotFoundError):
+        insertsizes.insert_bed_to_duckdb(str(tmp_path / 'missing*.bed'), db_path)
+
+
+def test_insert_bed_to_duckdb_rollback(synthetic_fragments, tmp_path):
+    """Test that a failing ingest is rolled back and the database is closed."""
+
+    import duckdb
+    import shutil
+
+    shutil.copy(synthetic_fragments, tmp_path / 's1.bed')
+    db_path = str(tmp_path / 'fragments.duckdb')
+    insertsizes.insert_bed_to_duckdb([str(tmp_path / 's1.bed')], db_path, n_threads=2)
+
+    with open(tmp_path / 's2.bed', 'w') as f:
+        f.write('chr1\tnot_a_position\t200\tBC00\t1\n')
+
+    with pytest.raises(duckdb.Error):
+        insertsizes.insert_bed_to_duckdb([str(tmp_path / 's1.bed'), str(tmp_path / 's2.bed')], db_path, n_threads=2)
+
+    with duckdb.connect(db_path) as con:
+        assert con.execute("SELECT COUNT(*) FROM manifest").fetchone()[0] == 1
+        assert con.execute("SELECT COUNT(*) FROM fragments").fetchone()[0] == 5000
+
+
+def test_insertsize_barcode_whitelist(synthetic_fragments, tmp_path):
+    """Test barcode whitelists given as list, file and AnnData object."""
+
+    import anndata as ad
+
+    full = insertsizes.insertsize_from_fragments(synthetic_fragments)
+    keep = ['BC01', 'BC05', 'BC17']
+
+    barcode_file = tmp_path / 'barcodes.txt'
+    barcode_file.write_text('\n'.join(keep + ['not_in_fragments']) + '\n')
+    adata = ad.AnnData(obs=pd.DataFrame({'barcode': keep}, index=['c1', 'c2', 'c3']))
+
+    for barcodes, barcode_col in [(keep, None), (barcode_file, None), (adata, 'barcode')]:
+        table = insertsizes.insertsize_from_fragments(synthetic_fragments, barcodes=barcodes,
+                                                      barcode_col=barcode_col).sort_index()
+        assert list(table.index) == keep
+        assert (table['insertsize_count'] == full.loc[keep, 'insertsize_count']).all()
+
+    stats, dists = insertsizes.insertsize_from_fragments(synthetic_fragments, barcodes=keep, output='sparse')
+    assert list(stats.index) == keep
+    assert dists.shape[0] == 3
+
+
+def test_insertsize_by_regions(synthetic_fragments, tmp_path):
+    """Test that inside and outside histograms partition the fragments and match an overlap check."""
+
+    regions_bed = tmp_path / 'regions.bed'
+    regions_bed.write_text("chr1\t100000\t300000\nchr1\t250000\t400000\nchr2\t0\t50000\n")
+
+    tables = insertsizes.insertsize_by_regions(synthetic_fragments, regions_bed)
+    full = insertsizes.insertsize_from_fragments(synthetic_fragments)
+
+    fragments = pd.read_csv(synthetic_fragments, sep='\t', header=None, names=['chrom', 'start', 'end', 'barcode', 'count'])
+    fragments = fragments[(fragments['end'] - fragments['start'] - 9).between(0, 1000)]
+    inside = (((fragments['chrom'] == 'chr1') & (fragments['end'] > 100000) & (fragments['start'] < 400000))
+              | ((fragments['chrom'] == 'chr2') & (fragments['start'] < 50000)))
+
+    assert tables['inside']['insertsize_count'].sum() == fragments.loc[inside, 'count'].sum()
+    assert tables['outside']['insertsize_count'].sum() == fragments.loc[~inside, 'count'].sum()
+
+    combined = tables['inside']['insertsize_count'].add(tables['outside']['insertsize_count'], fill_value=0)
+    assert (combined.sort_index() == full['insertsize_count'].sort_index()).all()
+
+
+def test_duckdb_config_profiling(synthetic_fragments, tmp_path):
+    """Test that the DuckDB config is applied and query profiles are written."""
+
+    import json
+
+    config = insertsizes.DuckDBConfig(memory_limit='1GB', threads=2, temp_directory=str(tmp_path / 'spill'),
+                                      profile_path=tmp_path / 'profile.json')
+    table = insertsizes.insertsize_from_fragments(synthetic_fragments, config=config).sort_index()
+    sniffed = insertsizes.insertsize_from_fragments(synthetic_fragments,
+                                                    config=insertsizes.DuckDBConfig(explicit_schema=False)).sort_index()
+
+    assert (table['insertsize_count'] == sniffed['insertsize_count']).all()
+
+    with open(tmp_path / 'profile.json') as f:
+        report = json.load(f)
+
+    assert report['config']['threads'] == 2
+    assert len(report['queries']) > 0
+    assert all('latency' in query and 'plan' in query for query in report['queries'])
+
+
+def test_duckdb_compact_schema(synthetic_fragments, tmp_path):
+    """Test the dictionary encoded fragments table and histograms computed from it."""
+
+    import duckdb
+
+    db_path = str(tmp_path / 'fragments.duckdb')
+    insertsizes.insert_bed_to_duckdb([synthetic_fragments], db_path)
+
+    with duckdb.connect(db_path) as con:
+        types = dict(con.execute("SELECT column_name, data_type FROM information_schema.columns "
+                                 "WHERE table_name = 'fragments'").fetchall())
+        n_barcodes = con.execute("SELECT COUNT(*) FROM barcodes").fetchone()[0]
+        chroms = [row[0] for row in con.execute("SELECT chrom FROM chroms ORDER BY chrom_id").fetchall()]
+
+    assert types['barcode_id'] == 'INTEGER' and types['size'] == 'SMALLINT'
+    assert 'barcode' not in types and 'chrom' not in types
+    assert n_barcodes == 30
+    assert chroms == ['chr1', 'chr2', 'chrM']
+
+    expected = insertsizes.insertsize_from_fragments(synthetic_fragments).sort_index()
+    table = insertsizes.insertsize_from_duckdb(db_path).sort_index()
+
+    assert list(table.index) == list(expected.index)
+    assert (np.stack(table['dist'].to_numpy()) == np.stack(expected['dist'].to_numpy())).all()
+    assert np.allclose(table['mean_insertsize'], expected['mean_insertsize'])
+
+
+def test_insertsize_cache(synthetic_fragments, tmp_path):
+    """Test that cached histograms are reused, invalidated on file changes and evicted by size."""
+
+    cache_dir = tmp_path / 'cache'
+    first = insertsizes.insertsize_from_fragments(synthetic_fragments, cache_dir=cache_dir)
+    second = insertsizes.insertsize_from_fragments(synthetic_fragments, cache_dir=cache_dir)
+
+    assert first.index.equals(second.index)
+    assert (np.stack(first['dist'].to_numpy()) == np.stack(second['dist'].to_numpy())).all()
+    assert len(os.listdir(cache_dir)) == 1
+
+    insertsizes.insertsize_from_fragments(synthetic_fragments, max_size=500, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+    with open(synthetic_fragments, 'a') as f:
+        f.write('chr1\t100\t300\tNEW_BARCODE\t1\n')
+    changed = insertsizes.insertsize_from_fragments(synthetic_fragments, cache_dir=cache_dir)
+    assert 'NEW_BARCODE' in changed.index
+
+    insertsizes.insertsize_from_fragments(synthetic_fragments, min_size=20, cache_dir=cache_dir, cache_size_limit=1)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_insertsize_numpy_output(synthetic_fragments):
+    """Test that the numpy output is a contiguous integer matrix matching the dense count table."""
+
+    table = insertsizes.insertsize_from_fragments(synthetic_fragments)
+    stats, dists = insertsizes.insertsize_from_fragments(synthetic_fragments, output='numpy')
+
+    assert isinstance(dists, np.ndarray)
+    assert dists.flags['C_CONTIGUOUS'] and np.issubdtype(dists.dtype, np.integer)
+    assert list(stats.index) == list(table.index)
+    assert (dists == np.stack(table['dist'].to_numpy())).all()
+
+
+def test_insertsize_from_sample_sheet(synthetic_fragments, synthetic_bams, tmp_path):
+    """Test per-sample histograms from a sample sheet mixing fragment and BAM files."""
+
+    import gzip
+    import shutil
+
+    gz_path = str(tmp_path / 'fragments_copy.bed.gz')
+    with open(synthetic_fragments, 'rb') as f_in, gzip.open(gz_path, 'wb') as f_out:
+        f_out.write(f_in.read())
+    second = str(tmp_path / 'lane2.bed')
+    shutil.copy(synthetic_fragments, second)
+
+    sheet = pd.DataFrame({'sample': ['frag', 'frag_gz', 'frag', 'bamA', 'bamB'],
+                          'path': [synthetic_fragments, gz_path, second] + synthetic_bams})
+    sheet_path = tmp_path / 'samples.tsv'
+    sheet.to_csv(sheet_path, sep='\t', index=False)
+
+    stats, dists = insertsizes.insertsize_from_sample_sheet(sheet_path, n_threads=2, output='numpy')
+
+    single = insertsizes.insertsize_from_fragments(synthetic_fragments)
+    by_file = insertsizes.insertsize_from_bam(synthetic_bams, sample_label='filename', n_threads=2)
+
+    assert list(stats.index) == ['frag', 'frag_gz', 'bamA', 'bamB']
+    assert dists.shape == (4, 1001)
+    assert stats.loc['frag', 'insertsize_count'] == 2 * single['insertsize_count'].sum()
+    assert stats.loc['frag_gz', 'insertsize_count'] == single['insertsize_count'].sum()
+    assert (dists[0] == 2 * dists[1]).all()
+    assert stats.loc['frag', 'mean_insertsize'] == pytest.approx(stats.loc['frag_gz', 'mean_insertsize'])
+    assert stats.loc['bamA', 'insertsize_count'] == by_file.loc['sampleA', 'insertsize_count']
+    assert (dists[3] == by_file.loc['sampleB', 'dist']).all()
+
+
+def test_qc_from_fragments(synthetic_fragments):
+    """Test the QC metrics computed alongside the histograms."""
+
+    count_table, qc_table, chrom_counts = insertsizes.qc_from_fragments(synthetic_fragments)
+    expected = insertsizes.insertsize_from_fragments(synthetic_fragments)
+
+    fragments = pd.read_csv(synthetic_fragments, sep='\t', header=None, names=['chrom', 'start', 'end', 'barcode', 'count'])
+    per_barcode = fragments.groupby('barcode')
+
+    assert (np.stack(count_table['dist'].to_numpy()) == np.stack(expected['dist'].to_numpy())).all()
+    assert (qc_table['unique_fragments'] == per_barcode.size()).all()
+    assert (qc_table['total_fragments'] == per_barcode['count'].sum()).all()
+    assert np.allclose(qc_table['duplicate_rate'], 1 - per_barcode.size() / per_barcode['count'].sum())
+    assert np.allclose(qc_table['mito_fraction'], (fragments['chrom'] == 'chrM').groupby(fragments['barcode']).mean())
+    assert list(chrom_counts.columns) == ['chr1', 'chr2', 'chrM']
+    assert (chrom_counts.sum(axis=1) == qc_table['unique_fragments']).all()
+
+
+def test_insertsize_numpy_backend(synthetic_fragments, tmp_path):
+    """Test that the numpy backend matches the DuckDB engine."""
+
+    import gzip
+
+    gz_path = str(tmp_path / 'fragments.bed.gz')
+    with open(synthetic_fragments, 'rb') as f_in, gzip.open(gz_path, 'wb') as f_out:
+        f_out.write(f_in.read())
+
+    for kwargs in [{}, {'regions': ['chr1:1-300000', 'chr2']}, {'barcodes': ['BC01', 'BC05', 'BC17']}]:
+        stats, dists = insertsizes.insertsize_from_fragments(synthetic_fragments, output='numpy', **kwargs)
+        for path in [synthetic_fragments, gz_path]:
+            np_stats, np_dists = insertsizes.insertsize_from_fragments(path, backend='numpy', n_threads=2,
+                                                                       chunk_size=10000, output='numpy', **kwargs)
+            assert list(np_stats.index) == list(stats.index)
+            assert (np_stats['insertsize_count'] == stats['insertsize_count']).all()
+            assert np.allclose(np_stats['mean_insertsize'], stats['mean_insertsize'])
+            assert (np_dists == dists).all()
+
+    timings = insertsizes.benchmark_backends(synthetic_fragments, n_runs=1, n_threads=2)
+    assert list(timings['backend']) == ['duckdb', 'numpy']
+    assert timings['identical'].all()
+
+
+def test_fragments_to_parquet(synthetic_fragments, tmp_path):
+    """Test the partitioned Parquet fragment store as input of the histogram functions."""
+
+    import shutil
+
+    second = str(tmp_path / 'sampleB.bed')
+    shutil.copy(synthetic_fragments, second)
+    store = str(tmp_path / 'store')
+
+    insertsizes.fragments_to_parquet([synthetic_fragments, second], store)
+
+    assert sorted(os.listdir(store)) == ['sample=fragments', 'sample=sampleB']
+    assert sorted(os.listdir(os.path.join(store, 'sample=sampleB'))) == ['chrom=chr1', 'chrom=chr2', 'chrom=chrM']
+    with pytest.raises(FileExistsError):
+        insertsizes.fragments_to_parquet([synthetic_fragments], store)
+
+    single = insertsizes.insertsize_from_fragments(synthetic_fragments)
+    table = insertsizes.insertsize_from_fragments(os.path.join(store, 'sample=sampleB'))
+    assert list(table.index) == list(single.index)
+    assert (table['insertsize_count'] == single['insertsize_count']).all()
+    assert (np.stack(table['dist'].to_numpy()) == np.stack(single['dist'].to_numpy())).all()
+
+    both = insertsizes.insertsize_from_fragments(store)
+    assert (both['insertsize_count'] == 2 * single['insertsize_count']).all()
+
+    regions = ['chr1:1-300000', 'chr2']
+    plain = insertsizes.insertsize_from_fragments(synthetic_fragments, regions=regions)
+    pruned = insertsizes.insertsize_from_fragments(os.path.join(store, 'sample=fragments'), regions=regions)
+    assert (pruned['insertsize_count'] == plain['insertsize_count']).all()
+
+    stats, _ = insertsizes.insertsize_from_sample_sheet({'A': os.path.join(store, 'sample=fragments'),
+                                                         'B': synthetic_fragments}, output='sparse')
+    assert stats.loc['A', 'insertsize_count'] == stats.loc['B', 'insertsize_count']
+
+
+def test_fragment_store(synthetic_fragments, tmp_path):
+    """Test histogram, lookup, region and summary queries of a FragmentStore session."""
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    db_path = str(tmp_path / 'fragments.duckdb')
+    insertsizes.insert_bed_to_duckdb([synthetic_fragments], db_path, summarize=True)
+    expected = insertsizes.insertsize_from_fragments(synthetic_fragments)
+    fragments = pd.read_csv(synthetic_fragments, sep='\t', header=None, names=['chrom', 'start', 'end', 'barcode', 'count'])
+
+    with insertsizes.FragmentStore(db_path) as store:
+        table = store.histogram()
+        assert list(table.index) == list(expected.index)
+        assert (np.stack(table['dist'].to_numpy()) == np.stack(expected['dist'].to_numpy())).all()
+
+        regional = store.histogram(regions='chr2', output='sparse')[0]
+        in_range = (fragments['end'] - fragments['start'] - 9).between(0, 1000)
+        assert regional['insertsize_count'].sum() == fragments.loc[in_range & (fragments['chrom'] == 'chr2'), 'count'].sum()
+
+        lookup = store.fragments(barcodes=['BC03'], regions='chr1:1-500000')
+        reference = fragments[(fragments['barcode'] == 'BC03') & (fragments['chrom'] == 'chr1') & (fragments['start'] < 500000)]
+        assert len(lookup) == len(reference)
+        assert (lookup['barcode'] == 'BC03').all()
+
+        summary = store.summary()
+        assert (summary['insertsize_count'] == expected['insertsize_count']).all()
+        assert len(store.files()) == 1
+
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda bc: store.histogram(barcodes=[bc]), ['BC01', 'BC02', 'BC03', 'BC04']))
+        assert [result.index[0] for result in results] == ['BC01', 'BC02', 'BC03', 'BC04']
+        assert store.cursor().execute("SELECT COUNT(*) FROM fragments").fetchone()[0] == len(fragments)
+
+
+def test_insertsize_sample_size(synthetic_fragments, tmp_path):
+    """Test reproducible per-barcode fragment samples of the histogram functions."""
+
+    full = insertsizes.insertsize_from_fragments(synthetic_fragments, output='sparse')
+    stats, dists = insertsizes.insertsize_from_fragments(synthetic_fragments, sample_size=50, output='sparse')
+    again = insertsizes.insertsize_from_fragments(synthetic_fragments, sample_size=50, n_threads=1, output='sparse')[1]
+    other = insertsizes.insertsize_from_fragments(synthetic_fragments, sample_size=50, seed=7, output='sparse')[1]
+
+    n_full = np.asarray(full[1].sum(axis=1)).ravel()
+    assert (np.asarray(dists.sum(axis=1)).ravel() == np.minimum(n_full, 50)).all()
+    assert ((dists - full[1]).max() <= 0)
+    assert (dists != again).nnz == 0
+    assert (dists != other).nnz > 0
+    assert (stats['insertsize_count'] == full[0]['insertsize_count']).all()
+    assert np.allclose(stats['mean_insertsize'], full[0]['mean_insertsize'])
+
+    numpy_dists = insertsizes.insertsize_from_fragments(synthetic_fragments, backend='numpy', n_threads=2,
+                                                        sample_size=50, output='sparse')[1]
+    assert (np.asarray(numpy_dists.sum(axis=1)).ravel() == np.minimum(n_full, 50)).all()
+
+    # the samples of both backends differ, so they are cached separately
+    cache_dir = str(tmp_path / 'cache')
+    cached = insertsizes.insertsize_from_fragments(synthetic_fragments, sample_size=50, cache_dir=cache_dir,
+                                                   output='sparse')[1]
+    cached_numpy = insertsizes.insertsize_from_fragments(synthetic_fragments, backend='numpy', n_threads=2,
+                                                         sample_size=50, cache_dir=cache_dir, output='sparse')[1]
+    assert (cached != dists).nnz == 0
+    assert (cached_numpy != numpy_dists).nnz == 0
+
+    db_path = str(tmp_path / 'fragments.duckdb')
+    insertsizes.insert_bed_to_duckdb([synthetic_fragments], db_path)
+    db_stats, db_dists = insertsizes.insertsize_from_duckdb(db_path, sample_size=50, output='sparse')
+    assert (np.asarray(db_dists.sum(axis=1)).ravel() == np.minimum(n_full, 50)).all()
+    assert (db_stats['insertsize_count'] == full[0]['insertsize_count']).all()
+
+    sheet_stats, sheet_dists = insertsizes.insertsize_from_sample_sheet({'bulk': synthetic_fragments},
+                                                                        sample_size=1000, output='numpy')
+    assert sheet_dists.sum() == 1000
+    assert sheet_stats.loc['bulk', 'insertsize_count'] == full[0]['insertsize_count'].sum()
+
+
+@pytest.mark.parametrize("fmt", ['duckdb', 'npy', 'npz', 'parquet', 'tsv'])
+def test_get_distributions(synthetic_fragments, tmp_path, fmt):
+    """Test point lookups of single barcode distributions in databases and count tables."""
+
+    stats, dists = insertsizes.insertsize_from_fragments(synthetic_fragments, output='sparse')
+    path = str(tmp_path / f'table.{fmt}')
+    if fmt == 'duckdb':
+        insertsizes.insert_bed_to_duckdb([synthetic_fragments], path)
+    elif fmt == 'npz':
+        insertsizes.write_count_table(stats, path, format='npy', dists=dists)
+    else:
+        insertsizes.write_count_table(stats, path, format=fmt, dists=dists.toarray())
+
+    lookup_stats, lookup = insertsizes.get_distributions(path, ['BC07', 'BC02'])
+    rows = stats.index.get_indexer(['BC07', 'BC02'])
+    assert list(lookup_stats.index) == ['BC07', 'BC02']
+    assert (lookup == dists[rows].toarray()).all()
+    assert (lookup_stats['insertsize_count'].to_numpy() == stats['insertsize_count'].to_numpy()[rows]).all()
+    assert (insertsizes.get_distribution(path, 'BC07') == lookup[0]).all()
+
+    with pytest.raises(KeyError):
+        insertsizes.get_distribution(path, 'UNKNOWN')
+
+
+def test_merge_partials(synthetic_fragments, tmp_path):
+    """Test that partials of shards combine exactly into the count table of all fragments."""
+
+    fragments = pd.read_csv(synthetic_fragments, sep='\t', header=None)
+    shards = []
+    for i, chrom in enumerate(['chr1', 'chr2', 'chrM']):
+        shard = str(tmp_path / f'shard_{i}.bed')
+        fragments[fragments[0] == chrom].to_csv(shard, sep='\t', header=False, index=False)
+        insertsizes.insertsize_from_fragments(shard, count_table_path=str(tmp_path / f'partial_{i}'),
+                                              count_table_format='partial')
+        shards.append(str(tmp_path / f'partial_{i}'))
+
+    expected, expected_dists = insertsizes.insertsize_from_fragments(synthetic_fragments, output='sparse')
+
+    # merging is associative: merge two shards first, then the rest
+    insertsizes.merge_partials(shards[:2], count_table_path=str(tmp_path / 'partial_01'))
+    stats, dists = insertsizes.merge_partials([str(tmp_path / 'partial_01'), shards[2]], output='sparse')
+    assert list(stats.index) == list(expected.index)
+    assert (dists != expected_dists).nnz == 0
+    assert (stats['insertsize_count'] == expected['insertsize_count']).all()
+    assert np.allclose(stats['mean_insertsize'], expected['mean_insertsize'], rtol=0, atol=1e-9)
+
+    assert len(insertsizes.merge_partials(str(tmp_path / 'partial_?'))) == len(expected)
+    with pytest.raises(ValueError):
+        insertsizes.merge_partials([synthetic_fragments])
+    with pytest.raises(ValueError):
+        insertsizes.insertsize_from_fragments(synthetic_fragments, sample_size=10, count_table_path=str(tmp_path / 'p'),
+                                              count_table_format='partial')
+
+
+def test_cutsite_pileup(synthetic_fragments, tmp_path):
+    """Test binned Tn5 cut-site coverage per barcode group."""
+
+    fragments = pd.read_csv(synthetic_fragments, sep='\t', header=None, names=['chrom', 'start', 'end', 'barcode', 'count'])
+    groups = {f'BC{i:02d}': 'even' if i % 2 == 0 else 'odd' for i in range(30)}
+    out_dir = insertsizes.cutsite_pileup(synthetic_fragments, tmp_path / 'pileup', bin_size=1000, groups=groups)
+
+    with open(os.path.join(out_dir, 'barcodes.txt')) as f:
+        assert f.read().splitlines() == ['even', 'odd']
+
+    bins, coverage = insertsizes.read_pileup(out_dir)
+    assert coverage.sum() == 2 * len(fragments)
+    assert list(pd.unique(bins['chrom'])) == ['chr1', 'chr2', 'chrM']
+
+    bins, coverage = insertsizes.read_pileup(out_dir, region='chr2:100001-200000')
+    assert bins['start'].iloc[0] == 100000 and len(bins) == 100
+    chr2 = fragments[(fragments['chrom'] == 'chr2') & (fragments['barcode'].str[-1].astype(int) % 2 == 1)]
+    cuts = np.concatenate([chr2['start'].to_numpy(), chr2['end'].to_numpy() - 1])
+    expected = np.bincount(cuts[(cuts >= 100000) & (cuts < 200000)] // 1000 - 100, minlength=100)
+    assert (coverage[:, 1].toarray().ravel() == expected).all()
+
+    # one column per barcode, only covered bins are stored
+    per_barcode = insertsizes.cutsite_pileup(synthetic_fragments, tmp_path / 'per_barcode', bin_size=1000)
+    with open(os.path.join(per_barcode, 'barcodes.txt')) as f:
+        labels = f.read().splitlines()
+    _, barcode_coverage = insertsizes.read_pileup(per_barcode, region='chr2:100001-200000', mmap=False)
+    odd = [i for i, label in enumerate(labels) if int(label[-1]) % 2 == 1]
+    assert (np.asarray(barcode_coverage[:, odd].sum(axis=1)).ravel() == expected).all()
+    assert barcode_coverage.nnz <= len(cuts)